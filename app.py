@@ -1,54 +1,2628 @@
 import asyncio
 import aiohttp
+from aiohttp import web
+import atexit
+import bisect
+import html
+import json
+import logging
+import logging.handlers
+import time
 import sqlite3
+import queue
+import concurrent.futures
 import os
 import ssl
-from datetime import datetime, timedelta
-from flask import Flask
+import hmac
+import secrets
+import functools
+import gc
+import hashlib
+import mmap
+from datetime import datetime, timedelta, time as dtime
+from zoneinfo import ZoneInfo
 import threading
 import signal
 import sys
+import multiprocessing
+from collections import OrderedDict, deque
+from urllib.parse import quote, urlsplit
+
+# Логи: LOG_LEVEL (DEBUG/INFO/WARNING/ERROR), LOG_FORMAT (text/json),
+# LOG_RATE_LIMIT_SECONDS — не чаще одной повторяющейся строки одного вида за интервал
+logger = logging.getLogger("medbot")
+log_listener = None
+
+# Время напоминания хранится как минуты от полуночи в часовом поясе пользователя
+DEFAULT_TIMEZONE = os.environ.get("DEFAULT_TIMEZONE", "Europe/Moscow")
+DEFAULT_REMINDER_MINUTE = 22 * 60
+MINUTE_LABELS = [f"{minute // 60:02d}:{minute % 60:02d}" for minute in range(24 * 60)]
+
+# Дни приёма — битовая маска по datetime.weekday(): бит 0 — понедельник, 127 — каждый день
+WEEKDAY_NAMES = ["пн", "вт", "ср", "чт", "пт", "сб", "вс"]
+ALL_WEEKDAYS = 127
+WEEKDAY_PRESETS = {"ежедневно": ALL_WEEKDAYS, "будни": 31, "выходные": 96}
+# Не больше 63 доз: в журнале приёма у каждой дозы пользователя свой бит в 64-битном INTEGER
+MAX_DOSES_PER_USER = min(int(os.environ.get("MAX_DOSES_PER_USER", 10)), 63)
+MAX_MEDICATION_LENGTH = 64
+
+# Журнал приёма: день — номер локальной даты от 1970-01-01, доза — бит своего schedules.slot
+EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+ADHERENCE_PERIODS = (7, 30, 90)
+
+# Кнопки выбора времени (местное время). Старые подписи вида "19:00 (22:00 ваше)" тоже принимаются
+TIME_CHOICES = {MINUTE_LABELS[minute]: minute for minute in (1320, 1380, 1260, 1200, 1140, 1080)}
+TIME_CHOICES.update({
+    f"{MINUTE_LABELS[minute - 180]} ({label} ваше)": minute
+    for label, minute in list(TIME_CHOICES.items())
+})
+
+# Клавиатуры и тексты ответов: сериализуются в JSON один раз (см. ReplyTemplates)
+MAIN_KEYBOARD = {
+    "keyboard": [
+        ["✅ Включить напоминания", "❌ Выключить напоминания"],
+        ["⚙️ Настроить время", "💊 Мои приёмы"],
+        ["📊 Статус", "🐱 Получить котика сейчас"],
+        ["ℹ️ Помощь"]
+    ],
+    "resize_keyboard": True,
+    "one_time_keyboard": False
+}
+TIME_KEYBOARD = {
+    "keyboard": [
+        [MINUTE_LABELS[1320], MINUTE_LABELS[1380]],
+        [MINUTE_LABELS[1260], MINUTE_LABELS[1200]],
+        [MINUTE_LABELS[1140], MINUTE_LABELS[1080]],
+        ["Назад"]
+    ],
+    "resize_keyboard": True,
+    "one_time_keyboard": True
+}
+
+class ReplyTemplates:
+    """Ответы бота в виде готовых кусков JSON-тела sendMessage
+
+    Хвост тела (text, parse_mode, reply_markup) кодируется один раз; при отправке к нему
+    приклеивается только chat_id. Ответы, зависящие от времени напоминания, кодируются
+    при первом обращении и дальше берутся из LRU-кэша ограниченного размера.
+    """
+
+    def __init__(self):
+        self.help = self.encode(
+            "🐱 <b>Бот-напоминалка с котиками</b> 💊\n\n"
+            "Я буду напоминать вам выпить таблетки каждый день в указанное время "
+            "и радовать фотографиями котиков! 😻\n\n"
+            "<b>Внимание:</b> Время указывается по вашему часовому поясу (по умолчанию — московское).\n\n"
+            "<b>Команды:</b>\n"
+            "✅ Включить напоминания - запустить ежедневные напоминания\n"
+            "❌ Выключить напоминания - остановить напоминания\n"
+            "⚙️ Настроить время - изменить время напоминания\n"
+            "💊 Мои приёмы - несколько приёмов в день, разные лекарства и дни недели\n"
+            "📊 Статус - посмотреть текущие настройки\n"
+            "🐱 Получить котика сейчас - мгновенная доза котикотерапии\n"
+            "/stats - сколько приёмов отмечено за 7, 30 и 90 дней\n\n"
+            "Когда примете таблетки, нажмите «✅ Принял» под напоминанием — "
+            "иначе я напомню еще раз.\n\n"
+            "Для начала нажмите «✅ Включить напоминания»!",
+            MAIN_KEYBOARD
+        )
+        self.disabled = self.encode("❌ <b>Напоминания выключены</b>\nВы всегда можете включить их снова!", MAIN_KEYBOARD)
+        self.time_menu = self.encode("🕐 Выберите время для ежедневного напоминания (указано ваше местное время):", TIME_KEYBOARD)
+        self.back = self.encode("Возвращаемся в главное меню:", MAIN_KEYBOARD)
+        self.unknown = self.encode("🤔 Не понимаю команду. Используйте кнопки ниже или /start для помощи", MAIN_KEYBOARD)
+        self.searching = self.encode("🔄 Ищу котика для вас...")
+        self.cat_link_only = self.encode("❌ Не удалось загрузить изображение котика, но вот ссылка выше!")
+        self.cat_failed = self.encode("❌ Не удалось получить котика, попробуйте позже")
+        self.reminder = self.encode(
+            "⏰ <b>Время выпить таблетки!</b> 💊\n\n"
+            "Не забудьте принять лекарство! 🏥\n"
+            "А чтобы поднять настроение - вот вам котик! 🐱"
+        )
+        self.add_usage = self.encode(
+            "✍️ <b>Как добавить приём:</b>\n"
+            "<code>/add 08:30 Витамин D</code> — каждый день\n"
+            "<code>/add 21:00 пн,ср,пт Аспирин</code> — по дням недели\n"
+            "<code>/add 09:00 будни</code> — также <i>выходные</i> и <i>ежедневно</i>\n\n"
+            f"Название — до {MAX_MEDICATION_LENGTH} символов, приёмов — не больше {MAX_DOSES_PER_USER}.",
+            MAIN_KEYBOARD
+        )
+        self.remove_usage = self.encode("✍️ Укажите номер приёма из списка «💊 Мои приёмы», например <code>/remove 2</code>", MAIN_KEYBOARD)
+        self.too_many_doses = self.encode(f"⚠️ Можно добавить не больше {MAX_DOSES_PER_USER} приёмов", MAIN_KEYBOARD)
+        self.nudge = self.encode(
+            "🔔 <b>Не забыли про таблетки?</b>\n\n"
+            "Если уже приняли — нажмите «✅ Принял»"
+        )
+        # Кнопка «✅ Принял»: callback_data несет UTC-минуту и маску доз (slot) напоминания,
+        # подставляется при отправке (with_ack)
+        self.ack_markup = b',"reply_markup":' + json.dumps(
+            {"inline_keyboard": [[{"text": "✅ Принял", "callback_data": "ack:%d:%d"}]]},
+            ensure_ascii=False, separators=(",", ":")
+        ).encode() + b'}'
+
+    @staticmethod
+    def encode(text, reply_markup=None):
+        payload = {"text": text, "parse_mode": "HTML"}
+        if reply_markup:
+            payload["reply_markup"] = reply_markup
+        # Без "{" в начале: его вместе с chat_id добавляет body()
+        return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode()[1:]
+
+    @staticmethod
+    def body(chat_id, tail):
+        return b'{"chat_id":%d,%s' % (chat_id, tail)
+
+    @functools.lru_cache(maxsize=1440)
+    def enabled(self, minute):
+        return self.encode(
+            f"✅ <b>Напоминания включены!</b>\n\n"
+            f"Я буду напоминать вам каждый день в <b>{MINUTE_LABELS[minute]}</b> (по вашему времени)\n"
+            f"Не забудьте выпить таблетки! 💊",
+            MAIN_KEYBOARD
+        )
+
+    @functools.lru_cache(maxsize=64)
+    def enabled_many(self, doses):
+        return self.encode(
+            f"✅ <b>Напоминания включены!</b>\n\n"
+            f"Приёмов по расписанию: <b>{doses}</b> — список в «💊 Мои приёмы»\n"
+            f"Не забудьте выпить таблетки! 💊",
+            MAIN_KEYBOARD
+        )
+
+    @functools.lru_cache(maxsize=1440)
+    def time_set(self, minute):
+        return self.encode(
+            f"🕐 <b>Время установлено!</b>\nНапоминания будут в <b>{MINUTE_LABELS[minute]}</b> (по вашему времени)",
+            MAIN_KEYBOARD
+        )
+
+    @functools.lru_cache(maxsize=4096)
+    def status(self, is_active, doses, day, minute):
+        """day — "сегодня", "завтра" или день недели; None, если напоминаний не будет"""
+        next_text = f"{day} в {MINUTE_LABELS[minute]}" if day else "—"
+        return self.encode(
+            f"📊 <b>Текущие настройки:</b>\n\n"
+            f"• Напоминания: <b>{'🟢 ВКЛЮЧЕНЫ' if is_active else '🔴 ВЫКЛЮЧЕНЫ'}</b>\n"
+            f"• Приёмов по расписанию: <b>{doses}</b>\n"
+            f"• Следующее напоминание: <b>{next_text}</b> (по вашему времени)",
+            MAIN_KEYBOARD
+        )
+
+    def with_ack(self, tail, ack):
+        """Добавляет к готовому хвосту без клавиатуры кнопку «✅ Принял»; ack — (UTC-минута, маска доз)"""
+        if not ack:
+            return tail
+        return tail[:-1] + self.ack_markup % ack
+
+    def reminder_for(self, medication, ack=None):
+        """Напоминание с названиями лекарств; без названий — общий готовый текст"""
+        if not medication:
+            return self.with_ack(self.reminder, ack)
+        return self.with_ack(self.encode(
+            "⏰ <b>Время выпить таблетки!</b> 💊\n\n"
+            f"<b>{html.escape(medication)}</b>\n\n"
+            "Не забудьте принять лекарство! 🏥\n"
+            "А чтобы поднять настроение - вот вам котик! 🐱"
+        ), ack)
+
+    def nudge_for(self, medication, ack=None):
+        """Повторное напоминание о неотмеченной дозе"""
+        if not medication:
+            return self.with_ack(self.nudge, ack)
+        return self.with_ack(self.encode(
+            "🔔 <b>Не забыли про таблетки?</b>\n\n"
+            f"<b>{html.escape(medication)}</b>\n\n"
+            "Если уже приняли — нажмите «✅ Принял»"
+        ), ack)
+
+    def adherence(self, report):
+        """Статистика приёма из AdherenceLog.report — пользовательские числа, не кэшируется"""
+        lines = []
+        for days, (taken, due) in report['periods'].items():
+            value = f"<b>{taken} из {due}</b> ({taken * 100 // due}%)" if due else "<b>—</b>"
+            lines.append(f"• {days} дней: {value}")
+        lines.append(f"• Дней подряд без пропусков: <b>{report['streak']}</b>")
+        icons = {None: "➖", True: "✅", False: "⚠️"}
+        week = " ".join(f"{WEEKDAY_NAMES[weekday]} {icons[complete]}" for weekday, complete in report['week'])
+        return self.encode(
+            "📈 <b>Отмеченные приёмы</b>\n\n" + "\n".join(lines) + f"\n\nПоследние 7 дней:\n{week}",
+            MAIN_KEYBOARD
+        )
+
+    def doses(self, rows, is_active, title="💊 <b>Ваши приёмы:</b>"):
+        """Список приёмов [(id, минута, дни, название, next_due_minute)] — пользовательский текст, не кэшируется"""
+        if rows:
+            lines = [
+                f"{number}. <b>{MINUTE_LABELS[local_minute]}</b> {format_weekdays(weekdays)}"
+                + (f" — {html.escape(medication)}" if medication else "")
+                for number, (_, local_minute, weekdays, medication, _) in enumerate(rows, start=1)
+            ]
+            text = f"{title}\n\n" + "\n".join(lines)
+        else:
+            text = "💊 Приёмов пока нет."
+        if not is_active:
+            text += "\n\n🔴 Напоминания выключены — включите их кнопкой «✅ Включить напоминания»."
+        return self.encode(
+            text + "\n\nДобавить: <code>/add 08:30 Витамин D</code>\nУдалить: <code>/remove 1</code>",
+            MAIN_KEYBOARD
+        )
+
+REPLIES = ReplyTemplates()
 
 print("🐱 БОТ-НАПОМИНАЛКА С КОТИКАМИ (TIMEZONE FIXED)")
 print("=" * 50)
 
-# Создаем Flask приложение для Railway
-app = Flask(__name__)
+def create_app():
+    """HTTP-приложение для Railway: работает в том же event loop, что и бот"""
+    app = web.Application()
+    routes = web.RouteTableDef()
+    
+    @routes.get('/')
+    async def home(request):
+        return web.Response(text="🐱 Medication Reminder Bot is running on Railway!")
+    
+    @routes.get('/health')
+    async def health(request):
+        return web.Response(text="✅ OK")
+    
+    @routes.get('/status')
+    async def status(request):
+        result = {
+            "status": "running",
+            "bot": "Medication Reminder Bot",
+            "timestamp": datetime.now().isoformat()
+        }
+        if bot_instance:
+            result["http_pool"] = bot_instance.http.stats()
+            result["reminder_slots"] = list(bot_instance.dispatcher.slot_stats)
+            result["cat_pool"] = bot_instance.cat_pool.stats()
+            result["cat_providers"] = bot_instance.cat_providers.stats()
+            result["image_cache"] = bot_instance.image_cache.stats()
+            result["file_id_cache"] = bot_instance.file_ids.stats()
+            result["updates"] = bot_instance.update_workers.stats()
+            result["processed_updates"] = bot_instance.processed_updates.stats()
+            result["user_settings"] = bot_instance.settings.stats()
+            result["outbox"] = bot_instance.outbox.stats()
+            result["schedules"] = bot_instance.scheduler.stats()
+            result["adherence"] = bot_instance.adherence.stats()
+        return web.json_response(result)
+    
+    @routes.get('/metrics')
+    async def metrics(request):
+        """Метрики в текстовом формате Prometheus"""
+        sources = [((), METRICS.snapshot())]
+        if bot_instance and bot_instance.shards > 1:
+            # Процессы доставки присылают свои снимки; различаем их меткой shard
+            sources = [((('shard', '0'),), sources[0][1])] + bot_instance.collect_worker_metrics()
+        return web.Response(
+            body=METRICS.render(sources).encode(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+        )
+    
+    def admin_denied(request):
+        """Проверяет Authorization: Bearer ADMIN_TOKEN; без ADMIN_TOKEN админские маршруты выключены"""
+        admin_token = os.environ.get("ADMIN_TOKEN")
+        if not admin_token:
+            return web.Response(text="Not found", status=404)
+        supplied = request.headers.get("Authorization", "").removeprefix("Bearer ")
+        if not hmac.compare_digest(supplied.encode(), admin_token.encode()):
+            return web.Response(text="⛔ Forbidden", status=403)
+        if not bot_instance or not bot_instance.loop:
+            return web.Response(text="⏳ Bot is not ready", status=503)
+        return None
+    
+    @routes.post('/admin/broadcast')
+    async def broadcast(request):
+        """Запускает рассылку всем активным пользователям: {"text": "..."}"""
+        denied = admin_denied(request)
+        if denied:
+            return denied
+        
+        try:
+            payload = await request.json()
+        except ValueError:
+            payload = None
+        text = payload.get("text") if isinstance(payload, dict) else None
+        if not isinstance(text, str) or not text.strip():
+            return web.json_response({"error": "text is required"}, status=400)
+        
+        broadcast_id = await bot_instance.start_broadcast(text)
+        return web.json_response({"id": broadcast_id, "progress": f"/admin/broadcast/{broadcast_id}"}, status=202)
+    
+    @routes.route('*', r'/admin/broadcast/{broadcast_id:\d+}')
+    async def broadcast_progress(request):
+        """Прогресс рассылки (GET) или ее отмена (DELETE)"""
+        if request.method not in ('GET', 'DELETE'):
+            raise web.HTTPMethodNotAllowed(request.method, ['GET', 'DELETE'])
+        denied = admin_denied(request)
+        if denied:
+            return denied
+        
+        broadcast_id = int(request.match_info['broadcast_id'])
+        if request.method == 'DELETE':
+            await bot_instance.broadcasts.cancel(broadcast_id)
+        progress = await bot_instance.broadcasts.progress(broadcast_id)
+        if progress is None:
+            return web.json_response({"error": "broadcast not found"}, status=404)
+        return web.json_response(progress)
+    
+    @routes.get('/admin/adherence')
+    async def adherence_export(request):
+        """CSV с отмеченными приёмами по пользователям за ?days= дней (30 по умолчанию), потоком"""
+        denied = admin_denied(request)
+        if denied:
+            return denied
+        
+        days = request.query.get("days", "30")
+        if not (days.isascii() and days.isdigit() and 1 <= int(days) <= max(ADHERENCE_PERIODS)):
+            return web.json_response({"error": f"days must be 1..{max(ADHERENCE_PERIODS)}"}, status=400)
+        
+        response = web.StreamResponse(headers={
+            "Content-Type": "text/csv; charset=utf-8",
+            "Content-Disposition": f'attachment; filename="adherence-{days}d.csv"'
+        })
+        await response.prepare(request)
+        await response.write(b"user_id,days,doses_due,doses_taken,adherence_percent\n")
+        async for chunk in bot_instance.adherence.export(int(days)):
+            await response.write(chunk)
+        await response.write_eof()
+        return response
+    
+    @routes.post(os.environ.get("WEBHOOK_PATH", "/webhook"))
+    async def webhook(request):
+        """Принимает апдейты Telegram в режиме webhook"""
+        if not bot_instance or not bot_instance.webhook_url or not bot_instance.loop:
+            return web.Response(text="⏳ Bot is not ready", status=503)
+        
+        secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        # Сравниваем байты: compare_digest на str с не-ASCII символами бросает TypeError
+        if not hmac.compare_digest(secret.encode(), bot_instance.webhook_secret.encode()):
+            return web.Response(text="⛔ Forbidden", status=403)
+        
+        try:
+            update = await request.json()
+        except ValueError:
+            update = None
+        if not isinstance(update, dict) or "update_id" not in update:
+            return web.Response(text="❌ Bad update", status=400)
+        
+        # Кладем апдейт в тот же пул обработчиков, что и polling; ждем, пока очередь его примет.
+        # Не принятый апдейт Telegram пришлет повторно в ответ на 503
+        try:
+            accepted = await bot_instance.accept_update(update)
+        except Exception as e:
+            bot_instance.log(f"❌ Не удалось принять апдейт: {e}", logging.ERROR, key="webhook_accept")
+            accepted = False
+        if not accepted:
+            return web.Response(text="⏳ Busy, retry later", status=503)
+        return web.Response()
+    
+    app.add_routes(routes)
+    return app
+
+class HttpClientPool:
+    """Общий пул HTTP-сессий на время жизни бота: одна сессия на хост с keep-alive"""
+
+    def __init__(self, ssl_context, limit_per_host=100, dns_ttl=300, keepalive_timeout=60):
+        self.ssl_context = ssl_context
+        self.limit_per_host = limit_per_host
+        self.dns_ttl = dns_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.sessions = {}
+        self.counters = {}
+
+    def _host_key(self, url):
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def _create_trace_config(self, counters):
+        """Считает новые и переиспользованные соединения через trace-хуки aiohttp"""
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, context, params):
+            counters['requests'] += 1
+
+        async def on_connection_create_end(session, context, params):
+            counters['created'] += 1
+
+        async def on_connection_reuseconn(session, context, params):
+            counters['reused'] += 1
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace_config
+
+    def session_for(self, url):
+        """Возвращает (или создает) сессию для хоста из url"""
+        key = self._host_key(url)
+        session = self.sessions.get(key)
+        if session is None or session.closed:
+            counters = self.counters.setdefault(key, {'requests': 0, 'created': 0, 'reused': 0})
+            connector = aiohttp.TCPConnector(
+                ssl=self.ssl_context,
+                limit=0,
+                limit_per_host=self.limit_per_host,
+                use_dns_cache=True,
+                ttl_dns_cache=self.dns_ttl,
+                keepalive_timeout=self.keepalive_timeout
+            )
+            session = aiohttp.ClientSession(
+                connector=connector,
+                trace_configs=[self._create_trace_config(counters)]
+            )
+            self.sessions[key] = session
+        return session
+
+    def stats(self):
+        """Статистика пула по хостам: открытые, простаивающие и переиспользованные соединения"""
+        result = {}
+        for key, session in list(self.sessions.items()):
+            connector = session.connector
+            # У aiohttp нет публичного API для размеров пула, поэтому читаем внутренние поля аккуратно
+            idle = sum(len(conns) for conns in getattr(connector, '_conns', {}).values()) if connector else 0
+            in_use = len(getattr(connector, '_acquired', ())) if connector else 0
+            counters = self.counters.get(key, {})
+            result[key] = {
+                'open': idle + in_use,
+                'idle': idle,
+                'in_use': in_use,
+                'created': counters.get('created', 0),
+                'reused': counters.get('reused', 0),
+                'requests': counters.get('requests', 0),
+                'closed': session.closed
+            }
+        return result
+
+    async def close(self):
+        """Закрывает все сессии пула"""
+        for session in self.sessions.values():
+            if not session.closed:
+                await session.close()
+        self.sessions.clear()
+
+def shard_for(user_id, shards):
+    """Номер процесса доставки, которому принадлежит пользователь"""
+    return user_id % shards
+
+@functools.lru_cache(maxsize=None)
+def get_zone(name):
+    return ZoneInfo(name)
+
+def next_fire_time(reminder_minute, timezone, after=None, weekdays=ALL_WEEKDAYS):
+    """Возвращает UTC timestamp ближайшего срабатывания строго после after (только в дни из маски weekdays)"""
+    zone = get_zone(timezone)
+    now = datetime.fromtimestamp(time.time() if after is None else after, zone)
+    target_time = dtime(reminder_minute // 60, reminder_minute % 60)
+    
+    for days in range(8):
+        day = now.date() + timedelta(days=days)
+        if not weekdays >> day.weekday() & 1:
+            continue
+        target_datetime = datetime.combine(day, target_time, tzinfo=zone)
+        if target_datetime > now:
+            return target_datetime.timestamp()
+    raise ValueError(f"Пустая маска дней недели: {weekdays}")
+
+def parse_local_minute(token):
+    """"08:30" -> минута от полуночи; None, если это не время"""
+    hours, sep, minutes = token.partition(":")
+    if not (sep and hours.isascii() and hours.isdigit() and minutes.isascii() and minutes.isdigit() and len(minutes) == 2):
+        return None
+    if int(hours) > 23 or int(minutes) > 59:
+        return None
+    return int(hours) * 60 + int(minutes)
+
+def parse_weekdays(token):
+    """"пн,ср,пт", "будни", "выходные", "ежедневно" -> битовая маска; None, если это не дни недели"""
+    token = token.lower()
+    if token in WEEKDAY_PRESETS:
+        return WEEKDAY_PRESETS[token]
+    mask = 0
+    for name in token.split(","):
+        if name not in WEEKDAY_NAMES:
+            return None
+        mask |= 1 << WEEKDAY_NAMES.index(name)
+    return mask
+
+@functools.lru_cache(maxsize=4096)
+def dose_day(due_minute, timezone):
+    """UTC-минута дозы -> локальный день в журнале приёма"""
+    return datetime.fromtimestamp(due_minute * 60, get_zone(timezone)).toordinal() - EPOCH_ORDINAL
+
+def format_weekdays(mask):
+    if mask == ALL_WEEKDAYS:
+        return "ежедневно"
+    if mask == WEEKDAY_PRESETS["будни"]:
+        return "по будням"
+    if mask == WEEKDAY_PRESETS["выходные"]:
+        return "по выходным"
+    return ", ".join(name for index, name in enumerate(WEEKDAY_NAMES) if mask >> index & 1)
+
+class LatencyStats:
+    """Счетчик задержек: количество, сумма, максимум и перцентили по последним замерам"""
+
+    def __init__(self, window=1000):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=window)
 
-@app.route('/')
-def home():
-    return "🐱 Medication Reminder Bot is running on Railway!"
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.recent.append(seconds)
 
-@app.route('/health')
-def health():
-    return "✅ OK", 200
+    def percentile(self, q):
+        if not self.recent:
+            return None
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'avg': round(self.total / self.count, 4) if self.count else None,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+            'max': round(self.max, 4)
+        }
+
+class RateLimitFilter(logging.Filter):
+    """Пропускает не больше одной записи за interval секунд на ключ (extra={'key': ...}), остальные считает"""
+
+    def __init__(self, interval):
+        super().__init__()
+        self.interval = interval
+        self.last = {}
+        self.suppressed = {}
+
+    def filter(self, record):
+        key = getattr(record, 'key', None)
+        if key is None or self.interval <= 0:
+            return True
+        if record.created - self.last.get(key, 0) < self.interval:
+            self.suppressed[key] = self.suppressed.get(key, 0) + 1
+            return False
+        self.last[key] = record.created
+        skipped = self.suppressed.pop(key, 0)
+        if skipped and not record.args:
+            record.msg = f"{record.msg} (+{skipped} похожих)"
+        return True
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    """Кладет запись в очередь как есть: копирование и форматирование — в фоновом потоке"""
+
+    def prepare(self, record):
+        return record
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'pid': record.process,
+            'msg': record.getMessage()
+        }
+        key = getattr(record, 'key', None)
+        if key:
+            entry['key'] = key
+        return json.dumps(entry, ensure_ascii=False)
+
+def setup_logging():
+    """Логи через очередь: вызывающий код только кладет запись, форматирует и пишет в stdout фоновый поток"""
+    global log_listener
+    if log_listener is not None:
+        return log_listener
+    
+    output = logging.StreamHandler(sys.stdout)
+    if os.environ.get("LOG_FORMAT", "text").lower() == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter("[%(asctime)s] %(message)s", "%Y-%m-%d %H:%M:%S"))
+    
+    # Имена потока и процесса в записях не используются, а их получение заметно дорожает на горячем пути
+    logging.logThreads = False
+    logging.logMultiprocessing = False
+    
+    log_queue = queue.SimpleQueue()
+    queue_handler = RecordQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(float(os.environ.get("LOG_RATE_LIMIT_SECONDS", 10))))
+    logger.addHandler(queue_handler)
+    logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+    logger.propagate = False
+    
+    log_listener = logging.handlers.QueueListener(log_queue, output)
+    log_listener.start()
+    # Дописываем очередь логов при выходе
+    atexit.register(stop_logging)
+    return log_listener
+
+def stop_logging():
+    """Дописывает накопленные записи и останавливает фоновый поток логов"""
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
+def format_labels(pairs):
+    """Метки вида {name="value",...} с экранированием по правилам Prometheus"""
+    if not pairs:
+        return ""
+    parts = []
+    for name, value in pairs:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{name}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+class MetricsRegistry:
+    """Счетчики, гистограммы и gauge в текстовом формате Prometheus; запись — O(1) под одной блокировкой"""
 
-@app.route('/status')
-def status():
-    return {
-        "status": "running",
-        "bot": "Medication Reminder Bot",
-        "timestamp": datetime.now().isoformat()
-    }
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.meta = {}
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def counter(self, name, help_text, labelnames=()):
+        self.meta[name] = ('counter', help_text, labelnames, None)
+
+    def histogram(self, name, help_text, labelnames=(), buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)):
+        self.meta[name] = ('histogram', help_text, labelnames, tuple(buckets))
+
+    def gauge(self, name, help_text, fn):
+        """fn() вызывается при каждом снятии метрик"""
+        self.meta[name] = ('gauge', help_text, (), None)
+        self.gauges[name] = fn
+
+    def inc(self, name, *labels, amount=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, *labels):
+        buckets = self.meta[name][3]
+        index = bisect.bisect_left(buckets, value)
+        key = (name, labels)
+        with self.lock:
+            series = self.histograms.get(key)
+            if series is None:
+                series = self.histograms[key] = [[0] * (len(buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self):
+        """Копия всех значений (можно передать между процессами)"""
+        gauges = {}
+        for name, fn in list(self.gauges.items()):
+            try:
+                gauges[name] = fn()
+            except Exception:
+                continue
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'histograms': {key: (list(series[0]), series[1], series[2]) for key, series in self.histograms.items()},
+                'gauges': gauges
+            }
+
+    def render(self, sources):
+        """Текст для /metrics; sources — [(дополнительные метки, снимок)]"""
+        lines = []
+        for name, (kind, help_text, labelnames, buckets) in self.meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for extra, snapshot in sources:
+                if kind == 'gauge':
+                    if name in snapshot['gauges']:
+                        lines.append(f"{name}{format_labels(extra)} {snapshot['gauges'][name]}")
+                elif kind == 'counter':
+                    for (metric, values), value in snapshot['counters'].items():
+                        if metric == name:
+                            lines.append(f"{name}{format_labels(extra + tuple(zip(labelnames, values)))} {value}")
+                else:
+                    for (metric, values), (counts, total, count) in snapshot['histograms'].items():
+                        if metric != name:
+                            continue
+                        labels = extra + tuple(zip(labelnames, values))
+                        cumulative = 0
+                        for bound, bucket_count in zip(buckets + ("+Inf",), counts):
+                            cumulative += bucket_count
+                            lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+                        lines.append(f"{name}_sum{format_labels(labels)} {total}")
+                        lines.append(f"{name}_count{format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+# Метрики процесса. Gauge регистрирует бот, остальные пишутся прямо из горячих путей
+METRICS = MetricsRegistry()
+METRICS.histogram("medbot_telegram_request_seconds", "Длительность запросов к Telegram Bot API", ("method",),
+                  (0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+METRICS.counter("medbot_telegram_requests_total", "Запросы к Telegram Bot API по результату", ("method", "result"))
+METRICS.histogram("medbot_cat_api_request_seconds", "Длительность запросов к cat API", ("provider",),
+                  (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+METRICS.counter("medbot_cat_api_requests_total", "Запросы к cat API по результату", ("provider", "result"))
+METRICS.histogram("medbot_reminder_lateness_seconds", "Опоздание напоминания: фактическая отправка минус плановое время", (),
+                  (0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600))
+METRICS.counter("medbot_reminders_total", "Напоминания по результату доставки", ("result",))
+METRICS.counter("medbot_nudges_total", "Повторные напоминания о неотмеченных дозах по результату доставки", ("result",))
+METRICS.counter("medbot_doses_acknowledged_total", "Дозы, отмеченные кнопкой «✅ Принял»")
+METRICS.counter("medbot_scheduled_doses_total", "Наступившие дозы: записаны в журнал (по заданию на пользователя и минуту) или просрочены", ("result",))
+METRICS.histogram("medbot_message_processing_seconds", "Время обработки входящего сообщения")
+METRICS.histogram("medbot_db_query_seconds", "Время чтения и пачки записей в SQLite", ("kind",),
+                  (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1))
+
+class DoseScheduler:
+    """Планировщик доз по таблице schedules: раз в минуту один запрос по индексу next_due_minute
+
+    Наступившие дозы в одной транзакции переносятся на следующее срабатывание,
+    записываются в журнал напоминаний (одно задание на пользователя и минуту, названия
+    лекарств — в payload). В журнал приёма (dose_log) доза попадает только после доставки.
+    Раздает задания цикл журнала порциями, поэтому ни здесь, ни при доставке не держится
+    состояние на каждого пользователя, и запуск не зависит от числа строк в schedules.
+    Дозы, просроченные больше чем на grace секунд (бот долго не работал), переносятся
+    без отправки.
+    """
+
+    def __init__(self, db, notify, log, grace=3600, batch_size=5000, shard_index=0, shards=1):
+        self.db = db
+        self.notify = notify
+        self.log = log
+        self.grace_minutes = grace // 60
+        self.batch_size = batch_size
+        # Каждый процесс доставки забирает только дозы своих пользователей
+        self.shard = (shards, shard_index)
+        self.task = None
+        self.ticks = 0
+        self.queued = 0
+        self.expired = 0
+        self.last_tick_seconds = 0.0
+        self.scheduled_users = 0
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self):
+        """Тик в начале каждой минуты; если тик затянулся, следующий идет сразу"""
+        while True:
+            minute = int(time.time() // 60)
+            try:
+                await self.tick(minute)
+            except Exception as e:
+                self.log(f"❌ Ошибка планировщика доз: {e}", logging.ERROR, key="dose_scheduler_error")
+            await asyncio.sleep(max(0, (minute + 1) * 60 - time.time()))
+
+    async def tick(self, now_minute):
+        """Переносит в журнал все дозы с next_due_minute <= now_minute, порциями по batch_size"""
+        started = time.monotonic()
+        queued = expired = 0
+        while True:
+            rows, jobs, skipped = await asyncio.wrap_future(
+                self.db.submit_write(functools.partial(self._claim, now_minute))
+            )
+            queued += jobs
+            expired += skipped
+            if jobs:
+                self.notify()
+            if rows < self.batch_size:
+                break
+        
+        self.ticks += 1
+        self.queued += queued
+        self.expired += expired
+        # Для /metrics: считаем раз за тик, а не на каждый запрос метрик
+        row = await self.db.fetchone('''
+            SELECT COUNT(*) FROM (SELECT DISTINCT user_id FROM schedules WHERE next_due_minute IS NOT NULL AND user_id % ? = ?)
+        ''', self.shard)
+        self.scheduled_users = row[0]
+        self.last_tick_seconds = time.monotonic() - started
+        if queued:
+            METRICS.inc("medbot_scheduled_doses_total", "queued", amount=queued)
+        if expired:
+            METRICS.inc("medbot_scheduled_doses_total", "expired", amount=expired)
+            self.log(f"⌛ Пропущено {expired} доз старше {self.grace_minutes} мин — перенесены на следующий раз", logging.WARNING)
+        return queued, expired
+
+    def _claim(self, now_minute, conn):
+        # Выполняется в потоке SQLite внутри транзакции записи
+        rows = conn.execute('''
+            SELECT id, user_id, chat_id, medication, local_minute, weekdays, timezone, next_due_minute, slot FROM schedules
+            WHERE next_due_minute <= ? AND user_id % ? = ?
+            ORDER BY next_due_minute, user_id LIMIT ?
+        ''', (now_minute,) + self.shard + (self.batch_size,)).fetchall()
+        if len(rows) == self.batch_size:
+            # Дозы одного пользователя на одну минуту не разрываются между порциями,
+            # иначе вторая порция не смогла бы дописать названия в то же задание
+            last = rows[-1]
+            claimed = {row[0] for row in rows}
+            rows.extend(row for row in conn.execute('''
+                SELECT id, user_id, chat_id, medication, local_minute, weekdays, timezone, next_due_minute, slot FROM schedules
+                WHERE next_due_minute = ? AND user_id = ?
+            ''', (last[7], last[1])) if row[0] not in claimed)
+        
+        oldest = now_minute - self.grace_minutes
+        next_minutes = {}
+        updates = []
+        doses = {}
+        expired = 0
+        for schedule_id, user_id, chat_id, medication, local_minute, weekdays, timezone, due, slot in rows:
+            # Следующее срабатывание одинаково для всех доз с тем же временем, днями и поясом
+            key = (local_minute, weekdays, timezone)
+            next_due = next_minutes.get(key)
+            if next_due is None:
+                next_due = next_minutes[key] = int(next_fire_time(local_minute, timezone, now_minute * 60, weekdays) // 60)
+            updates.append((next_due, schedule_id))
+            if due < oldest:
+                # Отрицательное значение — доза из миграции, время которой еще не считалось
+                expired += due >= 0
+                continue
+            # Задание: чат, названия и маска доз (бит slot каждой) для кнопки «✅ Принял»
+            dose = doses.get((user_id, due))
+            if dose is None:
+                dose = doses[(user_id, due)] = [chat_id, [], 0]
+            if medication:
+                dose[1].append(medication)
+            dose[2] |= 1 << slot
+        
+        conn.executemany("UPDATE schedules SET next_due_minute = ? WHERE id = ?", updates)
+        conn.executemany('''
+            INSERT OR IGNORE INTO reminder_outbox (user_id, chat_id, due_at, payload, slots, next_attempt_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', [
+            (user_id, chat_id, due * 60, ", ".join(names) or None, slots, due * 60)
+            for (user_id, due), (chat_id, names, slots) in doses.items()
+        ])
+        return len(rows), len(doses), expired
+
+    def stats(self):
+        return {
+            'ticks': self.ticks,
+            'queued': self.queued,
+            'expired': self.expired,
+            'scheduled_users': self.scheduled_users,
+            'last_tick_seconds': round(self.last_tick_seconds, 3)
+        }
+
+class RateLimiter:
+    """Token bucket для лимитов Telegram: общий на бота и отдельный на каждый чат"""
+
+    def __init__(self, global_rate=30, chat_rate=1):
+        self.global_rate = global_rate
+        self.chat_interval = 1 / chat_rate
+        self.tokens = global_rate
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.chat_next = {}
+
+    def pause(self, seconds):
+        """Приостанавливает отправку после 429 (retry_after)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def _reserve_chat_slot(self, chat_id, now):
+        # Резервируем ближайшее свободное окно для чата, чтобы сохранить порядок сообщений
+        slot = max(now, self.chat_next.get(chat_id, 0))
+        self.chat_next[chat_id] = slot + self.chat_interval
+        if len(self.chat_next) > 10000:
+            self.chat_next = {key: value for key, value in self.chat_next.items() if value > now}
+        return slot - now
+
+    async def acquire(self, chat_id=None):
+        """Ждет, пока можно отправить сообщение в чат"""
+        if chat_id is not None:
+            wait = self._reserve_chat_slot(chat_id, time.monotonic())
+            if wait > 0:
+                await asyncio.sleep(wait)
+        
+        while True:
+            now = time.monotonic()
+            if self.paused_until > now:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            
+            self.tokens = min(self.global_rate, self.tokens + (now - self.updated) * self.global_rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.global_rate)
+
+class TelegramClient:
+    """Запросы к Telegram Bot API: общий пул соединений, лимиты Telegram и retry_after
+
+    Отдельно от бота, чтобы CLI рассылки отправлял сообщения, не поднимая весь бот.
+    """
+
+    JSON_HEADERS = {"Content-Type": "application/json"}
+
+    def __init__(self, token, http, rate_limiter, log):
+        # Адрес API можно подменить (например, на локальную заглушку из loadtest.py)
+        self.base_url = f"{os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org').rstrip('/')}/bot{token}"
+        self.http = http
+        self.rate_limiter = rate_limiter
+        self.log = log
+
+    async def make_request(self, method, data=None, retries=3, files=None, body=None, chat_id=None):
+        """Оптимизированный запрос к Telegram API с учетом лимитов и retry_after
+
+        files: {поле: (имя файла, содержимое, content-type)} — отправка multipart
+        body: готовое JSON-тело (bytes) вместо data; chat_id для лимита тогда передается отдельно
+        """
+        if chat_id is None and data:
+            chat_id = data.get('chat_id')
+        for attempt in range(retries):
+            if chat_id is not None:
+                await self.rate_limiter.acquire(chat_id)
+
+            started = time.monotonic()
+            result = await self._send_request(method, data, files, body)
+            METRICS.observe("medbot_telegram_request_seconds", time.monotonic() - started, method)
+            if result is None:
+                METRICS.inc("medbot_telegram_requests_total", method, "network_error")
+            else:
+                METRICS.inc("medbot_telegram_requests_total", method, "ok" if result.get('ok') else str(result.get('error_code')))
+
+            if result and result.get('error_code') == 429:
+                retry_after = result.get('parameters', {}).get('retry_after', 1)
+                self.log(f"⏳ Лимит Telegram ({method}), ждем {retry_after} сек", logging.WARNING, key="telegram_429")
+                self.rate_limiter.pause(retry_after)
+                continue
+            return result
+        return result
+
+    async def _send_request(self, method, data=None, files=None, body=None):
+        url = f"{self.base_url}/{method}"
+
+        try:
+            session = self.http.session_for(url)
+            timeout = aiohttp.ClientTimeout(total=30)
+
+            if body is not None:
+                async with session.post(url, data=body, headers=self.JSON_HEADERS, timeout=timeout) as response:
+                    return await response.json()
+            elif data:
+                # Для отправки фото используем form-data
+                if files or ('photo' in data and data['photo'].startswith('http')):
+                    form_data = aiohttp.FormData()
+                    for key, value in data.items():
+                        form_data.add_field(key, str(value))
+                    for field, (filename, content, content_type) in (files or {}).items():
+                        form_data.add_field(field, content, filename=filename, content_type=content_type)
+                    async with session.post(url, data=form_data, timeout=timeout) as response:
+                        return await response.json()
+                else:
+                    async with session.post(url, json=data, timeout=timeout) as response:
+                        return await response.json()
+            else:
+                async with session.get(url, timeout=timeout) as response:
+                    return await response.json()
+        except Exception as e:
+            self.log(f"❌ Ошибка запроса: {e}", logging.ERROR, key="telegram_request_error")
+            return None
+
+class ReminderDispatcher:
+    """Раздает напоминания одного слота через лимитер и считает задержку доставки слота"""
+
+    def __init__(self, send, log, concurrency=100):
+        self.send = send
+        self.log = log
+        self.concurrency = concurrency
+        self.slot_stats = deque(maxlen=50)
+
+    async def dispatch_slot(self, slot_ts, recipients, *args, record=True):
+        """Отправляет напоминания всем получателям слота: send(*recipient, *args)
+
+        record=False — не попадает в статистику слотов (повторные напоминания идут спустя
+        NUDGE_AFTER_MINUTES после слота, и их задержка не говорит о скорости доставки).
+        """
+        pending = deque(recipients)
+        stats = {
+            'slot': datetime.fromtimestamp(slot_ts).isoformat(),
+            'recipients': len(recipients),
+            'sent': 0,
+            'failed': 0,
+            'latency': None
+        }
+        
+        async def worker():
+            while pending:
+                recipient = pending.popleft()
+                try:
+                    ok = await self.send(*recipient, *args)
+                except Exception as e:
+                    self.log(f"❌ Ошибка в напоминании: {e}", logging.ERROR)
+                    ok = False
+                stats['sent' if ok else 'failed'] += 1
+        
+        workers = min(self.concurrency, len(recipients))
+        await asyncio.gather(*(worker() for _ in range(workers)))
+        
+        # Задержка слота: время, когда последний пользователь получил напоминание
+        stats['latency'] = round(time.time() - slot_ts, 3)
+        if not record:
+            return stats
+        self.slot_stats.append(stats)
+        self.log(f"📬 Слот {stats['slot']}: {stats['sent']}/{stats['recipients']} напоминаний, задержка {stats['latency']} сек")
+        return stats
+
+class ReminderOutbox:
+    """Журнал напоминаний в SQLite: каждое срабатывание сначала записывается как задание
+
+    Задания записывает DoseScheduler, а раздает цикл журнала (claim_due) порциями.
+    После отправки задание может вернуться в pending со stage + 1 — это повторное
+    напоминание о неотмеченной дозе (см. mark_sent); отметка дозы снимает его (cancel_nudges).
+    Задание живет в статусе pending, пока не отправлено. Взятое в работу задание получает
+    аренду (next_attempt_at в будущем), поэтому после падения процесса оно снова станет
+    доступным. Порция может ждать лимитера дольше аренды, поэтому перед отправкой аренда
+    продлевается (renew) при условии, что ее никто не перехватил; взятые задания процесса
+    повторно не берутся. Ошибки повторяются с экспоненциальной задержкой до max_attempts.
+    Сам журнал разбирает ~24k заданий/сек (`python bench.py outbox`, 10k заданий без сети),
+    так что узким местом остается лимит Telegram.
+    """
+
+    def __init__(self, db, max_attempts=5, base_delay=30, lease=600, shard_index=0, shards=1):
+        self.db = db
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.lease = lease
+        # Каждый процесс доставки видит только задания своих пользователей
+        self.shard = (shards, shard_index)
+        # job_id -> next_attempt_at, который выставил этот процесс; пока задание здесь, оно наше
+        self.leases = {}
+        self.sent = 0
+        self.failed = 0
+
+    async def claim_due(self, limit=1000):
+        """Берет в работу задания, время попытки которых наступило: {due_at: [(job_id, user_id, chat_id, payload, stage, slots)]}"""
+        now = int(time.time())
+        # Задания, которые еще ждут отправки в этом процессе, не берутся второй раз
+        held = json.dumps(list(self.leases))
+
+        def write(conn):
+            jobs = conn.execute('''
+                SELECT id, user_id, chat_id, payload, stage, slots, due_at FROM reminder_outbox
+                WHERE status = 'pending' AND next_attempt_at <= ? AND user_id % ? = ?
+                  AND id NOT IN (SELECT value FROM json_each(?))
+                ORDER BY next_attempt_at LIMIT ?
+            ''', (now,) + self.shard + (held, limit)).fetchall()
+            conn.executemany(
+                "UPDATE reminder_outbox SET next_attempt_at = ? WHERE id = ?",
+                [(now + self.lease, job[0]) for job in jobs]
+            )
+            return jobs
+
+        slots = {}
+        for *job, due_at in await asyncio.wrap_future(self.db.submit_write(write)):
+            self.leases[job[0]] = now + self.lease
+            slots.setdefault(due_at, []).append(tuple(job))
+        return slots
+
+    async def renew(self, job_id):
+        """Продлевает аренду перед отправкой; False — задание перехвачено другим процессом или завершено"""
+        lease_until = self.leases.get(job_id)
+        if lease_until is None:
+            return False
+        now = int(time.time())
+        if lease_until - now > self.lease // 2:
+            # Аренда еще далека от истечения: взять задание до ее конца никто не может
+            return True
+        renewed = now + self.lease
+        updated = await self.db.execute(
+            "UPDATE reminder_outbox SET next_attempt_at = ? WHERE id = ? AND status = 'pending' AND next_attempt_at = ?",
+            (renewed, job_id, lease_until)
+        )
+        if not updated:
+            self.leases.pop(job_id, None)
+            return False
+        self.leases[job_id] = renewed
+        return True
+
+    def mark_sent(self, job_id, nudge_at=None, dose=None):
+        """Завершает задание после отправки
+
+        dose=(user_id, day, маска доз) — доставленные дозы: их биты попадают в due_mask журнала
+        приёма. С nudge_at задание остается pending до повторного напоминания, если дозы еще не
+        отмечены. Проверка идет в той же очереди записей, что и отметка «✅ Принял», поэтому
+        нажатие во время отправки (до перевода задания на следующий stage) повтор не запустит.
+        """
+        self.sent += 1
+        self.leases.pop(job_id, None)
+        now = int(time.time())
+
+        def write(conn):
+            taken = False
+            if dose is not None:
+                user_id, day, mask = dose
+                taken = conn.execute('''
+                    INSERT INTO dose_log (user_id, day, due_mask) VALUES (?, ?, ?)
+                    ON CONFLICT (user_id, day) DO UPDATE SET due_mask = due_mask | excluded.due_mask
+                    RETURNING taken_mask & ? = ?
+                ''', (user_id, day, mask, mask, mask)).fetchone()[0]
+            if nudge_at is None or taken:
+                conn.execute("UPDATE reminder_outbox SET status = 'sent', sent_at = ? WHERE id = ?", (now, job_id))
+            else:
+                conn.execute(
+                    "UPDATE reminder_outbox SET stage = stage + 1, attempts = 0, sent_at = ?, next_attempt_at = ? WHERE id = ?",
+                    (now, nudge_at, job_id)
+                )
+
+        self.db.submit_write(write)
+
+    def cancel_nudges(self, user_id, due_at):
+        """Доза отмечена — ожидающие повторные напоминания больше не нужны"""
+        self.db.submit_write(lambda conn: conn.execute(
+            "UPDATE reminder_outbox SET status = 'sent' WHERE user_id = ? AND due_at = ? AND status = 'pending' AND stage > 0",
+            (user_id, due_at)
+        ))
+
+    def mark_failed(self, job_id, error=None):
+        """Планирует повтор через base_delay * 2^attempts или помечает задание failed"""
+        self.failed += 1
+        self.leases.pop(job_id, None)
+        now = int(time.time())
+        self.db.submit_write(lambda conn: conn.execute('''
+            UPDATE reminder_outbox SET
+                attempts = attempts + 1,
+                status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END,
+                next_attempt_at = ? + ? * (1 << attempts),
+                last_error = ?
+            WHERE id = ?
+        ''', (self.max_attempts, now, self.base_delay, error, job_id)))
+
+    async def recover(self, grace):
+        """После рестарта: снимает аренду с незавершенных заданий и просрочивает слишком старые"""
+        now = int(time.time())
+
+        def write(conn):
+            expired = conn.execute(
+                "UPDATE reminder_outbox SET status = 'expired' WHERE status = 'pending' AND due_at < ? AND user_id % ? = ?",
+                (now - grace,) + self.shard
+            ).rowcount
+            # Повторные напоминания (stage > 0) ждут своего времени, а не уходят сразу
+            recovered = conn.execute(
+                "UPDATE reminder_outbox SET next_attempt_at = ? WHERE status = 'pending' AND attempts = 0 AND stage = 0 AND user_id % ? = ?",
+                (now,) + self.shard
+            ).rowcount
+            return recovered, expired
+
+        return await asyncio.wrap_future(self.db.submit_write(write))
+
+    async def prune(self, keep_seconds=7 * 86400):
+        """Удаляет старые завершенные задания"""
+        return await self.db.execute(
+            "DELETE FROM reminder_outbox WHERE status != 'pending' AND due_at < ?",
+            (int(time.time()) - keep_seconds,)
+        )
+
+    def stats(self):
+        return {'sent': self.sent, 'failed': self.failed}
+
+class Broadcaster:
+    """Рассылка сообщения всем активным пользователям с сохранением прогресса
+
+    Пользователи читаются порциями по user_id (keyset: в памяти только одна порция), сообщения
+    идут через обычную отправку, то есть через общий RateLimiter. После каждой порции в таблицу
+    broadcasts пишется последний user_id, поэтому прерванная рассылка продолжается с места остановки;
+    повторно может уйти только порция, прерванная посередине.
+    Рассылку ведет один процесс: он держит аренду (owner, lease_until) и продлевает ее перед
+    каждой порцией, заодно проверяя статус — отмена из другого процесса (бот или CLI)
+    останавливает рассылку не позже чем через порцию.
+    """
+
+    def __init__(self, db, send, log, chunk_size=200, concurrency=30, lease=300):
+        self.db = db
+        self.send = send
+        self.log = log
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.lease = lease
+        self.owner = f"{os.getpid()}-{secrets.token_hex(4)}"
+        # broadcast_id -> (задача, время запуска, отправлено на момент запуска)
+        self.running = {}
+
+    async def create(self, text):
+        """Заводит рассылку; total — число активных пользователей на момент создания"""
+        def write(conn):
+            total = conn.execute("SELECT COUNT(*) FROM user_settings WHERE is_active = 1").fetchone()[0]
+            now = time.time()
+            return conn.execute(
+                "INSERT INTO broadcasts (text, total, created_at, updated_at) VALUES (?, ?, ?, ?)",
+                (text, total, now, now)
+            ).lastrowid
+        return await asyncio.wrap_future(self.db.submit_write(write))
+
+    def start(self, broadcast_id):
+        """Запускает (или продолжает) рассылку фоновой задачей"""
+        entry = self.running.get(broadcast_id)
+        if entry and not entry[0].done():
+            return entry[0]
+        task = asyncio.create_task(self.run(broadcast_id))
+        self.running[broadcast_id] = (task, time.monotonic(), None)
+        return task
+
+    async def resume(self):
+        """Продолжает рассылки, прерванные остановкой бота (кроме тех, что ведет живой процесс)
+
+        Вызывается периодически: после падения процесса его аренда еще действует, и
+        рассылка подхватывается, когда аренда истечет.
+        """
+        rows = await self.db.fetchall(
+            "SELECT id FROM broadcasts WHERE status = 'running' AND (owner IS NULL OR lease_until < ?) ORDER BY id",
+            (time.time(),)
+        )
+        resumed = 0
+        for (broadcast_id,) in rows:
+            entry = self.running.get(broadcast_id)
+            if entry and entry[0] and not entry[0].done():
+                continue
+            self.log(f"📣 Продолжаем рассылку #{broadcast_id}")
+            self.start(broadcast_id)
+            resumed += 1
+        return resumed
+
+    async def renew(self, broadcast_id):
+        """Берет или продлевает аренду; False — рассылка не running или ее ведет другой процесс"""
+        now = time.time()
+        return await self.db.execute('''
+            UPDATE broadcasts SET owner = ?, lease_until = ?
+            WHERE id = ? AND status = 'running' AND (owner IS NULL OR owner = ? OR lease_until < ?)
+        ''', (self.owner, now + self.lease, broadcast_id, self.owner, now)) > 0
+
+    async def run(self, broadcast_id):
+        if not await self.renew(broadcast_id):
+            self.log(f"📣 Рассылка #{broadcast_id} не запущена: она не активна или идет в другом процессе")
+            return
+        text, last_id, sent, failed = await self.db.fetchone(
+            "SELECT text, last_user_id, sent, failed FROM broadcasts WHERE id = ?", (broadcast_id,)
+        )
+        task, started, _ = self.running.get(broadcast_id, (None, time.monotonic(), None))
+        self.running[broadcast_id] = (task, started, sent + failed)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def deliver(chat_id):
+            async with semaphore:
+                try:
+                    result = await self.send(chat_id, text)
+                    return bool(result and result.get('ok'))
+                except Exception as e:
+                    self.log(f"❌ Ошибка рассылки в чат {chat_id}: {e}", logging.DEBUG)
+                    return False
+
+        self.log(f"📣 Рассылка #{broadcast_id}: начинаем после user_id {last_id}")
+        while True:
+            rows = await self.db.fetchall('''
+                SELECT user_id, chat_id FROM user_settings
+                WHERE is_active = 1 AND user_id > ? ORDER BY user_id LIMIT ?
+            ''', (last_id, self.chunk_size))
+            if not rows:
+                break
+            
+            results = await asyncio.gather(*(deliver(chat_id) for _, chat_id in rows))
+            delivered = sum(results)
+            sent += delivered
+            failed += len(results) - delivered
+            last_id = rows[-1][0]
+            await self.db.execute(
+                "UPDATE broadcasts SET last_user_id = ?, sent = ?, failed = ?, updated_at = ? WHERE id = ?",
+                (last_id, sent, failed, time.time(), broadcast_id)
+            )
+            
+            if len(rows) < self.chunk_size:
+                break
+            if not await self.renew(broadcast_id):
+                self.running.pop(broadcast_id, None)
+                self.log(f"🛑 Рассылка #{broadcast_id} остановлена: отменена или перешла к другому процессу")
+                return
+        
+        await self.db.execute(
+            "UPDATE broadcasts SET status = 'done', owner = NULL, updated_at = ? WHERE id = ? AND status = 'running' AND owner = ?",
+            (time.time(), broadcast_id, self.owner)
+        )
+        self.log(f"✅ Рассылка #{broadcast_id} завершена: отправлено {sent}, ошибок {failed}")
+
+    def stop(self):
+        """Прерывает текущие рассылки; статус остается running, при следующем запуске они продолжатся"""
+        for task, _, _ in self.running.values():
+            task.cancel()
+        # Аренда отпускается сразу, чтобы другой процесс мог продолжить рассылку, не дожидаясь ее конца
+        owner = self.owner
+        self.db.submit_write(lambda conn: conn.execute(
+            "UPDATE broadcasts SET owner = NULL, lease_until = NULL WHERE owner = ?", (owner,)
+        ))
+
+    async def cancel(self, broadcast_id):
+        entry = self.running.pop(broadcast_id, None)
+        if entry:
+            entry[0].cancel()
+        return await self.db.execute(
+            "UPDATE broadcasts SET status = 'cancelled', owner = NULL, updated_at = ? WHERE id = ? AND status = 'running'",
+            (time.time(), broadcast_id)
+        )
+
+    async def progress(self, broadcast_id):
+        """Прогресс рассылки и скорость отправки в текущем запуске"""
+        row = await self.db.fetchone(
+            "SELECT status, total, sent, failed, last_user_id, created_at, updated_at FROM broadcasts WHERE id = ?",
+            (broadcast_id,)
+        )
+        if row is None:
+            return None
+        status, total, sent, failed, last_user_id, created_at, updated_at = row
+        result = {
+            'id': broadcast_id,
+            'status': status,
+            'total': total,
+            'sent': sent,
+            'failed': failed,
+            'last_user_id': last_user_id,
+            'created_at': created_at,
+            'updated_at': updated_at
+        }
+        entry = self.running.get(broadcast_id)
+        if entry and entry[2] is not None:
+            elapsed = time.monotonic() - entry[1]
+            result['per_second'] = round((sent + failed - entry[2]) / elapsed, 1) if elapsed > 0 else 0.0
+        return result
+
+class CatImagePool:
+    """Пул заранее полученных URL котиков: выдача за O(1), пополнение в фоне"""
+
+    def __init__(self, fetch, fallback_url, log, low_watermark=10, high_watermark=50, ttl=3600):
+        self.fetch = fetch
+        self.fallback_url = fallback_url
+        self.log = log
+        self.low_watermark = low_watermark
+        self.high_watermark = high_watermark
+        self.ttl = ttl
+        self.items = deque()
+        self.urls = set()
+        self.hits = 0
+        self.misses = 0
+        self.duplicates = 0
+        self.expired = 0
+        self.refill_needed = None
+        self.task = None
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self):
+        """Выдает котика из пула без сетевых запросов, при пустом пуле — фолбэк"""
+        now = time.time()
+        while self.items:
+            url, fetched_at = self.items.popleft()
+            self.urls.discard(url)
+            if now - fetched_at > self.ttl:
+                self.expired += 1
+                continue
+            self.hits += 1
+            if len(self.items) < self.low_watermark:
+                self._request_refill()
+            return url
+        
+        self.misses += 1
+        self._request_refill()
+        return self.fallback_url
+
+    def _request_refill(self):
+        if self.refill_needed:
+            self.refill_needed.set()
+
+    def _drop_expired(self):
+        now = time.time()
+        while self.items and now - self.items[0][1] > self.ttl:
+            url, _ = self.items.popleft()
+            self.urls.discard(url)
+            self.expired += 1
+
+    async def refill(self):
+        """Пополняет пул до верхней отметки"""
+        self._drop_expired()
+        failures = 0
+        while len(self.items) < self.high_watermark and failures < 5:
+            url = await self.fetch()
+            if not url:
+                failures += 1
+                continue
+            if url in self.urls:
+                self.duplicates += 1
+                failures += 1
+                continue
+            self.items.append((url, time.time()))
+            self.urls.add(url)
+        return failures < 5
+
+    async def run(self):
+        """Фоновое пополнение: по запросу с нижней отметки или раз в ttl/2"""
+        while True:
+            try:
+                if not await self.refill():
+                    self.log(f"⚠️ Не удалось пополнить пул котиков ({len(self.items)} в пуле)", logging.WARNING, key="cat_pool_refill")
+                    await asyncio.sleep(30)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.log(f"❌ Ошибка пополнения пула котиков: {e}", logging.ERROR)
+                await asyncio.sleep(30)
+            
+            try:
+                await asyncio.wait_for(self.refill_needed.wait(), self.ttl / 2)
+            except asyncio.TimeoutError:
+                pass
+            self.refill_needed.clear()
+
+    def start(self):
+        self.refill_needed = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def stats(self):
+        return {
+            'size': len(self.items),
+            'hits': self.hits,
+            'misses': self.misses,
+            'duplicates': self.duplicates,
+            'expired': self.expired
+        }
+
+def parse_cat_response(api_url, data):
+    """URL картинки из ответа cat API: TheCatAPI отдает список, Cataas — путь относительно хоста"""
+    if isinstance(data, list):
+        return data[0].get('url', '') if data else None
+    parts = urlsplit(api_url)
+    return f"{parts.scheme}://{parts.netloc}{data.get('url', '')}" if data.get('url') else None
+
+class CatProvider:
+    """Источник котиков со скользящей статистикой задержки и ошибок и предохранителем"""
+
+    def __init__(self, name, url, parse=parse_cat_response, window=50, failure_threshold=5, cooldown=30):
+        self.name = name
+        self.url = url
+        self.parse = parse
+        self.latency = LatencyStats(window)
+        self.outcomes = deque(maxlen=window)
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.trips = 0
+
+    def available(self, now):
+        # После паузы предохранитель пропускает пробный запрос (half-open)
+        return now >= self.open_until
+
+    def record(self, seconds, ok):
+        self.outcomes.append(ok)
+        if ok:
+            self.latency.observe(seconds)
+            self.consecutive_failures = 0
+            return
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.failure_threshold:
+            self.open_until = time.monotonic() + self.cooldown
+            self.consecutive_failures = self.failure_threshold - 1
+            self.trips += 1
+
+    def error_rate(self):
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def score(self):
+        """Чем меньше, тем раньше пробуем: медианная задержка со штрафом за ошибки; новый источник — первым"""
+        median = self.latency.percentile(0.5)
+        if median is None:
+            # Ни одного успешного ответа: без истории — пробуем первым, только ошибки — последним
+            return float("inf") if self.outcomes else 0.0
+        return median * (1 + 4 * self.error_rate())
+
+    def hedge_delay(self, quantile, default=0.5):
+        """Сколько ждать ответа, прежде чем параллельно спросить следующий источник"""
+        delay = self.latency.percentile(quantile)
+        return default if delay is None else min(max(delay, 0.05), 5.0)
+
+    def stats(self):
+        return {
+            'url': self.url,
+            'score': round(self.score(), 4) if self.score() != float("inf") else None,
+            'error_rate': round(self.error_rate(), 3),
+            'latency': self.latency.stats(),
+            'circuit_open': not self.available(time.monotonic()),
+            'trips': self.trips
+        }
+
+class CatProviderPool:
+    """Получение котика из нескольких источников: по рейтингу, с хеджированием медленного ответа
+
+    Первый источник по рейтингу спрашивается сразу; если он не ответил за свой p90 (CAT_HEDGE_QUANTILE)
+    или ответил ошибкой, параллельно спрашивается следующий. Побеждает первый успешный ответ, остальные
+    запросы отменяются. Новый источник — еще один URL в CAT_API_URLS или CatProvider со своим parse.
+    """
+
+    def __init__(self, providers, http, log, hedge_quantile=0.9, timeout=10):
+        self.providers = list(providers)
+        self.http = http
+        self.log = log
+        self.hedge_quantile = hedge_quantile
+        self.timeout = timeout
+        self.hedged = 0
+
+    def ranked(self):
+        now = time.monotonic()
+        return sorted((p for p in self.providers if p.available(now)), key=lambda p: p.score())
+
+    async def attempt(self, provider):
+        """Один запрос к источнику; проигранная гонка — не ошибка, но ее время идет в задержку как нижняя оценка"""
+        started = time.monotonic()
+        result = "error"
+        image_url = None
+        try:
+            self.log(f"🔄 Пробуем получить котика из {provider.url}", logging.DEBUG)
+            session = self.http.session_for(provider.url)
+            async with session.get(provider.url, timeout=aiohttp.ClientTimeout(total=self.timeout)) as response:
+                if response.status == 200:
+                    image_url = provider.parse(provider.url, await response.json())
+                    result = "ok" if image_url else "bad_response"
+                else:
+                    result = f"http_{response.status}"
+                    self.log(f"❌ API {provider.url} вернул статус {response.status}", logging.WARNING, key=f"cat_api:{provider.name}")
+        except asyncio.CancelledError:
+            # Иначе медленный источник, который всегда проигрывает, так и остался бы «без истории» в начале рейтинга
+            provider.latency.observe(time.monotonic() - started)
+            METRICS.inc("medbot_cat_api_requests_total", provider.name, "cancelled")
+            raise
+        except Exception as e:
+            self.log(f"❌ Ошибка получения котика из {provider.url}: {e}", logging.WARNING, key=f"cat_api:{provider.name}")
+        
+        elapsed = time.monotonic() - started
+        provider.record(elapsed, image_url is not None)
+        METRICS.observe("medbot_cat_api_request_seconds", elapsed, provider.name)
+        METRICS.inc("medbot_cat_api_requests_total", provider.name, result)
+        if image_url:
+            self.log(f"✅ Получен котик от {provider.name}", logging.DEBUG)
+        return image_url
+
+    async def fetch(self):
+        """URL котика от самого быстрого из ответивших источников или None"""
+        pending = set()
+        try:
+            for index, provider in enumerate(self.ranked()):
+                if index:
+                    self.hedged += 1
+                pending.add(asyncio.create_task(self.attempt(provider)))
+                deadline = time.monotonic() + provider.hedge_delay(self.hedge_quantile)
+                # Ждем до порога хеджирования; если все запущенные уже ответили ошибкой — сразу следующий
+                while pending:
+                    done, pending = await asyncio.wait(
+                        pending, timeout=max(0.0, deadline - time.monotonic()), return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for task in done:
+                        if task.result():
+                            return task.result()
+                    if not done:
+                        break
+            
+            # Все источники уже спрошены: ждем первый успешный ответ
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.result():
+                        return task.result()
+            return None
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self):
+        return {'hedged': self.hedged, 'providers': {p.name: p.stats() for p in self.providers}}
+
+class Database:
+    """SQLite в отдельном потоке: запросы не блокируют event loop, записи группируются в транзакции
+
+    Все обращения идут через одно соединение в потоке sqlite-worker. Подряд идущие записи
+    выполняются в одной транзакции (каждая в своем SAVEPOINT, чтобы ошибка одной не откатывала
+    остальные). Скомпилированные запросы переиспользуются через кэш statement'ов sqlite3,
+    поэтому SQL передается константными строками с параметрами.
+    """
+
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-16000",
+        "PRAGMA busy_timeout=5000"
+    )
+
+    def __init__(self, path, schema=(), migrations=(), batch_size=500):
+        self.path = path
+        self.schema = schema
+        self.migrations = migrations
+        self.batch_size = batch_size
+        self.jobs = queue.Queue()
+        self.batches = 0
+        self.batched_writes = 0
+        self.thread = threading.Thread(target=self._run, name="sqlite-worker", daemon=True)
+
+        ready = concurrent.futures.Future()
+        self.thread.start()
+        self.jobs.put(('read', self._init_schema, ready))
+        ready.result()
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            check_same_thread=False,
+            isolation_level=None,
+            cached_statements=256
+        )
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _init_schema(self, conn):
+        conn.execute("BEGIN")
+        for statement in self.schema:
+            conn.execute(statement)
+        
+        # Миграции применяются по порядку, номер последней хранится в PRAGMA user_version
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, statements in enumerate(self.migrations[version:], start=version + 1):
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {number}")
+        conn.execute("COMMIT")
+
+    def _run(self):
+        conn = self._connect()
+        next_job = None
+        while True:
+            job = next_job or self.jobs.get()
+            next_job = None
+            if job is None:
+                break
+
+            kind, fn, future = job
+            if kind == 'read':
+                self._resolve(future, fn, conn)
+                continue
+
+            # Собираем подряд идущие записи в одну транзакцию
+            batch = [job]
+            while len(batch) < self.batch_size:
+                try:
+                    queued = self.jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if queued is None or queued[0] != 'write':
+                    next_job = queued
+                    break
+                batch.append(queued)
+            self._write_batch(conn, batch)
+
+        conn.close()
+
+    def _write_batch(self, conn, batch):
+        results = []
+        started = time.monotonic()
+        try:
+            # IMMEDIATE сразу берет блокировку записи: с несколькими процессами это избегает SQLITE_BUSY посреди пачки
+            conn.execute("BEGIN IMMEDIATE")
+            for _, fn, future in batch:
+                conn.execute("SAVEPOINT job")
+                try:
+                    results.append((future, fn(conn), None))
+                    conn.execute("RELEASE job")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    conn.execute("RELEASE job")
+                    results.append((future, None, e))
+            conn.execute("COMMIT")
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            results = [(future, None, e) for _, _, future in batch]
+
+        METRICS.observe("medbot_db_query_seconds", time.monotonic() - started, "write_batch")
+        self.batches += 1
+        self.batched_writes += len(batch)
+        for future, result, error in results:
+            # Запись выполняется, даже если ожидавшую ее корутину отменили; результат тогда не нужен
+            if not future.set_running_or_notify_cancel():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def _resolve(self, future, fn, conn):
+        if not future.set_running_or_notify_cancel():
+            return
+        started = time.monotonic()
+        try:
+            result = fn(conn)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        METRICS.observe("medbot_db_query_seconds", time.monotonic() - started, "read")
+
+    def submit_read(self, fn):
+        """Ставит чтение fn(conn) в очередь, возвращает concurrent.futures.Future"""
+        future = concurrent.futures.Future()
+        self.jobs.put(('read', fn, future))
+        return future
+
+    def submit_write(self, fn):
+        """Ставит запись fn(conn) в очередь; она попадет в ближайшую пачку транзакции"""
+        future = concurrent.futures.Future()
+        self.jobs.put(('write', fn, future))
+        return future
+
+    async def fetchone(self, sql, params=()):
+        return await asyncio.wrap_future(self.submit_read(lambda conn: conn.execute(sql, params).fetchone()))
+
+    async def fetchall(self, sql, params=()):
+        return await asyncio.wrap_future(self.submit_read(lambda conn: conn.execute(sql, params).fetchall()))
+
+    async def execute(self, sql, params=()):
+        return await asyncio.wrap_future(self.submit_write(lambda conn: conn.execute(sql, params).rowcount))
+
+    async def executemany(self, sql, seq):
+        return await asyncio.wrap_future(self.submit_write(lambda conn: conn.executemany(sql, seq).rowcount))
+
+    def close(self):
+        """Дожидается выполнения очереди и закрывает соединение"""
+        if self.thread.is_alive():
+            self.jobs.put(None)
+            self.thread.join()
+
+    async def aclose(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    def stats(self):
+        return {
+            'queue': self.jobs.qsize(),
+            'write_batches': self.batches,
+            'batched_writes': self.batched_writes
+        }
+
+class UserSettings:
+    """Настройки одного пользователя (компактная запись без __dict__)"""
+
+    __slots__ = ('user_id', 'chat_id', 'is_active', 'reminder_minute', 'timezone')
+
+    def __init__(self, user_id, chat_id, is_active, reminder_minute, timezone):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.is_active = is_active
+        self.reminder_minute = reminder_minute
+        # Часовых поясов мало, поэтому строки интернируются и не дублируются
+        self.timezone = sys.intern(timezone)
+
+class UserSettingsStore:
+    """Настройки пользователей в памяти со сквозной записью в SQLite
+
+    Запись UserSettings (__slots__, 5 полей), chat_id и ячейка словаря занимают ~190 байт
+    на пользователя: на 100k пользователей ~19 МБ (см. `python bench.py memory`).
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.records = {}
+        self.loaded = False
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.records)
+
+    async def get(self, user_id):
+        record = self.records.get(user_id)
+        if record is not None or self.loaded:
+            # После полной загрузки отсутствие записи означает, что пользователя нет в БД
+            self.hits += 1
+            return record
+        
+        self.misses += 1
+        row = await self.db.fetchone(
+            "SELECT user_id, chat_id, is_active, reminder_minute, timezone FROM user_settings WHERE user_id = ?",
+            (user_id,)
+        )
+        if row is None:
+            return None
+        record = UserSettings(row[0], row[1], bool(row[2]), row[3], row[4])
+        self.records[user_id] = record
+        return record
+
+    async def save(self, user_id, chat_id, is_active, reminder_minute, timezone):
+        """Обновляет запись в памяти и сразу пишет ее в SQLite"""
+        self.records[user_id] = UserSettings(user_id, chat_id, bool(is_active), reminder_minute, timezone)
+        await self.db.execute('''
+            INSERT OR REPLACE INTO user_settings 
+            (user_id, chat_id, is_active, reminder_minute, timezone) 
+            VALUES (?, ?, ?, ?, ?)
+        ''', (user_id, chat_id, int(is_active), reminder_minute, timezone))
+
+    async def iter_chunks(self, shard_index=0, shards=1, chunk_size=2000):
+        """Загружает пользователей (своего шарда) в память порциями по user_id, отдает записи каждой порции"""
+        last_id = -(1 << 63)
+        while True:
+            rows = await self.db.fetchall('''
+                SELECT user_id, chat_id, is_active, reminder_minute, timezone FROM user_settings
+                WHERE user_id > ? AND user_id % ? = ? ORDER BY user_id LIMIT ?
+            ''', (last_id, shards, shard_index, chunk_size))
+            if not rows:
+                break
+            
+            chunk = []
+            for user_id, chat_id, is_active, reminder_minute, timezone in rows:
+                # Запись, уже попавшая в память во время загрузки, новее строки из выборки
+                record = self.records.get(user_id)
+                if record is None:
+                    record = self.records[user_id] = UserSettings(user_id, chat_id, bool(is_active), reminder_minute, timezone)
+                chunk.append(record)
+            last_id = rows[-1][0]
+            yield chunk
+            
+            if len(rows) < chunk_size:
+                break
+        self.loaded = True
+
+    def stats(self):
+        return {'users': len(self.records), 'loaded': self.loaded, 'hits': self.hits, 'misses': self.misses}
+
+class ScheduleStore:
+    """Приёмы лекарств: строка на дозу (время, дни недели, название) в таблице schedules
+
+    В памяти ничего не хранится: список приёмов читается из БД по запросу пользователя,
+    а наступившие дозы забирает DoseScheduler. next_due_minute — UTC-минута (timestamp // 60)
+    следующего срабатывания, NULL у выключенных. slot — номер дозы у пользователя (0..62),
+    ее бит в журнале приёма; номер удаленной дозы занимает следующая добавленная.
+    """
+
+    def __init__(self, db, max_per_user=MAX_DOSES_PER_USER):
+        self.db = db
+        self.max_per_user = max_per_user
+
+    @staticmethod
+    def next_due(local_minute, weekdays, timezone, after=None):
+        return int(next_fire_time(local_minute, timezone, after, weekdays) // 60)
+
+    async def list(self, user_id):
+        """[(id, минута, дни, название, next_due_minute)] в порядке времени приёма"""
+        return await self.db.fetchall('''
+            SELECT id, local_minute, weekdays, medication, next_due_minute FROM schedules
+            WHERE user_id = ? ORDER BY local_minute, id
+        ''', (user_id,))
+
+    async def summary(self, user_id):
+        """(число доз, ближайшая next_due_minute или None)"""
+        return await self.db.fetchone(
+            "SELECT COUNT(*), MIN(next_due_minute) FROM schedules WHERE user_id = ?", (user_id,)
+        )
+
+    async def add(self, user_id, chat_id, local_minute, weekdays, medication, timezone, active):
+        """Добавляет дозу; None, если у пользователя уже max_per_user доз"""
+        next_due = self.next_due(local_minute, weekdays, timezone) if active else None
+
+        def write(conn):
+            used = {row[0] for row in conn.execute("SELECT slot FROM schedules WHERE user_id = ?", (user_id,))}
+            if len(used) >= self.max_per_user:
+                return None
+            slot = min(set(range(len(used) + 1)) - used)
+            return conn.execute('''
+                INSERT INTO schedules (user_id, chat_id, medication, local_minute, weekdays, timezone, next_due_minute, slot)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (user_id, chat_id, medication, local_minute, weekdays, timezone, next_due, slot)).lastrowid
+
+        return await asyncio.wrap_future(self.db.submit_write(write))
+
+    async def remove(self, user_id, schedule_id):
+        return await self.db.execute("DELETE FROM schedules WHERE id = ? AND user_id = ?", (schedule_id, user_id))
+
+    async def set_primary_time(self, user_id, chat_id, local_minute, timezone, active):
+        """Меняет время первой (самой старой) дозы пользователя, а если доз нет — создает ее"""
+        def write(conn):
+            row = conn.execute(
+                "SELECT id, weekdays FROM schedules WHERE user_id = ? ORDER BY id LIMIT 1", (user_id,)
+            ).fetchone()
+            weekdays = row[1] if row else ALL_WEEKDAYS
+            next_due = self.next_due(local_minute, weekdays, timezone) if active else None
+            if row is None:
+                conn.execute('''
+                    INSERT INTO schedules (user_id, chat_id, local_minute, timezone, next_due_minute)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (user_id, chat_id, local_minute, timezone, next_due))
+            else:
+                conn.execute(
+                    "UPDATE schedules SET local_minute = ?, next_due_minute = ? WHERE id = ?",
+                    (local_minute, next_due, row[0])
+                )
+
+        await asyncio.wrap_future(self.db.submit_write(write))
+
+    async def activate(self, user_id, chat_id, timezone, default_minute):
+        """Включает все дозы пользователя (без доз — создает одну на default_minute); возвращает [(минута, дни)]"""
+        def write(conn):
+            rows = conn.execute(
+                "SELECT id, local_minute, weekdays FROM schedules WHERE user_id = ?", (user_id,)
+            ).fetchall()
+            if not rows:
+                conn.execute('''
+                    INSERT INTO schedules (user_id, chat_id, local_minute, timezone, next_due_minute)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (user_id, chat_id, default_minute, timezone, self.next_due(default_minute, ALL_WEEKDAYS, timezone)))
+                return [(default_minute, ALL_WEEKDAYS)]
+            conn.executemany(
+                "UPDATE schedules SET chat_id = ?, next_due_minute = ? WHERE id = ?",
+                [(chat_id, self.next_due(local_minute, weekdays, timezone), schedule_id)
+                 for schedule_id, local_minute, weekdays in rows]
+            )
+            return [(local_minute, weekdays) for _, local_minute, weekdays in rows]
+
+        return await asyncio.wrap_future(self.db.submit_write(write))
+
+    async def deactivate(self, user_id):
+        return await self.db.execute("UPDATE schedules SET next_due_minute = NULL WHERE user_id = ?", (user_id,))
+
+class AdherenceLog:
+    """Журнал приёма: строка (user_id, локальный день) с двумя битовыми масками доз
+
+    Бит дозы — ее schedules.slot. due_mask — дозы, напоминание о которых доставлено (пишет
+    ReminderOutbox.mark_sent), taken_mask — отмеченные кнопкой «✅ Принял». Кнопка несет маску
+    доз своего напоминания: дозы одной минуты приходят одним сообщением и отмечаются вместе,
+    дозы разного времени — каждая своей кнопкой. Строки только дополняются битами (OR), история не
+    переписывается. 90 дней пользователя — до 90 строк по ~20 байт в таблице WITHOUT ROWID,
+    читаются диапазоном по первичному ключу; выгрузка идет порциями по ключу (user_id, day).
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.acknowledged = 0
+
+    @staticmethod
+    def today(timezone):
+        return datetime.now(get_zone(timezone)).toordinal() - EPOCH_ORDINAL
+
+    async def acknowledge(self, user_id, day, mask):
+        """Отмечает дозы mask принятыми; False, если они уже отмечены
+
+        Бит due может еще не быть записан (кнопку нажали, пока досылается котик), поэтому
+        taken пишется независимо; в статистику идет только taken & due.
+        """
+        updated = await self.db.execute('''
+            INSERT INTO dose_log (user_id, day, taken_mask) VALUES (?, ?, ?)
+            ON CONFLICT (user_id, day) DO UPDATE SET taken_mask = taken_mask | excluded.taken_mask
+            WHERE taken_mask & excluded.taken_mask != excluded.taken_mask
+        ''', (user_id, day, mask))
+        self.acknowledged += updated
+        return updated > 0
+
+    async def is_taken(self, user_id, day, mask):
+        row = await self.db.fetchone(
+            "SELECT taken_mask & ? = ? FROM dose_log WHERE user_id = ? AND day = ?", (mask, mask, user_id, day)
+        )
+        return bool(row and row[0])
+
+    async def report(self, user_id, today):
+        """Отмечено/назначено за ADHERENCE_PERIODS дней, серия дней без пропусков и последняя неделя"""
+        rows = await self.db.fetchall(
+            "SELECT day, due_mask, taken_mask FROM dose_log WHERE user_id = ? AND day > ? ORDER BY day DESC",
+            (user_id, today - max(ADHERENCE_PERIODS))
+        )
+        periods = {days: [0, 0] for days in ADHERENCE_PERIODS}
+        by_day = {}
+        for day, due_mask, taken_mask in rows:
+            due, taken = due_mask.bit_count(), (taken_mask & due_mask).bit_count()
+            by_day[day] = taken == due if due else None
+            for days, totals in periods.items():
+                if day > today - days:
+                    totals[0] += taken
+                    totals[1] += due
+        
+        # Дни без доз серию не прерывают; сегодняшние пропуски еще можно отметить
+        streak = 0
+        for day in range(today, today - max(ADHERENCE_PERIODS), -1):
+            complete = by_day.get(day)
+            if complete:
+                streak += 1
+            elif complete is False and day != today:
+                break
+        return {
+            'periods': {days: tuple(totals) for days, totals in periods.items()},
+            'streak': streak,
+            'week': [
+                (datetime.fromordinal(day + EPOCH_ORDINAL).weekday(), by_day.get(day))
+                for day in range(today - 6, today + 1)
+            ]
+        }
+
+    async def export(self, days, timezone=DEFAULT_TIMEZONE, chunk_size=5000):
+        """CSV по пользователям за последние days дней, порциями bytes; в памяти одна порция строк
+
+        Дни в журнале — локальные дни пользователей; окно отсчитывается от сегодняшней даты
+        в timezone, как и в /stats (AdherenceLog.today).
+        """
+        first_day = self.today(timezone) - days + 1
+        last = (-(1 << 63), 0)
+        current = None
+        while True:
+            rows = await self.db.fetchall('''
+                SELECT user_id, day, due_mask, taken_mask FROM dose_log
+                WHERE (user_id, day) > (?, ?) AND day >= ? ORDER BY user_id, day LIMIT ?
+            ''', last + (first_day, chunk_size))
+            
+            lines = []
+            for user_id, day, due_mask, taken_mask in rows:
+                if current is None or current[0] != user_id:
+                    if current is not None:
+                        lines.append(self._csv_line(current))
+                    current = [user_id, 0, 0, 0]
+                due = due_mask.bit_count()
+                if due:
+                    current[1] += 1
+                    current[2] += due
+                    current[3] += (taken_mask & due_mask).bit_count()
+            
+            if len(rows) < chunk_size:
+                # Последний пользователь дописывается вместе с последней порцией
+                if current is not None:
+                    lines.append(self._csv_line(current))
+                if lines:
+                    yield "".join(lines).encode()
+                return
+            last = rows[-1][:2]
+            if lines:
+                yield "".join(lines).encode()
+
+    @staticmethod
+    def _csv_line(totals):
+        user_id, days, due, taken = totals
+        return f"{user_id},{days},{due},{taken},{round(taken * 100 / due, 1) if due else ''}\n"
+
+    def stats(self):
+        return {'acknowledged': self.acknowledged}
+
+class FileIdCache:
+    """LRU-кэш URL картинки -> Telegram file_id, сохраняемый в SQLite"""
+
+    def __init__(self, db, capacity=1000):
+        self.db = db
+        self.capacity = capacity
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+        rows = self.db.submit_read(lambda conn: conn.execute(
+            "SELECT url, file_id FROM photo_file_ids ORDER BY last_used DESC LIMIT ?",
+            (capacity,)
+        ).fetchall()).result()
+        for url, file_id in reversed(rows):
+            self.items[url] = file_id
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, url):
+        file_id = self.items.get(url)
+        if file_id is None:
+            self.misses += 1
+            return None
+        self.items.move_to_end(url)
+        self.hits += 1
+        return file_id
+
+    def put(self, url, file_id):
+        self.items[url] = file_id
+        self.items.move_to_end(url)
+        while len(self.items) > self.capacity:
+            self.items.popitem(last=False)
+
+        # Запись уходит в фоновую пачку транзакции, отправку фото не ждем
+        self.writes += 1
+        trim = self.writes % 100 == 0
+        capacity = self.capacity
+
+        def write(conn):
+            conn.execute(
+                "INSERT OR REPLACE INTO photo_file_ids (url, file_id, last_used) VALUES (?, ?, CURRENT_TIMESTAMP)",
+                (url, file_id)
+            )
+            if trim:
+                # Периодически подрезаем таблицу до размера кэша
+                conn.execute('''
+                    DELETE FROM photo_file_ids WHERE url NOT IN
+                    (SELECT url FROM photo_file_ids ORDER BY last_used DESC LIMIT ?)
+                ''', (capacity,))
+
+        self.db.submit_write(write)
+
+    def discard(self, url):
+        self.items.pop(url, None)
+        self.db.submit_write(lambda conn: conn.execute("DELETE FROM photo_file_ids WHERE url = ?", (url,)))
+
+    def stats(self):
+        return {'size': len(self.items), 'hits': self.hits, 'misses': self.misses}
+
+class ImageDiskCache:
+    """Локальный кэш картинок котиков на диске: индекс в SQLite, LRU с ограничением общего размера
+
+    Нужен на случай, когда источники котиков недоступны: тогда фото загружается в Telegram
+    из файла (multipart через mmap, без чтения файла в bytes) вместо ссылки текстом.
+    """
+
+    def __init__(self, db, directory, http, log, max_bytes=50 * 1024 * 1024, max_file_bytes=10 * 1024 * 1024, store_every=5):
+        self.db = db
+        self.directory = directory
+        self.http = http
+        self.log = log
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.store_every = store_every
+        # url -> (путь, размер, content-type), от давно использованных к недавним
+        self.items = OrderedDict()
+        self.total_bytes = 0
+        self.offered = 0
+        self.downloads = set()
+        self.stored = 0
+        self.evicted = 0
+        self.served = 0
+
+        os.makedirs(directory, exist_ok=True)
+        # В общей таблице у каждого каталога (процесса доставки) свои записи
+        self.path_pattern = os.path.join(directory, "%")
+        rows = self.db.submit_read(lambda conn: conn.execute(
+            "SELECT url, path, size, content_type FROM cat_images WHERE path LIKE ? ORDER BY last_used",
+            (self.path_pattern,)
+        ).fetchall()).result()
+        for url, path, size, content_type in rows:
+            if os.path.exists(path):
+                self.items[url] = (path, size, content_type)
+                self.total_bytes += size
+        
+        # Файлы, не попавшие в индекс (оборванная загрузка), и записи без файлов
+        known = {entry[0] for entry in self.items.values()}
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if path not in known and os.path.isfile(path):
+                os.remove(path)
+        if len(self.items) != len(rows):
+            missing = [(row[0],) for row in rows if row[0] not in self.items]
+            self.db.submit_write(lambda conn: conn.executemany("DELETE FROM cat_images WHERE url = ?", missing))
+        self._evict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def offer(self, url):
+        """Сохраняет в фоне каждую store_every-ю полученную картинку"""
+        self.offered += 1
+        if self.offered % self.store_every or url in self.items or len(self.downloads) >= 2:
+            return
+        task = asyncio.create_task(self.download(url))
+        self.downloads.add(task)
+        task.add_done_callback(self.downloads.discard)
+
+    async def download(self, url):
+        temp_path = os.path.join(self.directory, f".{secrets.token_hex(8)}.part")
+        size = 0
+        try:
+            session = self.http.session_for(url)
+            async with session.get(url, timeout=aiohttp.ClientTimeout(total=30)) as response:
+                if response.status != 200 or not response.content_type.startswith("image/"):
+                    return False
+                content_type = response.content_type
+                # Пишем потоком по 64 КБ: файл целиком в памяти не держим
+                with open(temp_path, "wb") as output:
+                    async for chunk in response.content.iter_chunked(64 * 1024):
+                        size += len(chunk)
+                        if size > self.max_file_bytes:
+                            return False
+                        output.write(chunk)
+            if not size:
+                return False
+            
+            extension = content_type.split("/", 1)[1].split("+", 1)[0]
+            path = os.path.join(self.directory, f"{hashlib.sha1(url.encode()).hexdigest()}.{extension}")
+            os.replace(temp_path, path)
+            self.add(url, path, size, content_type)
+            return True
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.log(f"❌ Не удалось сохранить котика в кэш: {e}", logging.WARNING, key="image_cache_download")
+            return False
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def add(self, url, path, size, content_type):
+        self.items[url] = (path, size, content_type)
+        self.total_bytes += size
+        self.stored += 1
+        self.db.submit_write(lambda conn: conn.execute(
+            "INSERT OR REPLACE INTO cat_images (url, path, size, content_type, last_used) VALUES (?, ?, ?, ?, ?)",
+            (url, path, size, content_type, time.time())
+        ))
+        self._evict()
+
+    def _evict(self):
+        evicted = []
+        while self.total_bytes > self.max_bytes and self.items:
+            url, (path, size, _) = self.items.popitem(last=False)
+            self.total_bytes -= size
+            evicted.append(url)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        if evicted:
+            self.evicted += len(evicted)
+            self.db.submit_write(lambda conn: conn.executemany(
+                "DELETE FROM cat_images WHERE url = ?", [(url,) for url in evicted]
+            ))
+
+    def pick(self):
+        """Следующая картинка по кругу (давно не использованная): (url, путь, размер, content-type) или None"""
+        if not self.items:
+            return None
+        url, entry = next(iter(self.items.items()))
+        self.items.move_to_end(url)
+        self.served += 1
+        self.db.submit_write(lambda conn: conn.execute(
+            "UPDATE cat_images SET last_used = ? WHERE url = ?", (time.time(), url)
+        ))
+        return (url,) + entry
+
+    def stats(self):
+        return {
+            'files': len(self.items),
+            'bytes': self.total_bytes,
+            'max_bytes': self.max_bytes,
+            'stored': self.stored,
+            'evicted': self.evicted,
+            'served': self.served
+        }
+
+class ProcessedUpdates:
+    """Недавно принятые update_id, чтобы обработчик не запускался дважды для одного апдейта
+
+    Telegram присылает апдейт повторно, если смещение не успели подтвердить (рестарт, повтор
+    webhook). В памяти — последние capacity id, в SQLite — они же для следующего запуска.
+    Апдейты отмечаются пачкой (все из одного ответа getUpdates — одним executemany), и только
+    отмеченные передаются обработчикам. В память id попадают после успешной записи: если
+    запись упала, повтор того же апдейта не считается дубликатом.
+    """
+
+    def __init__(self, db, capacity=10000):
+        self.db = db
+        self.capacity = capacity
+        rows = self.db.submit_read(lambda conn: conn.execute(
+            "SELECT update_id FROM processed_updates ORDER BY update_id DESC LIMIT ?", (capacity,)
+        ).fetchall()).result()
+        self.order = deque(sorted(row[0] for row in rows))
+        self.ids = set(self.order)
+        # id, запись которых еще идет: параллельный claim того же апдейта (повтор webhook) — дубликат
+        self.pending = set()
+        self.claimed = 0
+        self.duplicates = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    async def claim(self, update_ids):
+        """Отмечает новые update_id и возвращает их множество; уже виденные отбрасываются"""
+        fresh = set()
+        for update_id in update_ids:
+            if update_id in self.ids or update_id in self.pending or update_id in fresh:
+                self.duplicates += 1
+                continue
+            fresh.add(update_id)
+        if not fresh:
+            return fresh
+        
+        self.pending |= fresh
+        try:
+            await asyncio.wrap_future(self.db.submit_write(lambda conn: conn.executemany(
+                "INSERT OR IGNORE INTO processed_updates (update_id) VALUES (?)", [(update_id,) for update_id in fresh]
+            )))
+        finally:
+            self.pending -= fresh
+        
+        for update_id in sorted(fresh):
+            self.ids.add(update_id)
+            self.order.append(update_id)
+            if len(self.order) > self.capacity:
+                self.ids.discard(self.order.popleft())
+        previous, self.claimed = self.claimed, self.claimed + len(fresh)
+        if previous // 1000 != self.claimed // 1000:
+            # Таблица держится примерно того же размера, что и множество в памяти
+            oldest = self.order[0]
+            self.db.submit_write(lambda conn: conn.execute(
+                "DELETE FROM processed_updates WHERE update_id < ?", (oldest,)
+            ))
+        return fresh
+
+    async def forget(self, update_ids):
+        """Снимает отметку с апдейтов, которые так и не попали к обработчикам (их пришлют повторно)"""
+        for update_id in update_ids:
+            if update_id in self.ids:
+                self.ids.discard(update_id)
+                self.order.remove(update_id)
+        await self.db.executemany(
+            "DELETE FROM processed_updates WHERE update_id = ?", [(update_id,) for update_id in update_ids]
+        )
+
+    def stats(self):
+        return {'tracked': len(self.ids), 'claimed': self.claimed, 'duplicates': self.duplicates}
+
+class UpdateWorkerPool:
+    """Обработка апдейтов пулом воркеров: параллельно между чатами, по порядку внутри чата"""
+
+    def __init__(self, handler, log, workers=16, queue_size=100):
+        self.handler = handler
+        self.log = log
+        self.workers = workers
+        self.queue_size = queue_size
+        self.queues = []
+        self.tasks = []
+        self.latency = LatencyStats()
+        self.max_depth = 0
+
+    def start(self):
+        # Каждый чат закреплен за одной очередью, поэтому его сообщения обрабатываются по порядку
+        self.queues = [asyncio.Queue(maxsize=self.queue_size) for _ in range(self.workers)]
+        self.tasks = [asyncio.create_task(self.worker(queue)) for queue in self.queues]
+
+    async def submit(self, chat_id, update):
+        """Ставит апдейт в очередь чата; при заполненной очереди ждет (backpressure)"""
+        queue = self.queues[hash(chat_id) % self.workers]
+        await queue.put((time.monotonic(), update))
+        self.max_depth = max(self.max_depth, self.queue_depth())
+
+    async def worker(self, queue):
+        while True:
+            received_at, update = await queue.get()
+            try:
+                await self.handler(update)
+            except Exception as e:
+                self.log(f"💥 Ошибка обработки апдейта: {e}", logging.ERROR)
+            finally:
+                # Задержка от постановки в очередь до конца обработки
+                self.latency.observe(time.monotonic() - received_at)
+                queue.task_done()
+
+    def queue_depth(self):
+        return sum(queue.qsize() for queue in self.queues)
+
+    async def stop(self, timeout=10):
+        """Дожидается обработки уже принятых апдейтов и останавливает воркеров"""
+        if self.queues:
+            try:
+                await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self.queues)), timeout)
+            except asyncio.TimeoutError:
+                self.log(f"⚠️ Не дождались обработки {self.queue_depth()} апдейтов", logging.WARNING)
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue_depth(),
+            'max_queue_depth': self.max_depth,
+            'handler_latency': self.latency.stats()
+        }
 
 class MedicationReminderBot:
-    def __init__(self, token):
+    # Типы апдейтов для getUpdates и webhook: сообщения и нажатия inline-кнопок
+    ALLOWED_UPDATES = ["message", "callback_query"]
+
+    def __init__(self, token, shard_index=0, shards=None):
         self.token = token
-        self.base_url = f"https://api.telegram.org/bot{token}"
+        # Адреса источников котиков можно подменить (например, на локальную заглушку из loadtest.py)
+        self.cat_api_urls = [
+            url.strip() for url in os.environ.get(
+                "CAT_API_URLS", "https://api.thecatapi.com/v1/images/search,https://cataas.com/cat?json=true"
+            ).split(",") if url.strip()
+        ]
         self.last_update_id = 0
-        self.reminder_tasks = {}
+        self.loop = None
+        
+        # Доставка напоминаний может быть разнесена по нескольким процессам (шардам по user_id).
+        # Процесс 0 — основной: он же получает апдейты и обслуживает HTTP
+        self.shards = shards or max(1, int(os.environ.get("DELIVERY_WORKERS", 1)))
+        self.shard_index = shard_index
+        self.worker_processes = {}
+        self.worker_queues = {}
+        self.worker_metrics_queues = {}
+        self.worker_metrics = {}
+        
+        # Режим webhook включается переменной WEBHOOK_URL, иначе используется polling
+        self.webhook_url = os.environ.get("WEBHOOK_URL", "").rstrip("/")
+        self.webhook_secret = os.environ.get("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
         self.is_running = True
         
+        # Лимиты Telegram: ~30 сообщений/сек на бота (делится между процессами) и 1 сообщение/сек на чат
+        self.rate_limiter = RateLimiter(
+            global_rate=float(os.environ.get("TG_GLOBAL_RATE", 30)) / self.shards,
+            chat_rate=float(os.environ.get("TG_CHAT_RATE", 1))
+        )
+        self.dispatcher = ReminderDispatcher(
+            self.deliver_job,
+            self.log,
+            concurrency=int(os.environ.get("REMINDER_CONCURRENCY", 100))
+        )
+        
+        # Апдейты обрабатываются параллельно, но по порядку внутри каждого чата
+        self.update_workers = UpdateWorkerPool(
+            self.handle_update,
+            self.log,
+            workers=int(os.environ.get("UPDATE_WORKERS", 16)),
+            queue_size=int(os.environ.get("UPDATE_QUEUE_SIZE", 100))
+        )
+        
+        # Пул котиков пополняется в фоне, чтобы не ходить в cat API на каждое напоминание
+        self.cat_pool = CatImagePool(
+            self.fetch_cat_image,
+            "https://cataas.com/cat",
+            self.log,
+            low_watermark=int(os.environ.get("CAT_POOL_LOW", 10)),
+            high_watermark=int(os.environ.get("CAT_POOL_HIGH", 50)),
+            ttl=int(os.environ.get("CAT_POOL_TTL", 3600))
+        )
+        
+        # Один пул соединений на все время жизни бота
+        self.http = HttpClientPool(
+            self.create_ssl_context(),
+            limit_per_host=int(os.environ.get("HTTP_POOL_LIMIT_PER_HOST", 100)),
+            dns_ttl=int(os.environ.get("HTTP_DNS_CACHE_TTL", 300))
+        )
+        self.telegram = TelegramClient(token, self.http, self.rate_limiter, self.log)
+        self.base_url = self.telegram.base_url
+        
+        # Источники котиков с рейтингом, предохранителем и хеджированием медленных ответов
+        self.cat_providers = CatProviderPool(
+            self.create_cat_providers(),
+            self.http,
+            self.log,
+            hedge_quantile=float(os.environ.get("CAT_HEDGE_QUANTILE", 0.9))
+        )
+        
         # Инициализация базы данных с абсолютным путем для Railway
         self.db_path = os.path.join(os.getcwd(), 'reminder_bot.db')
         self.init_database()
         
+        self.settings = UserSettingsStore(self.db)
+        
+        # Смещение getUpdates переживает рестарт, а повторно присланные апдейты отбрасываются
+        self.processed_updates = ProcessedUpdates(self.db, capacity=int(os.environ.get("PROCESSED_UPDATES_KEEP", 10000)))
+        self.saved_update_id = 0
+        
+        # Каждое срабатывание сначала пишется в журнал, чтобы пережить рестарт
+        self.outbox = ReminderOutbox(
+            self.db,
+            max_attempts=int(os.environ.get("REMINDER_MAX_ATTEMPTS", 5)),
+            base_delay=int(os.environ.get("REMINDER_RETRY_DELAY", 30)),
+            shard_index=self.shard_index,
+            shards=self.shards
+        )
+        self.missed_grace = int(os.environ.get("MISSED_REMINDER_GRACE_MINUTES", 60)) * 60
+        self.outbox_batch = int(os.environ.get("OUTBOX_BATCH_SIZE", 1000))
+        self.outbox_wakeup = asyncio.Event()
+        
+        # Приёмы лекарств: наступившие дозы раз в минуту забираются из БД запросом по индексу
+        self.schedules = ScheduleStore(self.db)
+        self.scheduler = DoseScheduler(
+            self.db,
+            self.outbox_wakeup.set,
+            self.log,
+            grace=self.missed_grace,
+            batch_size=int(os.environ.get("SCHEDULER_BATCH_SIZE", 5000)),
+            shard_index=self.shard_index,
+            shards=self.shards
+        )
+        
+        # Отметки «✅ Принял»; неотмеченная доза получает до NUDGE_MAX повторов через NUDGE_AFTER_MINUTES
+        self.adherence = AdherenceLog(self.db)
+        self.nudge_after = int(os.environ.get("NUDGE_AFTER_MINUTES", 30)) * 60
+        self.nudge_max = int(os.environ.get("NUDGE_MAX", 1))
+        
+        # Рассылки администратора (только в основном процессе)
+        self.broadcasts = Broadcaster(
+            self.db,
+            self.send_message,
+            self.log,
+            chunk_size=int(os.environ.get("BROADCAST_CHUNK_SIZE", 200)),
+            lease=int(os.environ.get("BROADCAST_LEASE_SECONDS", 300))
+        )
+        self.delivery_tasks = set()
+        self.outbox_task = None
+        self.supervisor_task = None
+        self.warmup_task = None
+        self.restore_chunk_size = int(os.environ.get("RESTORE_CHUNK_SIZE", 2000))
+        self.shutdown_drain_seconds = float(os.environ.get("SHUTDOWN_DRAIN_SECONDS", 10))
+        
+        # Команды из текста сообщения: один поиск в словаре вместо цепочки сравнений
+        self.commands = {
+            "/start": self.cmd_help,
+            "ℹ️ Помощь": self.cmd_help,
+            "✅ Включить напоминания": self.cmd_enable,
+            "❌ Выключить напоминания": self.cmd_disable,
+            "⚙️ Настроить время": self.cmd_time_menu,
+            "Назад": self.cmd_back,
+            "📊 Статус": self.cmd_status,
+            "💊 Мои приёмы": self.cmd_doses,
+            "🐱 Получить котика сейчас": self.cmd_cat
+        }
+        for label, minute in TIME_CHOICES.items():
+            self.commands[label] = functools.partial(self.cmd_set_time, reminder_minute=minute)
+        # Команды с аргументами: "/add 08:30 Витамин D" ищется по первому слову
+        self.command_prefixes = {
+            "/add": self.cmd_add,
+            "/remove": self.cmd_remove,
+            "/stats": self.cmd_stats
+        }
+        # Нажатия inline-кнопок: callback_data "ack:<минута>:<маска доз>" ищется по префиксу до двоеточия
+        self.callbacks = {
+            "ack": self.cb_ack
+        }
+        
+        # После первой загрузки фото Telegram отдает file_id — дальше шлем его вместо URL
+        self.file_ids = FileIdCache(self.db, capacity=int(os.environ.get("FILE_ID_CACHE_SIZE", 1000)))
+        self.photo_uploads = {}
+        
+        # Котики на диске — на случай, когда источники недоступны
+        image_cache_dir = os.environ.get("IMAGE_CACHE_DIR", os.path.join(os.getcwd(), "cat_cache"))
+        if self.shards > 1:
+            image_cache_dir = os.path.join(image_cache_dir, f"shard-{self.shard_index}")
+        self.image_cache = ImageDiskCache(
+            self.db,
+            image_cache_dir,
+            self.http,
+            self.log,
+            max_bytes=int(float(os.environ.get("IMAGE_CACHE_MAX_MB", 50)) * 1024 * 1024),
+            store_every=int(os.environ.get("IMAGE_CACHE_EVERY", 5))
+        )
+        
+        # Текущие значения для /metrics
+        METRICS.gauge("medbot_scheduled_users", "Пользователей с включенными приёмами (пересчитывается на каждом тике)", lambda: self.scheduler.scheduled_users)
+        METRICS.gauge("medbot_scheduler_tick_seconds", "Длительность последнего тика планировщика доз", lambda: self.scheduler.last_tick_seconds)
+        METRICS.gauge("medbot_update_queue_depth", "Апдейтов в очередях обработчиков", self.update_workers.queue_depth)
+        METRICS.gauge("medbot_db_queue_depth", "Операций в очереди потока SQLite", self.db.jobs.qsize)
+        METRICS.gauge("medbot_cat_pool_size", "Котиков в пуле", lambda: len(self.cat_pool))
+        METRICS.gauge("medbot_image_cache_bytes", "Размер локального кэша котиков на диске", lambda: self.image_cache.total_bytes)
+        
     def init_database(self):
         """Создает базу данных для хранения настроек пользователей"""
-        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
-        cursor = self.conn.cursor()
+        self.db = self.open_database(self.db_path)
+        self.log(f"✅ База данных инициализирована: {self.db_path}")
+    
+    @staticmethod
+    def open_database(path):
+        """Открывает БД бота со схемой и миграциями (нужно и CLI рассылки)"""
+        schema = []
         
-        cursor.execute('''
+        schema.append('''
             CREATE TABLE IF NOT EXISTS user_settings (
                 user_id INTEGER PRIMARY KEY,
                 chat_id INTEGER,
@@ -58,47 +2632,166 @@ class MedicationReminderBot:
             )
         ''')
         
-        self.conn.commit()
-        print(f"✅ База данных инициализирована: {self.db_path}")
+        schema.append('''
+            CREATE TABLE IF NOT EXISTS photo_file_ids (
+                url TEXT PRIMARY KEY,
+                file_id TEXT NOT NULL,
+                last_used TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        migrations = [
+            # 1: время как минуты от полуночи + IANA часовой пояс вместо строки "19:00 (22:00 ваше)".
+            # Старая колонка reminder_time больше не используется
+            (
+                "ALTER TABLE user_settings ADD COLUMN reminder_minute INTEGER NOT NULL DEFAULT 1320",
+                "ALTER TABLE user_settings ADD COLUMN timezone TEXT NOT NULL DEFAULT 'Europe/Moscow'",
+                '''
+                UPDATE user_settings SET reminder_minute =
+                    (CAST(substr(reminder_time, 1, 2) AS INTEGER) * 60
+                     + CAST(substr(reminder_time, 4, 2) AS INTEGER) + 180) % 1440
+                WHERE reminder_time GLOB '[0-2][0-9]:[0-5][0-9]*'
+                '''
+            ),
+            # 2: журнал напоминаний (outbox) и служебное состояние бота
+            (
+                '''
+                CREATE TABLE IF NOT EXISTS reminder_outbox (
+                    id INTEGER PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    chat_id INTEGER NOT NULL,
+                    due_at INTEGER NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at INTEGER NOT NULL,
+                    sent_at INTEGER,
+                    last_error TEXT,
+                    UNIQUE (user_id, due_at)
+                )
+                ''',
+                "CREATE INDEX IF NOT EXISTS idx_outbox_pending ON reminder_outbox (status, next_attempt_at)",
+                "CREATE INDEX IF NOT EXISTS idx_outbox_due ON reminder_outbox (due_at)",
+                '''
+                CREATE TABLE IF NOT EXISTS bot_state (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                )
+                '''
+            ),
+            # 3: индекс локального кэша картинок котиков
+            (
+                '''
+                CREATE TABLE IF NOT EXISTS cat_images (
+                    url TEXT PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    content_type TEXT NOT NULL,
+                    last_used REAL NOT NULL
+                )
+                ''',
+                "CREATE INDEX IF NOT EXISTS idx_cat_images_last_used ON cat_images (last_used)"
+            ),
+            # 4: рассылки всем активным пользователям с прогрессом для продолжения после рестарта
+            (
+                '''
+                CREATE TABLE IF NOT EXISTS broadcasts (
+                    id INTEGER PRIMARY KEY,
+                    text TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'running',
+                    total INTEGER NOT NULL DEFAULT 0,
+                    sent INTEGER NOT NULL DEFAULT 0,
+                    failed INTEGER NOT NULL DEFAULT 0,
+                    last_user_id INTEGER NOT NULL DEFAULT -9223372036854775808,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                ''',
+            ),
+            # 5: недавно обработанные апдейты (защита от повторной обработки после рестарта)
+            (
+                "CREATE TABLE IF NOT EXISTS processed_updates (update_id INTEGER PRIMARY KEY) WITHOUT ROWID",
+            ),
+            # 6: приёмы лекарств — несколько доз на пользователя. Текущее время каждого пользователя
+            # становится его первой дозой; -1 в next_due_minute — "посчитать на первом тике без отправки".
+            # payload в журнале — названия лекарств для текста напоминания
+            (
+                '''
+                CREATE TABLE IF NOT EXISTS schedules (
+                    id INTEGER PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    chat_id INTEGER,
+                    medication TEXT NOT NULL DEFAULT '',
+                    local_minute INTEGER NOT NULL,
+                    weekdays INTEGER NOT NULL DEFAULT 127 CHECK (weekdays BETWEEN 1 AND 127),
+                    timezone TEXT NOT NULL,
+                    next_due_minute INTEGER,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+                ''',
+                "CREATE INDEX IF NOT EXISTS idx_schedules_user ON schedules (user_id)",
+                "CREATE INDEX IF NOT EXISTS idx_schedules_due ON schedules (next_due_minute, user_id) WHERE next_due_minute IS NOT NULL",
+                '''
+                INSERT INTO schedules (user_id, chat_id, local_minute, timezone, next_due_minute)
+                SELECT user_id, chat_id, reminder_minute, timezone, CASE WHEN is_active THEN -1 END FROM user_settings
+                ''',
+                "ALTER TABLE reminder_outbox ADD COLUMN payload TEXT",
+            ),
+            # 7: журнал приёма (битовые маски назначенных и отмеченных доз по дням) и
+            # stage в журнале напоминаний — номер повторного напоминания о неотмеченной дозе
+            (
+                '''
+                CREATE TABLE IF NOT EXISTS dose_log (
+                    user_id INTEGER NOT NULL,
+                    day INTEGER NOT NULL,
+                    due_mask INTEGER NOT NULL DEFAULT 0,
+                    taken_mask INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (user_id, day)
+                ) WITHOUT ROWID
+                ''',
+                "ALTER TABLE reminder_outbox ADD COLUMN stage INTEGER NOT NULL DEFAULT 0",
+            ),
+            # 8: аренда рассылки — процесс, который ее ведет, и срок, до которого она за ним
+            (
+                "ALTER TABLE broadcasts ADD COLUMN owner TEXT",
+                "ALTER TABLE broadcasts ADD COLUMN lease_until REAL",
+            ),
+            # 9: у каждой дозы свой номер (бит в журнале приёма); задание журнала напоминаний
+            # несет маску своих доз. Старые задания (slots = 0) уходят без кнопки «✅ Принял»
+            (
+                "ALTER TABLE schedules ADD COLUMN slot INTEGER NOT NULL DEFAULT 0",
+                '''
+                UPDATE schedules SET slot = (
+                    SELECT COUNT(*) FROM schedules AS earlier
+                    WHERE earlier.user_id = schedules.user_id AND earlier.id < schedules.id
+                )
+                ''',
+                "CREATE UNIQUE INDEX IF NOT EXISTS idx_schedules_slot ON schedules (user_id, slot)",
+                "ALTER TABLE reminder_outbox ADD COLUMN slots INTEGER NOT NULL DEFAULT 0",
+            ),
+        ]
+        
+        # Все запросы к SQLite выполняются в отдельном потоке, вне event loop
+        return Database(path, schema, migrations)
     
-    def log(self, message):
-        """Улучшенное логирование с timestamp"""
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        print(f"[{timestamp}] {message}")
+    @staticmethod
+    def log(message, level=logging.INFO, key=None):
+        """Кладет запись в очередь логов; key включает ограничение частоты для повторяющихся строк"""
+        if logger.isEnabledFor(level):
+            # makeRecord напрямую: без поиска вызывающего кадра, который делает logger.log
+            logger.handle(logger.makeRecord(logger.name, level, "", 0, message, None, None,
+                                            extra={'key': key} if key else None))
     
-    def create_ssl_context(self):
+    @staticmethod
+    def create_ssl_context():
         """Создает SSL контекст для Railway"""
         ssl_context = ssl.create_default_context()
         ssl_context.check_hostname = False
         ssl_context.verify_mode = ssl.CERT_NONE
         return ssl_context
     
-    async def make_request(self, method, data=None):
-        """Оптимизированный запрос к Telegram API"""
-        url = f"{self.base_url}/{method}"
-        
-        try:
-            ssl_context = self.create_ssl_context()
-            connector = aiohttp.TCPConnector(ssl=ssl_context)
-            
-            async with aiohttp.ClientSession(connector=connector) as session:
-                if data:
-                    # Для отправки фото используем form-data
-                    if 'photo' in data and data['photo'].startswith('http'):
-                        form_data = aiohttp.FormData()
-                        for key, value in data.items():
-                            form_data.add_field(key, value)
-                        async with session.post(url, data=form_data, timeout=30) as response:
-                            return await response.json()
-                    else:
-                        async with session.post(url, json=data, timeout=30) as response:
-                            return await response.json()
-                else:
-                    async with session.get(url, timeout=30) as response:
-                        return await response.json()
-        except Exception as e:
-            self.log(f"❌ Ошибка запроса: {e}")
-            return None
+    async def make_request(self, method, data=None, retries=3, files=None, body=None, chat_id=None):
+        """Запрос к Telegram API через общий клиент (см. TelegramClient.make_request)"""
+        return await self.telegram.make_request(method, data, retries, files, body, chat_id)
     
     async def send_message(self, chat_id, text, reply_markup=None):
         """Отправляет сообщение пользователю"""
@@ -113,238 +2806,318 @@ class MedicationReminderBot:
             
         return await self.make_request("sendMessage", data)
     
+    async def send_reply(self, chat_id, tail):
+        """Отправляет заранее закодированный ответ из REPLIES"""
+        return await self.make_request("sendMessage", body=REPLIES.body(chat_id, tail), chat_id=chat_id)
+    
+    async def _upload_photo(self, chat_id, photo_url, caption):
+        """Загружает фото по URL и запоминает полученный file_id"""
+        data = {
+            "chat_id": chat_id,
+            "photo": photo_url,
+            "caption": caption
+        }
+        result = await self.make_request("sendPhoto", data)
+        
+        if result and result.get('ok') and photo_url != self.cat_pool.fallback_url:
+            # Берем самый крупный размер фото из ответа
+            photos = result['result'].get('photo') or []
+            if photos:
+                self.file_ids.put(photo_url, photos[-1]['file_id'])
+        return result
+    
     async def send_photo(self, chat_id, photo_url, caption=""):
-        """Отправляет фото по URL с улучшенной обработкой ошибок"""
+        """Отправляет фото, по возможности по закэшированному file_id"""
         try:
-            data = {
-                "chat_id": chat_id,
-                "photo": photo_url,
-                "caption": caption
-            }
-            result = await self.make_request("sendPhoto", data)
+            # Если это же фото сейчас загружается для другого чата — дожидаемся его file_id
+            upload = self.photo_uploads.get(photo_url)
+            if upload:
+                await asyncio.shield(upload)
+            
+            result = None
+            if photo_url == self.cat_pool.fallback_url and len(self.image_cache):
+                # Пул пуст — значит, источники сейчас не отвечают; котик с диска надежнее фолбэк-ссылки
+                result = await self.send_cached_photo(chat_id, caption)
+                if result and result.get('ok'):
+                    self.log(f"✅ Фото из локального кэша отправлено пользователю {chat_id}", logging.DEBUG)
+                    return True
+                result = None
+            
+            file_id = self.file_ids.get(photo_url)
+            if file_id:
+                data = {
+                    "chat_id": chat_id,
+                    "photo": file_id,
+                    "caption": caption
+                }
+                result = await self.make_request("sendPhoto", data)
+                if not (result and result.get('ok')):
+                    # file_id больше не принимается — забываем его и шлем по URL
+                    self.file_ids.discard(photo_url)
+                    result = None
+            
+            if result is None:
+                upload = asyncio.ensure_future(self._upload_photo(chat_id, photo_url, caption))
+                self.photo_uploads[photo_url] = upload
+                try:
+                    result = await upload
+                finally:
+                    if self.photo_uploads.get(photo_url) is upload:
+                        del self.photo_uploads[photo_url]
             
             if result and result.get('ok'):
-                self.log(f"✅ Фото отправлено пользователю {chat_id}")
+                self.log(f"✅ Фото отправлено пользователю {chat_id}", logging.DEBUG)
                 return True
-            else:
-                self.log(f"❌ Ошибка отправки фото: {result}")
-                # Фолбэк - отправляем сообщение с ссылкой
-                fallback_msg = f"{caption}\n\n📸 Ссылка на котика: {photo_url}"
-                await self.send_message(chat_id, fallback_msg)
-                return False
+            
+            self.log(f"❌ Ошибка отправки фото: {result}", logging.ERROR, key="send_photo_error")
+            # Фолбэк — котик из локального кэша, и только если кэш пуст — ссылка текстом
+            cached = await self.send_cached_photo(chat_id, caption)
+            if cached and cached.get('ok'):
+                return True
+            fallback_msg = f"{caption}\n\n📸 Ссылка на котика: {photo_url}"
+            await self.send_message(chat_id, fallback_msg)
+            return False
                 
         except Exception as e:
-            self.log(f"❌ Ошибка в send_photo: {e}")
+            self.log(f"❌ Ошибка в send_photo: {e}", logging.ERROR)
             fallback_msg = f"{caption}\n\n📸 Ссылка на котика: {photo_url}"
             await self.send_message(chat_id, fallback_msg)
             return False
     
+    async def send_cached_photo(self, chat_id, caption):
+        """Отправляет котика из локального кэша: по file_id, если он уже загружался, иначе файлом"""
+        entry = self.image_cache.pick()
+        if entry is None:
+            return None
+        url, path, size, content_type = entry
+        
+        file_id = self.file_ids.get(url)
+        if file_id:
+            result = await self.make_request("sendPhoto", {"chat_id": chat_id, "photo": file_id, "caption": caption})
+            if result and result.get('ok'):
+                return result
+            self.file_ids.discard(url)
+        
+        try:
+            with open(path, "rb") as source:
+                mapped = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            self.log(f"❌ Не удалось открыть котика из кэша: {e}", logging.ERROR)
+            return None
+        
+        # Страницы файла читает ядро при отправке в сокет; копии файла в bytes нет
+        view = memoryview(mapped)
+        try:
+            result = await self.make_request(
+                "sendPhoto",
+                {"chat_id": chat_id, "caption": caption},
+                files={"photo": (os.path.basename(path), view, content_type)}
+            )
+        finally:
+            view.release()
+            try:
+                mapped.close()
+            except BufferError:
+                # Срез буфера еще держит HTTP-клиент — файл закроется вместе с ним
+                pass
+        
+        if result and result.get('ok'):
+            photos = result['result'].get('photo') or []
+            if photos:
+                self.file_ids.put(url, photos[-1]['file_id'])
+        return result
+    
     async def get_updates(self):
         """Получает обновления от Telegram с улучшенным таймаутом"""
-        url = f"{self.base_url}/getUpdates?offset={self.last_update_id + 1}&timeout=25"
+        url = f"{self.base_url}/getUpdates?offset={self.last_update_id + 1}&timeout=25&allowed_updates={quote(json.dumps(self.ALLOWED_UPDATES))}"
         
         try:
-            ssl_context = self.create_ssl_context()
-            connector = aiohttp.TCPConnector(ssl=ssl_context)
-            
-            async with aiohttp.ClientSession(connector=connector) as session:
-                async with session.get(url, timeout=30) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        return result.get("result", [])
-                    else:
-                        self.log(f"❌ Статус ответа: {response.status}")
-                        return []
+            session = self.http.session_for(url)
+            async with session.get(url, timeout=aiohttp.ClientTimeout(total=30)) as response:
+                if response.status == 200:
+                    result = await response.json()
+                    return result.get("result", [])
+                else:
+                    self.log(f"❌ Статус ответа: {response.status}", logging.ERROR, key="get_updates_status")
+                    return []
         except asyncio.TimeoutError:
-            self.log("⏰ Таймаут получения обновлений")
+            self.log("⏰ Таймаут получения обновлений", logging.WARNING, key="get_updates_timeout")
             return []
         except Exception as e:
-            self.log(f"❌ Ошибка получения обновлений: {e}")
+            self.log(f"❌ Ошибка получения обновлений: {e}", logging.ERROR, key="get_updates_error")
             return []
     
-    def get_user_settings(self, user_id):
-        """Получает настройки пользователя"""
-        cursor = self.conn.cursor()
-        cursor.execute(
-            "SELECT * FROM user_settings WHERE user_id = ?", 
-            (user_id,)
-        )
-        result = cursor.fetchone()
-        
-        if result:
-            return {
-                'user_id': result[0],
-                'chat_id': result[1],
-                'is_active': bool(result[2]),
-                'reminder_time': result[3]
-            }
-        return None
+    async def get_user_settings(self, user_id):
+        """Получает настройки пользователя из кэша в памяти"""
+        return await self.settings.get(user_id)
     
-    def save_user_settings(self, user_id, chat_id, is_active=True, reminder_time="19:00 (22:00 ваше)"):
-        """Сохраняет настройки пользователя"""
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            INSERT OR REPLACE INTO user_settings 
-            (user_id, chat_id, is_active, reminder_time) 
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, chat_id, int(is_active), reminder_time))
+    async def save_user_settings(self, user_id, chat_id, is_active=True,
+                                 reminder_minute=DEFAULT_REMINDER_MINUTE, timezone=DEFAULT_TIMEZONE):
+        """Сохраняет настройки пользователя (в памяти и в SQLite)"""
+        await self.settings.save(user_id, chat_id, is_active, reminder_minute, timezone)
+        if not self.owns(user_id):
+            # Процессу доставки нужна свежая запись, чтобы проверять is_active при отправке
+            self.forward_to_shard(user_id, ('settings', user_id, chat_id, bool(is_active), reminder_minute, timezone))
         
-        self.conn.commit()
         self.log(f"💾 Сохранены настройки для пользователя {user_id}")
     
     async def get_random_cat_image(self):
-        """Получает случайное фото котика с улучшенной обработкой ошибок"""
-        cat_apis = [
-            "https://api.thecatapi.com/v1/images/search",
-            "https://cataas.com/cat?json=true"
-        ]
-        
-        for api_url in cat_apis:
-            try:
-                self.log(f"🔄 Пробуем получить котика из {api_url}")
-                ssl_context = self.create_ssl_context()
-                connector = aiohttp.TCPConnector(ssl=ssl_context)
-                
-                async with aiohttp.ClientSession(connector=connector) as session:
-                    async with session.get(api_url, timeout=10) as response:
-                        if response.status == 200:
-                            data = await response.json()
-                            
-                            if "thecatapi.com" in api_url:
-                                image_url = data[0].get('url', '')
-                                self.log(f"✅ Получен котик от TheCatAPI")
-                                return image_url
-                            elif "cataas.com" in api_url:
-                                image_url = f"https://cataas.com{data.get('url', '')}"
-                                self.log(f"✅ Получен котик от Cataas")
-                                return image_url
-                        else:
-                            self.log(f"❌ API {api_url} вернул статус {response.status}")
-                            
-            except Exception as e:
-                self.log(f"❌ Ошибка получения котика из {api_url}: {e}")
-                continue
-        
-        # Фолбэк - статичная картинка
-        fallback_url = "https://cataas.com/cat"
-        self.log(f"🔄 Используем фолбэк котика")
-        return fallback_url
+        """Выдает случайного котика из заранее заполненного пула"""
+        return self.cat_pool.get()
     
-    def create_main_keyboard(self):
-        """Создает основную клавиатуру"""
-        return {
-            "keyboard": [
-                ["✅ Включить напоминания", "❌ Выключить напоминания"],
-                ["⚙️ Настроить время", "📊 Статус"],
-                ["🐱 Получить котика сейчас", "ℹ️ Помощь"]
-            ],
-            "resize_keyboard": True,
-            "one_time_keyboard": False
-        }
+    async def fetch_cat_image(self):
+        """Получает случайное фото котика из cat API (источник пополнения пула)"""
+        url = await self.cat_providers.fetch()
+        if url:
+            self.image_cache.offer(url)
+        return url
     
-    def create_time_keyboard(self):
-        """Создает клавиатуру для выбора времени с учетом разницы +3 часа"""
-        times = [
-            ["19:00 (22:00 ваше)", "20:00 (23:00 ваше)"],
-            ["18:00 (21:00 ваше)", "17:00 (20:00 ваше)"],
-            ["16:00 (19:00 ваше)", "15:00 (18:00 ваше)"],
-            ["Назад"]
-        ]
-        
-        return {
-            "keyboard": times,
-            "resize_keyboard": True,
-            "one_time_keyboard": True
-        }
+    def create_cat_providers(self):
+        """Источники котиков из CAT_API_URLS; имя — хост, а при нескольких URL на одном хосте — хост с путем"""
+        hosts = [urlsplit(url).netloc for url in self.cat_api_urls]
+        providers = []
+        for url, host in zip(self.cat_api_urls, hosts):
+            name = host if hosts.count(host) == 1 else host + urlsplit(url).path
+            providers.append(CatProvider(name, url))
+        return providers
     
-    async def send_reminder(self, user_id, chat_id):
-        """Отправляет напоминание с котиком"""
+    async def send_reminder(self, user_id, chat_id, cat_url=None, medication=None, ack=None):
+        """Отправляет напоминание с котиком (и названиями лекарств, если они указаны)"""
         try:
-            # Получаем случайного котика
-            cat_url = await self.get_random_cat_image()
-            
-            # Отправляем напоминание
-            message = (
-                "⏰ <b>Время выпить таблетки!</b> 💊\n\n"
-                "Не забудьте принять лекарство! 🏥\n"
-                "А чтобы поднять настроение - вот вам котик! 🐱"
-            )
+            # Получаем случайного котика, если он не выбран заранее для всего слота
+            if cat_url is None:
+                cat_url = await self.get_random_cat_image()
             
-            await self.send_message(chat_id, message)
+            # Отправляем напоминание; ack из журнала добавляет кнопку «✅ Принял»
+            result = await self.send_reply(chat_id, REPLIES.reminder_for(medication, ack))
             await self.send_photo(chat_id, cat_url, "😻 Держите вашего терапевтического котика!")
             
-            self.log(f"📨 Отправлено напоминание пользователю {user_id}")
+            self.log(f"📨 Отправлено напоминание пользователю {user_id}", logging.DEBUG)
+            return bool(result and result.get('ok'))
             
         except Exception as e:
-            self.log(f"❌ Ошибка отправки напоминания: {e}")
+            self.log(f"❌ Ошибка отправки напоминания: {e}", logging.ERROR)
+            return False
     
-    async def start_reminder_for_user(self, user_id, chat_id, reminder_time="19:00 (22:00 ваше)"):
-        """Запускает ежедневное напоминание для пользователя"""
-        if user_id in self.reminder_tasks:
-            self.reminder_tasks[user_id].cancel()
-        
-        async def daily_reminder():
-            while self.is_running:
-                try:
-                    # Текущее время на сервере (UTC+3)
-                    now = datetime.now()
-                    
-                    # Извлекаем только время из текста (например "19:00" из "19:00 (22:00 ваше)")
-                    server_time_str = reminder_time.split(' ')[0]
-                    target_time = datetime.strptime(server_time_str, "%H:%M").time()
-                    
-                    # Вычисляем время до следующего напоминания
-                    target_datetime = datetime.combine(now.date(), target_time)
-                    if now.time() > target_time:
-                        target_datetime += timedelta(days=1)
-                    
-                    wait_seconds = (target_datetime - now).total_seconds()
-                    
-                    # Вычисляем пользовательское время для логов
-                    server_time = datetime.strptime(server_time_str, "%H:%M")
-                    user_time = server_time + timedelta(hours=3)
-                    user_time_str = user_time.strftime("%H:%M")
-                    
-                    self.log(f"⏰ Пользователь {user_id}: ждем {wait_seconds:.0f} сек до {server_time_str} (сервер) = {user_time_str} (ваше время)")
-                    
-                    # Ждем до времени напоминания с проверкой running
-                    wait_intervals = max(1, int(wait_seconds / 60))
-                    for _ in range(wait_intervals):
-                        if not self.is_running:
-                            return
-                        await asyncio.sleep(60)
-                    
-                    # Проверяем, что напоминание все еще активно
-                    settings = self.get_user_settings(user_id)
-                    if settings and settings['is_active'] and self.is_running:
-                        await self.send_reminder(user_id, chat_id)
-                    
-                    # Короткая пауза перед следующим циклом
-                    await asyncio.sleep(10)
-                    
-                except asyncio.CancelledError:
-                    self.log(f"🛑 Напоминание отменено для пользователя {user_id}")
-                    break
-                except Exception as e:
-                    self.log(f"❌ Ошибка в напоминании: {e}")
-                    await asyncio.sleep(3600)  # Ждем час при ошибке
-        
-        task = asyncio.create_task(daily_reminder())
-        self.reminder_tasks[user_id] = task
+    async def send_nudge(self, user_id, chat_id, medication=None, ack=None):
+        """Повторное напоминание о неотмеченной дозе — без котика"""
+        result = await self.send_reply(chat_id, REPLIES.nudge_for(medication, ack))
+        self.log(f"🔔 Повторное напоминание пользователю {user_id}", logging.DEBUG)
+        return bool(result and result.get('ok'))
+    
+    async def dispatch_jobs(self, slot_ts, jobs):
+        """Раздает задания журнала [(job_id, user_id, chat_id, payload, stage, slots)] через лимитер: один котик на порцию ради file_id
+
+        Повторные напоминания (stage > 0) идут без котика и не учитываются в статистике слотов.
+        """
+        reminders = [job for job in jobs if not job[4]]
+        nudges = [job for job in jobs if job[4]]
+        if reminders:
+            cat_url = await self.get_random_cat_image()
+            await self.dispatcher.dispatch_slot(slot_ts, reminders, cat_url, slot_ts)
+        if nudges:
+            await self.dispatcher.dispatch_slot(slot_ts, nudges, None, slot_ts, record=False)
+    
+    async def deliver_job(self, job_id, user_id, chat_id, payload=None, stage=0, slots=0, cat_url=None, due_at=None):
+        """Отправляет одно задание журнала и отмечает результат; stage > 0 — повторное напоминание"""
+        if not await self.outbox.renew(job_id):
+            # Пока задание ждало лимитера, аренда истекла и его взял другой процесс
+            METRICS.inc("medbot_nudges_total" if stage else "medbot_reminders_total", "lease_lost")
+            return True
+        try:
+            sent = await self.fire_reminder(user_id, chat_id, cat_url, payload, due_at, stage, slots)
+            error = None if sent is not False else "send failed"
+        except Exception as e:
+            sent, error = False, str(e)
         
-        # Вычисляем пользовательское время для лога
-        server_time = datetime.strptime(reminder_time.split(' ')[0], "%H:%M")
-        user_time = server_time + timedelta(hours=3)
-        user_time_str = user_time.strftime("%H:%M")
+        if sent:
+            dose = nudge_at = None
+            if due_at is not None and slots:
+                # Доза считается назначенной, только когда напоминание о ней доставлено
+                settings = await self.settings.get(user_id)
+                dose = (user_id, dose_day(due_at // 60, settings.timezone if settings else DEFAULT_TIMEZONE), slots)
+                # Задание остается в журнале до следующего повтора; отметка дозы его снимет
+                if stage < self.nudge_max:
+                    nudge_at = int(time.time()) + self.nudge_after
+            if due_at is not None and not stage:
+                METRICS.observe("medbot_reminder_lateness_seconds", time.time() - due_at)
+            self.outbox.mark_sent(job_id, nudge_at, dose)
+        elif sent is None:
+            self.outbox.mark_sent(job_id)
+        else:
+            self.outbox.mark_failed(job_id, error)
+        METRICS.inc("medbot_nudges_total" if stage else "medbot_reminders_total",
+                    "sent" if sent else "skipped" if sent is None else "failed")
+        return sent is not False
+    
+    def spawn_delivery(self, coro):
+        task = asyncio.create_task(coro)
+        self.delivery_tasks.add(task)
+        task.add_done_callback(self.delivery_tasks.discard)
+        return task
+    
+    async def run_outbox(self, interval=15, in_flight=2, resume_interval=60):
+        """Цикл журнала: раздает задания порциями (новые от планировщика и повторы с backoff), чистит старые
         
-        self.log(f"✅ Запущено напоминание для {user_id} в {user_time_str} (по вашему времени)")
+        Следующая порция берется, только когда раздается меньше in_flight порций: большой слот
+        ждет в SQLite, а не в памяти, и доставка идет со скоростью лимитера. REMINDER_CONCURRENCY
+        действует на порцию, то есть одновременных отправок до in_flight * REMINDER_CONCURRENCY.
+        Основной процесс раз в resume_interval подхватывает рассылки, аренда которых истекла.
+        """
+        pruned_at = resumed_at = time.monotonic()
+        while self.is_running:
+            self.outbox_wakeup.clear()
+            try:
+                while len(self.delivery_tasks) >= in_flight:
+                    await asyncio.wait(list(self.delivery_tasks), return_when=asyncio.FIRST_COMPLETED)
+                
+                slots = await self.outbox.claim_due(limit=self.outbox_batch)
+                for due_at, jobs in slots.items():
+                    self.spawn_delivery(self.dispatch_jobs(due_at, jobs))
+                
+                if time.monotonic() - pruned_at > 3600:
+                    pruned_at = time.monotonic()
+                    await self.outbox.prune()
+                if self.shard_index == 0 and time.monotonic() - resumed_at > resume_interval:
+                    resumed_at = time.monotonic()
+                    await self.broadcasts.resume()
+                if slots:
+                    continue
+            except Exception as e:
+                self.log(f"❌ Ошибка в цикле журнала напоминаний: {e}", logging.ERROR)
+            
+            # Новые задания будят цикл сразу, повторы подхватываются не позже чем через interval
+            try:
+                await asyncio.wait_for(self.outbox_wakeup.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def start_broadcast(self, text):
+        """Создает и запускает рассылку, возвращает ее id"""
+        broadcast_id = await self.broadcasts.create(text)
+        self.broadcasts.start(broadcast_id)
+        self.log(f"📣 Рассылка #{broadcast_id} запущена")
+        return broadcast_id
     
-    async def stop_reminder_for_user(self, user_id):
-        """Останавливает напоминание для пользователя"""
-        if user_id in self.reminder_tasks:
-            self.reminder_tasks[user_id].cancel()
-            del self.reminder_tasks[user_id]
-            self.log(f"🛑 Остановлено напоминание для пользователя {user_id}")
+    async def fire_reminder(self, user_id, chat_id, cat_url=None, medication=None, due_at=None, stage=0, slots=0):
+        """Отправляет напоминание из журнала, если пользователь не выключил напоминания после записи задания
+
+        True — отправлено, False — ошибка отправки, None — отправлять не нужно (напоминания
+        выключены или доза, о которой повторное напоминание, уже отмечена).
+        """
+        # После загрузки кэша — без похода в БД на каждое задание; пока кэш грузится, промах
+        # читает строку из SQLite. Процессы доставки получают изменения через управляющую очередь
+        settings = await self.settings.get(user_id)
+        if not ((settings is None or settings.is_active) and self.is_running):
+            return None
+        # Кнопка «✅ Принял» — только у заданий с известными дозами
+        ack = (due_at // 60, slots) if due_at is not None and slots else None
+        if stage:
+            timezone = settings.timezone if settings else DEFAULT_TIMEZONE
+            if ack and await self.adherence.is_taken(user_id, dose_day(due_at // 60, timezone), slots):
+                return None
+            return await self.send_nudge(user_id, chat_id, medication, ack)
+        return await self.send_reminder(user_id, chat_id, cat_url, medication, ack)
     
     async def process_message(self, message):
         """Обрабатывает входящие сообщения"""
@@ -355,121 +3128,390 @@ class MedicationReminderBot:
         self.log(f"📨 Сообщение от {user_id}: {text}")
         
         # Получаем или создаем настройки пользователя
-        settings = self.get_user_settings(user_id)
+        settings = await self.get_user_settings(user_id)
         if not settings:
-            self.save_user_settings(user_id, chat_id)
-            settings = self.get_user_settings(user_id)
-        
-        if text == "/start" or text == "ℹ️ Помощь":
-            response = (
-                "🐱 <b>Бот-напоминалка с котиками</b> 💊\n\n"
-                "Я буду напоминать вам выпить таблетки каждый день в указанное время "
-                "и радовать фотографиями котиков! 😻\n\n"
-                "<b>Внимание:</b> Сервер находится в UTC+3, время автоматически корректируется.\n\n"
-                "<b>Команды:</b>\n"
-                "✅ Включить напоминания - запустить ежедневные напоминания\n"
-                "❌ Выключить напоминания - остановить напоминания\n"
-                "⚙️ Настроить время - изменить время напоминания\n"
-                "📊 Статус - посмотреть текущие настройки\n"
-                "🐱 Получить котика сейчас - мгновенная доза котикотерапии\n\n"
-                "Для начала нажмите «✅ Включить напоминания»!"
-            )
-            await self.send_message(chat_id, response, self.create_main_keyboard())
-            
-        elif text == "✅ Включить напоминания":
-            self.save_user_settings(user_id, chat_id, is_active=True)
-            await self.start_reminder_for_user(user_id, chat_id, settings['reminder_time'])
-            
-            # Вычисляем пользовательское время для отображения
-            server_time = datetime.strptime(settings['reminder_time'].split(' ')[0], "%H:%M")
-            user_time = server_time + timedelta(hours=3)
-            user_time_str = user_time.strftime("%H:%M")
-            
-            response = (
-                f"✅ <b>Напоминания включены!</b>\n\n"
-                f"Я буду напоминать вам каждый день в <b>{user_time_str}</b> (по вашему времени)\n"
-                f"Не забудьте выпить таблетки! 💊"
-            )
-            await self.send_message(chat_id, response, self.create_main_keyboard())
-            
-        elif text == "❌ Выключить напоминания":
-            self.save_user_settings(user_id, chat_id, is_active=False)
-            await self.stop_reminder_for_user(user_id)
-            
-            response = "❌ <b>Напоминания выключены</b>\nВы всегда можете включить их снова!"
-            await self.send_message(chat_id, response, self.create_main_keyboard())
-            
-        elif text == "⚙️ Настроить время":
-            response = "🕐 Выберите время для ежедневного напоминания (указано ваше местное время):"
-            await self.send_message(chat_id, response, self.create_time_keyboard())
-            
-        elif text in ["19:00 (22:00 ваше)", "20:00 (23:00 ваше)", "18:00 (21:00 ваше)", "17:00 (20:00 ваше)", "16:00 (19:00 ваше)", "15:00 (18:00 ваше)"]:
-            self.save_user_settings(user_id, chat_id, reminder_time=text)
-            
-            # Перезапускаем напоминание с новым временем
-            if settings['is_active']:
-                await self.start_reminder_for_user(user_id, chat_id, text)
-            
-            # Извлекаем пользовательское время для отображения
-            user_time_str = text.split(' ')[1].strip('()')
-            response = f"🕐 <b>Время установлено!</b>\nНапоминания будут в <b>{user_time_str}</b> (по вашему времени)"
-            await self.send_message(chat_id, response, self.create_main_keyboard())
-            
-        elif text == "Назад":
-            await self.send_message(chat_id, "Возвращаемся в главное меню:", self.create_main_keyboard())
-            
-        elif text == "📊 Статус":
-            status = "🟢 ВКЛЮЧЕНЫ" if settings['is_active'] else "🔴 ВЫКЛЮЧЕНЫ"
-            
-            # Вычисляем пользовательское время для отображения
-            server_time = datetime.strptime(settings['reminder_time'].split(' ')[0], "%H:%M")
-            user_time = server_time + timedelta(hours=3)
-            user_time_str = user_time.strftime("%H:%M")
-            
-            response = (
-                f"📊 <b>Текущие настройки:</b>\n\n"
-                f"• Напоминания: <b>{status}</b>\n"
-                f"• Время: <b>{user_time_str}</b> (по вашему времени)\n"
-                f"• Следующее напоминание: <b>сегодня в {user_time_str}</b>"
-            )
-            await self.send_message(chat_id, response, self.create_main_keyboard())
-            
-        elif text == "🐱 Получить котика сейчас":
-            try:
-                await self.send_message(chat_id, "🔄 Ищу котика для вас...")
-                cat_url = await self.get_random_cat_image()
-                self.log(f"🐱 Отправка котика пользователю {user_id}")
-                success = await self.send_photo(chat_id, cat_url, "😻 Ваш внеочередной котик!")
-                if not success:
-                    await self.send_message(chat_id, "❌ Не удалось загрузить изображение котика, но вот ссылка выше!")
-            except Exception as e:
-                self.log(f"❌ Ошибка получения котика: {e}")
-                await self.send_message(chat_id, "❌ Не удалось получить котика, попробуйте позже")
-                
+            await self.save_user_settings(user_id, chat_id)
+            settings = await self.get_user_settings(user_id)
+        
+        handler = self.commands.get(text)
+        if handler is None:
+            command, _, args = text.partition(" ")
+            prefix_handler = self.command_prefixes.get(command)
+            if prefix_handler is not None:
+                await prefix_handler(user_id, chat_id, settings, args.strip())
+                return
+            handler = self.cmd_unknown
+        await handler(user_id, chat_id, settings)
+    
+    async def cmd_help(self, user_id, chat_id, settings):
+        await self.send_reply(chat_id, REPLIES.help)
+    
+    async def cmd_enable(self, user_id, chat_id, settings):
+        await self.save_user_settings(user_id, chat_id, True, settings.reminder_minute, settings.timezone)
+        doses = await self.schedules.activate(user_id, chat_id, settings.timezone, settings.reminder_minute)
+        self.log(f"✅ Запущены напоминания для {user_id}: приёмов {len(doses)}")
+        if len(doses) == 1 and doses[0][1] == ALL_WEEKDAYS:
+            await self.send_reply(chat_id, REPLIES.enabled(doses[0][0]))
         else:
-            response = "🤔 Не понимаю команду. Используйте кнопки ниже или /start для помощи"
-            await self.send_message(chat_id, response, self.create_main_keyboard())
+            await self.send_reply(chat_id, REPLIES.enabled_many(len(doses)))
+    
+    async def cmd_disable(self, user_id, chat_id, settings):
+        await self.save_user_settings(user_id, chat_id, False, settings.reminder_minute, settings.timezone)
+        await self.schedules.deactivate(user_id)
+        self.log(f"🛑 Остановлено напоминание для пользователя {user_id}")
+        await self.send_reply(chat_id, REPLIES.disabled)
+    
+    async def cmd_time_menu(self, user_id, chat_id, settings):
+        await self.send_reply(chat_id, REPLIES.time_menu)
     
-    async def restore_reminders(self):
-        """Восстанавливает напоминания при запуске бота"""
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT user_id, chat_id, reminder_time FROM user_settings WHERE is_active = 1")
+    async def cmd_set_time(self, user_id, chat_id, settings, reminder_minute):
+        await self.save_user_settings(user_id, chat_id, settings.is_active, reminder_minute, settings.timezone)
+        
+        # Кнопки времени меняют первую дозу; остальные настраиваются через /add и /remove
+        await self.schedules.set_primary_time(user_id, chat_id, reminder_minute, settings.timezone, settings.is_active)
+        await self.send_reply(chat_id, REPLIES.time_set(reminder_minute))
+    
+    async def cmd_back(self, user_id, chat_id, settings):
+        await self.send_reply(chat_id, REPLIES.back)
+    
+    async def cmd_status(self, user_id, chat_id, settings):
+        doses, next_due = await self.schedules.summary(user_id)
+        day = minute = None
+        if settings.is_active and next_due is not None and next_due >= 0:
+            # День следующего напоминания считаем в часовом поясе пользователя
+            zone = get_zone(settings.timezone)
+            next_fire = datetime.fromtimestamp(next_due * 60, zone)
+            days = (next_fire.date() - datetime.now(zone).date()).days
+            day = "сегодня" if days == 0 else "завтра" if days == 1 else WEEKDAY_NAMES[next_fire.weekday()]
+            minute = next_fire.hour * 60 + next_fire.minute
+        await self.send_reply(chat_id, REPLIES.status(settings.is_active, doses, day, minute))
+    
+    async def cmd_doses(self, user_id, chat_id, settings):
+        rows = await self.schedules.list(user_id)
+        await self.send_reply(chat_id, REPLIES.doses(rows, settings.is_active))
+    
+    async def cmd_add(self, user_id, chat_id, settings, args):
+        """/add ЧЧ:ММ [дни] [название]"""
+        time_token, _, rest = args.partition(" ")
+        local_minute = parse_local_minute(time_token)
+        days_token, _, tail = rest.strip().partition(" ")
+        weekdays = parse_weekdays(days_token) if days_token else None
+        if weekdays:
+            rest = tail
+        medication = " ".join(rest.split())
+        if local_minute is None or weekdays == 0 or len(medication) > MAX_MEDICATION_LENGTH:
+            await self.send_reply(chat_id, REPLIES.add_usage)
+            return
+        
+        schedule_id = await self.schedules.add(
+            user_id, chat_id, local_minute, weekdays or ALL_WEEKDAYS, medication, settings.timezone, settings.is_active
+        )
+        if schedule_id is None:
+            await self.send_reply(chat_id, REPLIES.too_many_doses)
+            return
+        self.log(f"💊 Пользователь {user_id} добавил приём в {MINUTE_LABELS[local_minute]}")
+        rows = await self.schedules.list(user_id)
+        await self.send_reply(chat_id, REPLIES.doses(rows, settings.is_active, "✅ <b>Приём добавлен!</b> Ваши приёмы:"))
+    
+    async def cmd_remove(self, user_id, chat_id, settings, args):
+        """/remove N — номер из списка «💊 Мои приёмы»"""
+        rows = await self.schedules.list(user_id)
+        number = int(args) if args.isascii() and args.isdigit() else 0
+        if not 1 <= number <= len(rows):
+            await self.send_reply(chat_id, REPLIES.remove_usage)
+            return
+        
+        await self.schedules.remove(user_id, rows[number - 1][0])
+        self.log(f"🗑 Пользователь {user_id} удалил приём в {MINUTE_LABELS[rows[number - 1][1]]}")
+        rows = await self.schedules.list(user_id)
+        await self.send_reply(chat_id, REPLIES.doses(rows, settings.is_active, "🗑 <b>Приём удален.</b> Ваши приёмы:"))
+    
+    async def cmd_stats(self, user_id, chat_id, settings, args):
+        """/stats — отмеченные приёмы за 7, 30 и 90 дней в часовом поясе пользователя"""
+        report = await self.adherence.report(user_id, AdherenceLog.today(settings.timezone))
+        await self.send_reply(chat_id, REPLIES.adherence(report))
+    
+    async def process_callback(self, query):
+        """Обрабатывает нажатие inline-кнопки и отвечает всплывающим уведомлением"""
+        user_id = query["from"]["id"]
+        message = query.get("message") or {}
+        prefix, _, argument = query.get("data", "").partition(":")
+        handler = self.callbacks.get(prefix)
+        text = None
+        if handler is not None and message:
+            text = await handler(user_id, message, argument)
+        # Ответ обязателен, иначе у кнопки крутится индикатор загрузки
+        answer = {"callback_query_id": query["id"]}
+        if text:
+            answer["text"] = text
+        await self.make_request("answerCallbackQuery", answer)
+    
+    async def cb_ack(self, user_id, message, argument):
+        """«✅ Принял»: отмечает дозу в журнале приёма, снимает повтор и убирает кнопку"""
+        due_text, _, slots_text = argument.partition(":")
+        if not all(part.isascii() and part.isdigit() for part in (due_text, slots_text)):
+            return None
+        due_minute, slots = int(due_text), int(slots_text)
+        settings = await self.get_user_settings(user_id)
+        if settings is None or not 0 < slots < 1 << 63:
+            return None
         
-        active_users = cursor.fetchall()
+        chat_id = message["chat"]["id"]
+        if not await self.adherence.acknowledge(user_id, dose_day(due_minute, settings.timezone), slots):
+            return "Этот приём уже отмечен"
+        METRICS.inc("medbot_doses_acknowledged_total")
+        self.outbox.cancel_nudges(user_id, due_minute * 60)
+        self.log(f"✅ Пользователь {user_id} отметил приём", logging.DEBUG)
+        await self.make_request("editMessageReplyMarkup", {
+            "chat_id": chat_id,
+            "message_id": message["message_id"],
+            "reply_markup": {"inline_keyboard": []}
+        })
+        return "✅ Отмечено! Так держать 💪"
+    
+    async def cmd_cat(self, user_id, chat_id, settings):
+        try:
+            await self.send_reply(chat_id, REPLIES.searching)
+            cat_url = await self.get_random_cat_image()
+            self.log(f"🐱 Отправка котика пользователю {user_id}")
+            success = await self.send_photo(chat_id, cat_url, "😻 Ваш внеочередной котик!")
+            if not success:
+                await self.send_reply(chat_id, REPLIES.cat_link_only)
+        except Exception as e:
+            self.log(f"❌ Ошибка получения котика: {e}", logging.ERROR)
+            await self.send_reply(chat_id, REPLIES.cat_failed)
+    
+    async def cmd_unknown(self, user_id, chat_id, settings):
+        await self.send_reply(chat_id, REPLIES.unknown)
+    
+    async def handle_update(self, update):
+        """Обрабатывает один апдейт Telegram"""
+        if "message" in update:
+            started = time.monotonic()
+            await self.process_message(update["message"])
+            METRICS.observe("medbot_message_processing_seconds", time.monotonic() - started)
+        elif "callback_query" in update:
+            await self.process_callback(update["callback_query"])
+    
+    async def enqueue_update(self, update):
+        """Передает апдейт в пул обработчиков"""
+        message = update.get("message") or update.get("callback_query", {}).get("message") or {}
+        chat_id = message.get("chat", {}).get("id", 0)
+        await self.update_workers.submit(chat_id, update)
+    
+    async def accept_update(self, update, timeout=10):
+        """Принимает апдейт из webhook (повтор уже принятого апдейта пропускается)
+
+        False — очередь обработчиков не приняла апдейт за timeout секунд; отметка с него
+        снимается, чтобы повтор от Telegram не отбросился как дубликат.
+        """
+        update_id = update["update_id"]
+        if await self.processed_updates.claim([update_id]):
+            try:
+                await asyncio.wait_for(self.enqueue_update(update), timeout)
+            except asyncio.TimeoutError:
+                await self.processed_updates.forget([update_id])
+                return False
+        self.last_update_id = max(self.last_update_id, update_id)
+        return True
+    
+    async def load_update_offset(self):
+        """Последний принятый update_id из прошлого запуска"""
+        row = await self.db.fetchone("SELECT value FROM bot_state WHERE key = 'last_update_id'")
+        if row:
+            self.last_update_id = max(self.last_update_id, int(row[0]))
+            self.saved_update_id = self.last_update_id
+    
+    def checkpoint_update_offset(self):
+        """Ставит запись смещения в очередь SQLite, не дожидаясь ее; возвращает future или None"""
+        if self.last_update_id == self.saved_update_id:
+            return None
+        self.saved_update_id = offset = self.last_update_id
+        return self.db.submit_write(lambda conn: conn.execute(
+            "INSERT OR REPLACE INTO bot_state (key, value) VALUES ('last_update_id', ?)", (str(offset),)
+        ))
+    
+    async def save_update_offset(self):
+        future = self.checkpoint_update_offset()
+        if future:
+            await asyncio.wrap_future(future)
+    
+    async def setup_webhook(self):
+        """Регистрирует webhook в Telegram"""
+        url = self.webhook_url + os.environ.get("WEBHOOK_PATH", "/webhook")
+        result = await self.make_request("setWebhook", {
+            "url": url,
+            "secret_token": self.webhook_secret,
+            "allowed_updates": self.ALLOWED_UPDATES
+        })
+        if result and result.get("ok"):
+            self.log(f"🔗 Webhook установлен: {url}")
+            return True
+        self.log(f"❌ Не удалось установить webhook: {result}", logging.ERROR)
+        return False
+    
+    async def run_polling(self):
+        """Получение апдейтов через long polling"""
+        # Если раньше был установлен webhook, getUpdates будет отвечать 409
+        await self.make_request("deleteWebhook")
         
-        for user_id, chat_id, reminder_time in active_users:
-            await self.start_reminder_for_user(user_id, chat_id, reminder_time)
+        # Главный цикл с проверкой флага running
+        while self.is_running:
+            try:
+                updates = await self.get_updates()
+                # Повторно присланные апдейты (например, после рестарта) обработчикам не передаются
+                fresh = await self.processed_updates.claim([update["update_id"] for update in updates]) if updates else set()
+                
+                for update in updates:
+                    # Смещение двигаем только после того, как апдейт принят в очередь
+                    if update["update_id"] in fresh:
+                        fresh.discard(update["update_id"])
+                        await self.enqueue_update(update)
+                    self.last_update_id = update["update_id"]
+                
+                # Одна запись смещения на пачку апдейтов, в общей транзакции с остальными записями
+                self.checkpoint_update_offset()
+                
+                # Если апдейты были — сразу опрашиваем снова
+                if not updates:
+                    await asyncio.sleep(1)
+                
+            except Exception as e:
+                self.log(f"💥 Ошибка в главном цикле: {e}", logging.ERROR, key="main_loop_error")
+                await asyncio.sleep(5)
+    
+    def owns(self, user_id):
+        """Отвечает ли этот процесс за доставку напоминаний пользователю"""
+        return self.shards == 1 or shard_for(user_id, self.shards) == self.shard_index
+    
+    def forward_to_shard(self, user_id, message):
+        """Передает изменение процессу доставки, которому принадлежит пользователь"""
+        control_queue = self.worker_queues.get(shard_for(user_id, self.shards))
+        if control_queue is not None:
+            control_queue.put(message)
+    
+    def apply_control(self, message):
+        """Применяет изменение от основного процесса (в процессе доставки)"""
+        kind = message[0]
+        if kind == 'settings':
+            _, user_id, chat_id, is_active, reminder_minute, timezone = message
+            self.settings.records[user_id] = UserSettings(user_id, chat_id, is_active, reminder_minute, timezone)
+    
+    def start_delivery_workers(self):
+        """Запускает процессы доставки для шардов 1..N-1 (шард 0 обслуживает основной процесс)"""
+        context = multiprocessing.get_context("spawn")
+        for shard_index in range(1, self.shards):
+            process = self.worker_processes.get(shard_index)
+            if process is not None and process.is_alive():
+                continue
+            if process is not None:
+                self.log(f"⚠️ Процесс доставки {shard_index} завершился (код {process.exitcode}), перезапускаем", logging.WARNING)
             
-            # Вычисляем пользовательское время для лога
-            server_time = datetime.strptime(reminder_time.split(' ')[0], "%H:%M")
-            user_time = server_time + timedelta(hours=3)
-            user_time_str = user_time.strftime("%H:%M")
+            # Очередь всегда новая: убитый процесс мог оставить захваченной блокировку старой
+            control_queue = context.Queue()
+            metrics_queue = context.Queue()
+            process = context.Process(
+                target=run_delivery_worker,
+                args=(self.token, shard_index, self.shards, control_queue, metrics_queue),
+                name=f"delivery-{shard_index}",
+                daemon=True
+            )
+            process.start()
+            self.worker_queues[shard_index] = control_queue
+            self.worker_metrics_queues[shard_index] = metrics_queue
+            self.worker_processes[shard_index] = process
+    
+    async def supervise_workers(self, interval=10):
+        """Перезапускает упавшие процессы доставки"""
+        while self.is_running:
+            await asyncio.sleep(interval)
+            if self.is_running:
+                self.start_delivery_workers()
+                self.collect_worker_metrics()
+    
+    def collect_worker_metrics(self):
+        """Последние снимки метрик процессов доставки: [((('shard', i),), снимок)]"""
+        for shard_index, metrics_queue in list(self.worker_metrics_queues.items()):
+            try:
+                while True:
+                    self.worker_metrics[shard_index] = metrics_queue.get_nowait()
+            except (queue.Empty, OSError, ValueError):
+                pass
+        return [((('shard', str(shard_index)),), snapshot) for shard_index, snapshot in sorted(self.worker_metrics.items())]
+    
+    async def stop_delivery_workers(self, timeout=15):
+        for control_queue in self.worker_queues.values():
+            control_queue.put(None)
+        for process in self.worker_processes.values():
+            await self.loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                process.terminate()
+        self.worker_processes.clear()
+    
+    def read_control(self, control_queue):
+        """Поток чтения управляющей очереди в процессе доставки"""
+        while True:
+            message = control_queue.get()
+            if message is None:
+                self.loop.call_soon_threadsafe(setattr, self, 'is_running', False)
+                return
+            self.loop.call_soon_threadsafe(self.apply_control, message)
+    
+    async def run_delivery_worker(self, control_queue, metrics_queue=None, metrics_interval=15):
+        """Цикл процесса доставки: только свой срез пользователей, без получения апдейтов"""
+        self.loop = asyncio.get_running_loop()
+        self.loop.add_signal_handler(signal.SIGTERM, setattr, self, 'is_running', False)
+        threading.Thread(target=self.read_control, args=(control_queue,), daemon=True).start()
+        self.log(f"🧩 Процесс доставки {self.shard_index + 1}/{self.shards} запущен")
+        
+        try:
+            self.cat_pool.start()
+            await self.warm_up()
             
-            self.log(f"♻️ Восстановлено напоминание для {user_id} в {user_time_str} (по вашему времени)")
+            ticks = 0
+            while self.is_running:
+                await asyncio.sleep(1)
+                ticks += 1
+                if metrics_queue is not None and ticks % metrics_interval == 0:
+                    metrics_queue.put(METRICS.snapshot())
+        finally:
+            await self.stop()
+    
+    async def load_settings(self):
+        """Загружает настройки в кэш порциями, не блокируя обработку апдейтов
+
+        Основной процесс отвечает на сообщения всех пользователей и грузит всех, процесс
+        доставки — только свой шард: по кэшу он проверяет is_active перед отправкой.
+        """
+        shard = (self.shard_index, self.shards) if self.shard_index else (0, 1)
+        loaded = 0
+        async for records in self.settings.iter_chunks(*shard, chunk_size=self.restore_chunk_size):
+            loaded += len(records)
+            # Записи живут до остановки бота: убираем их из обхода сборщика мусора,
+            # иначе полные сборки на миллионе пользователей останавливают цикл на сотни мс
+            gc.freeze()
+        self.log(f"♻️ Загружены настройки пользователей: {loaded}")
+        return loaded
+    
+    async def warm_up(self):
+        """Фоновая часть запуска: журнал после рестарта, планировщик доз, затем кэш настроек"""
+        started = time.monotonic()
+        # Аренды снимаются до первого тика, чтобы не задеть задания, которые он запишет
+        recovered, expired = await self.outbox.recover(self.missed_grace)
+        if recovered or expired:
+            self.log(f"♻️ Журнал: {recovered} незавершенных заданий возвращено в очередь, {expired} просрочено")
+        self.scheduler.start()
+        self.outbox_task = asyncio.create_task(self.run_outbox())
+        
+        await self.load_settings()
+        if self.shard_index == 0:
+            self.log(f"💊 Запуск завершен за {time.monotonic() - started:.1f} сек")
+            await self.broadcasts.resume()
     
     async def run_bot(self):
         """Главный цикл бота"""
         self.log("🔄 Запуск бота-напоминалки...")
+        self.loop = asyncio.get_running_loop()
         
         # Тест подключения
         test = await self.make_request("getMe")
@@ -478,52 +3520,87 @@ class MedicationReminderBot:
             bot_info = test["result"]
             self.log(f"🤖 Бот: @{bot_info.get('username', 'N/A')} ({bot_info.get('first_name', 'N/A')})")
         else:
-            self.log("❌ Ошибка подключения. Проверьте токен.")
+            self.log("❌ Ошибка подключения. Проверьте токен.", logging.ERROR)
             return
         
-        # Восстанавливаем активные напоминания
-        await self.restore_reminders()
+        await self.load_update_offset()
+        
+        # Процессы доставки для остальных шардов
+        if self.shards > 1:
+            self.log(f"🧩 Доставка разделена на {self.shards} процессов")
+            self.start_delivery_workers()
+            self.supervisor_task = asyncio.create_task(self.supervise_workers())
+        
+        # Запускаем пополнение пула котиков и обработчики апдейтов
+        self.cat_pool.start()
+        self.update_workers.start()
+        # Журнал, планировщик и кэш настроек стартуют в фоне: бот отвечает на апдейты сразу
+        self.warmup_task = asyncio.create_task(self.warm_up())
         
         self.log("🎯 Бот готов к работе!")
-        self.log("💊 Напоминания восстановлены для активных пользователей")
         
-        # Главный цикл с проверкой флага running
-        while self.is_running:
-            try:
-                updates = await self.get_updates()
-                
-                for update in updates:
-                    if not self.is_running:
-                        break
-                    self.last_update_id = update["update_id"]
-                    if "message" in update:
-                        await self.process_message(update["message"])
-                
+        if self.webhook_url and await self.setup_webhook():
+            # Апдейты приходят в /webhook, здесь только ждем остановки
+            while self.is_running:
                 await asyncio.sleep(1)
-                
-            except Exception as e:
-                self.log(f"💥 Ошибка в главном цикле: {e}")
-                await asyncio.sleep(5)
+        else:
+            self.webhook_url = ""
+            await self.run_polling()
     
     async def stop(self):
         """Корректная остановка бота"""
         self.log("🛑 Останавливаем бота...")
         self.is_running = False
         
-        # Отменяем все задачи напоминаний
-        for user_id, task in list(self.reminder_tasks.items()):
+        # Останавливаем процессы доставки
+        if self.supervisor_task:
+            self.supervisor_task.cancel()
+        if self.worker_processes:
+            await self.stop_delivery_workers()
+        
+        # Дорабатываем принятые апдейты и запоминаем, до какого апдейта дошли
+        drain_deadline = time.monotonic() + self.shutdown_drain_seconds
+        await self.update_workers.stop()
+        self.log(f"📊 Статистика обработки апдейтов: {self.update_workers.stats()}")
+        if self.shard_index == 0 and self.last_update_id:
+            await self.save_update_offset()
+        
+        # Начатые раздачи получают время до drain_deadline; недоставленное
+        # остается pending в журнале и уйдет после рестарта
+        await self.scheduler.stop()
+        if self.warmup_task:
+            self.warmup_task.cancel()
+        if self.outbox_task:
+            self.outbox_task.cancel()
+        self.broadcasts.stop()
+        if self.delivery_tasks:
+            await asyncio.wait(list(self.delivery_tasks), timeout=max(0, drain_deadline - time.monotonic()))
+        for task in list(self.delivery_tasks):
             task.cancel()
-        self.reminder_tasks.clear()
+        self.log(f"📬 Статистика журнала напоминаний: {self.outbox.stats()}")
+        await self.cat_pool.stop()
+        self.log(f"🐱 Статистика пула котиков: {self.cat_pool.stats()}")
+        
+        # Закрываем пул HTTP-соединений
+        self.log(f"📊 Статистика HTTP-пула: {self.http.stats()}")
+        await self.http.close()
         
-        # Закрываем соединение с БД
-        if hasattr(self, 'conn'):
-            self.conn.close()
+        # Дописываем очередь записей и закрываем соединение с БД
+        if hasattr(self, 'db'):
+            await self.db.aclose()
         
         self.log("✅ Бот остановлен")
 
+def run_delivery_worker(token, shard_index, shards, control_queue, metrics_queue=None):
+    """Точка входа процесса доставки: свой event loop, свой срез пользователей и своя доля лимита"""
+    # Остановкой управляет основной процесс через управляющую очередь
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    setup_logging()
+    bot = MedicationReminderBot(token, shard_index=shard_index, shards=shards)
+    asyncio.run(bot.run_delivery_worker(control_queue, metrics_queue))
+
 # Глобальные переменные
 bot_instance = None
-bot_task = None
 
 def get_token():
     """Получает токен бота из переменных окружения Railway"""
@@ -548,69 +3625,124 @@ def get_token():
     print("ℹ️ Добавьте переменную BOT_TOKEN в настройках Railway")
     return None
 
-async def start_bot():
-    """Запускает бота в асинхронном режиме"""
-    global bot_instance
-    
+async def broadcast_from_cli(args):
+    """Рассылка из командной строки с выводом прогресса
+
+    Процесс открывает ту же БД, но лимит Telegram у него свой: если бот запущен,
+    удобнее POST /admin/broadcast — тогда рассылка делит лимит с напоминаниями.
+    Поднимаются только БД, HTTP-пул с лимитером и Broadcaster: без кэша котиков на диске
+    (он чистит общий каталог, в котором качает файлы работающий бот) и без метрик бота.
+    """
     token = get_token()
     if not token:
-        print("❌ Не удалось получить токен бота.")
-        return
+        return 1
     
-    bot_instance = MedicationReminderBot(token)
-    await bot_instance.run_bot()
-
-async def stop_bot():
-    """Останавливает бота"""
-    global bot_instance
-    if bot_instance:
-        await bot_instance.stop()
-
-def signal_handler(signum, frame):
-    """Обработчик сигналов для корректной остановки"""
-    print(f"\n🛑 Получен сигнал {signum}, останавливаем бота...")
-    asyncio.create_task(stop_bot())
-    sys.exit(0)
+    log = MedicationReminderBot.log
+    db = MedicationReminderBot.open_database(os.path.join(os.getcwd(), 'reminder_bot.db'))
+    http = HttpClientPool(MedicationReminderBot.create_ssl_context())
+    rate_limiter = RateLimiter(
+        global_rate=float(os.environ.get("TG_GLOBAL_RATE", 30)),
+        chat_rate=float(os.environ.get("TG_CHAT_RATE", 1))
+    )
+    telegram = TelegramClient(token, http, rate_limiter, log)
+    
+    async def send(chat_id, text):
+        return await telegram.make_request("sendMessage", {"chat_id": chat_id, "text": text, "parse_mode": "HTML"})
+    
+    broadcasts = Broadcaster(
+        db,
+        send,
+        log,
+        chunk_size=int(os.environ.get("BROADCAST_CHUNK_SIZE", 200)),
+        lease=int(os.environ.get("BROADCAST_LEASE_SECONDS", 300))
+    )
+    try:
+        if args.status:
+            print(json.dumps(await broadcasts.progress(args.status), ensure_ascii=False))
+            return 0
+        
+        broadcast_id = args.resume or await broadcasts.create(args.text)
+        task = broadcasts.start(broadcast_id)
+        while not task.done():
+            await asyncio.wait({task}, timeout=args.interval)
+            print(json.dumps(await broadcasts.progress(broadcast_id), ensure_ascii=False), flush=True)
+        await task
+        return 0
+    finally:
+        broadcasts.stop()
+        await http.close()
+        await db.aclose()
 
-# Регистрируем обработчики сигналов
-signal.signal(signal.SIGINT, signal_handler)
-signal.signal(signal.SIGTERM, signal_handler)
+def run_broadcast_cli(argv):
+    """python app.py broadcast "текст" | --resume ID | --status ID"""
+    import argparse
+    
+    parser = argparse.ArgumentParser(prog="app.py broadcast", description="Рассылка всем активным пользователям")
+    parser.add_argument("text", nargs="?", help="текст сообщения (HTML)")
+    parser.add_argument("--resume", type=int, metavar="ID", help="продолжить прерванную рассылку")
+    parser.add_argument("--status", type=int, metavar="ID", help="показать прогресс рассылки")
+    parser.add_argument("--interval", type=float, default=5, help="как часто печатать прогресс, сек")
+    args = parser.parse_args(argv)
+    if not (args.text or args.resume or args.status):
+        parser.error("нужен текст, --resume или --status")
+    return asyncio.run(broadcast_from_cli(args))
 
-def run_flask_app():
-    """Запускает Flask приложение"""
+async def serve_http():
+    """Запускает HTTP-сервер (health, status, metrics, webhook) в текущем event loop"""
     port = int(os.environ.get("PORT", 10000))
-    print(f"🌐 Запускаем Flask сервер на порту {port}")
-    app.run(host='0.0.0.0', port=port, debug=False)
+    runner = web.AppRunner(create_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', port).start()
+    print(f"🌐 HTTP-сервер запущен на порту {port}")
+    return runner
 
 async def main():
-    """Основная функция запуска"""
+    """Основная функция запуска: HTTP-сервер и бот в одном event loop; возвращает код выхода"""
+    global bot_instance
     print("=" * 50)
     print("🐱 TELEGRAM БОТ-НАПОМИНАЛКА (TIMEZONE FIXED)")
     print("💊 Ежедневные напоминания + котики!")
     print("⏰ Время автоматически корректируется (UTC+3)")
     print("=" * 50)
     
-    # Запускаем бота в фоновой задаче
-    bot_task = asyncio.create_task(start_bot())
+    token = get_token()
+    if not token:
+        print("❌ Не удалось получить токен бота.")
+        return 1
+    
+    bot_instance = MedicationReminderBot(token)
+    runner = await serve_http()
+    
+    # SIGTERM (остановка на Railway) и Ctrl+C только ставят флаг; останавливаемся здесь, в event loop
+    stop_requested = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop_requested.set)
+    
+    bot_task = asyncio.create_task(bot_instance.run_bot())
+    stop_wait = asyncio.create_task(stop_requested.wait())
+    await asyncio.wait({bot_task, stop_wait}, return_when=asyncio.FIRST_COMPLETED)
+    if stop_requested.is_set():
+        print("\n🛑 Получен сигнал остановки, останавливаем бота...")
     
+    # Сначала перестаем принимать апдейты (polling и webhook), затем дорабатываем уже принятое
+    bot_instance.is_running = False
+    stop_wait.cancel()
+    bot_task.cancel()
     try:
-        # Ждем завершения задачи бота (никогда не завершится в нормальном режиме)
         await bot_task
     except asyncio.CancelledError:
-        print("🛑 Задача бота отменена")
+        pass
     except Exception as e:
         print(f"💥 Критическая ошибка: {e}")
+    await runner.cleanup()
+    await bot_instance.stop()
+    return 0 if stop_requested.is_set() else 1
 
 if __name__ == "__main__":
-    # Для Railway запускаем Flask + бота в отдельных потоках
-    import threading
-    
-    # Запускаем бота в отдельном потоке
-    def run_async_bot():
-        asyncio.run(main())
+    setup_logging()
     
-    bot_thread = threading.Thread(target=run_async_bot, daemon=True)
-    bot_thread.start()
+    if sys.argv[1:2] == ["broadcast"]:
+        sys.exit(run_broadcast_cli(sys.argv[2:]))
     
-    # Запускаем Flask в основном потоке
-    run_flask_app()
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,442 @@
+"""Бенчмарки компонентов бота
+
+Примеры:
+    python bench.py memory --users 100000
+    python bench.py outbox --jobs 10000
+    python bench.py logging --calls 100000
+    python bench.py startup --users 1000000
+    python bench.py schedules --rows 1000000 --due 50000
+    python bench.py render --messages 20000
+    python bench.py adherence --users 100000 --days 90
+"""
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import app
+
+
+def bench_memory(args):
+    """Память кэша настроек пользователей (UserSettingsStore) на N пользователей"""
+    reminder_minutes = sorted(set(app.TIME_CHOICES.values()))
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+
+    store = app.UserSettingsStore(db=None)
+    for user_id in range(args.users):
+        chat_id = 10_000_000 + user_id
+        # Строки приходят из SQLite новыми объектами, как при реальной загрузке
+        timezone = "".join(list(app.DEFAULT_TIMEZONE))
+        reminder_minute = reminder_minutes[user_id % len(reminder_minutes)]
+        store.records[user_id] = app.UserSettings(user_id, chat_id, True, reminder_minute, timezone)
+
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    total = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    return {
+        "benchmark": "memory",
+        "users": args.users,
+        "total_bytes": total,
+        "bytes_per_user": round(total / args.users, 1)
+    }
+
+
+def bench_outbox(args):
+    """Скорость разбора журнала: N pending-заданий -> claim -> отправка (заглушка) -> sent"""
+    async def run():
+        bot = app.MedicationReminderBot("0:bench")
+        bot.log = lambda message, *args, **kwargs: None
+        bot.dispatcher.log = bot.log
+
+        async def fake_send(user_id, chat_id, cat_url=None, medication=None, due_at=None, stage=0, slots=0):
+            await asyncio.sleep(0)
+            return True
+
+        bot.fire_reminder = fake_send
+        # Без повторных напоминаний: каждое задание завершается после первой отправки
+        bot.nudge_max = 0
+        # Кэш настроек как после загрузки на старте: доставка не ходит в SQLite за каждым пользователем
+        bot.settings.loaded = True
+        due_at = int(time.time()) - 60
+        await bot.db.executemany(
+            "INSERT INTO reminder_outbox (user_id, chat_id, due_at, next_attempt_at) VALUES (?, ?, ?, ?)",
+            [(user_id, user_id, due_at, due_at) for user_id in range(args.jobs)]
+        )
+
+        started = time.perf_counter()
+        while True:
+            slots = await bot.outbox.claim_due(limit=args.batch)
+            if not slots:
+                break
+            for slot_ts, jobs in slots.items():
+                await bot.dispatcher.dispatch_slot(slot_ts, jobs, None)
+        # Дожидаемся, пока отметки sent будут записаны
+        await bot.db.fetchone("SELECT 1")
+        elapsed = time.perf_counter() - started
+
+        sent = (await bot.db.fetchone("SELECT COUNT(*) FROM reminder_outbox WHERE status = 'sent'"))[0]
+        stats = bot.db.stats()
+        await bot.db.aclose()
+        return {
+            "benchmark": "outbox",
+            "jobs": args.jobs,
+            "sent": sent,
+            "seconds": round(elapsed, 3),
+            "jobs_per_second": round(args.jobs / elapsed),
+            "write_batches": stats["write_batches"]
+        }
+
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            return asyncio.run(run())
+        finally:
+            os.chdir(cwd)
+
+
+def bench_logging(args):
+    """Цена вызова bot.log на горячем пути: очередь логов против прежнего print с timestamp"""
+    def per_call(fn):
+        started = time.perf_counter()
+        for i in range(args.calls):
+            fn(i)
+        return round((time.perf_counter() - started) / args.calls * 1e6, 3)
+
+    with tempfile.TemporaryDirectory() as workdir, open(os.devnull, "w") as devnull:
+        cwd, stdout = os.getcwd(), sys.stdout
+        os.chdir(workdir)
+        sys.stdout = devnull
+        try:
+            app.setup_logging()
+            bot = app.MedicationReminderBot("0:bench")
+
+            def print_log(i):
+                timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                print(f"[{timestamp}] 📨 Отправлено напоминание пользователю {i}")
+
+            result = {
+                "benchmark": "logging",
+                "calls": args.calls,
+                "format": os.environ.get("LOG_FORMAT", "text"),
+                "print_us": per_call(print_log),
+                "info_us": per_call(lambda i: bot.log(f"📨 Отправлено напоминание пользователю {i}")),
+                "debug_filtered_us": per_call(lambda i: bot.log(f"📨 Отправлено напоминание пользователю {i}", logging.DEBUG)),
+                "rate_limited_us": per_call(lambda i: bot.log(f"⏳ Лимит Telegram, ждем {i} сек", logging.WARNING, key="bench")),
+            }
+            # Сколько фоновому потоку нужно, чтобы дописать накопленное
+            started = time.perf_counter()
+            app.stop_logging()
+            result["drain_seconds"] = round(time.perf_counter() - started, 3)
+            bot.db.close()
+        finally:
+            sys.stdout = stdout
+            os.chdir(cwd)
+    return result
+
+
+def bench_startup(args):
+    """Запуск на синтетической базе из N пользователей: импорт, готовность к апдейтам, загрузка кэша настроек
+    и первый тик планировщика, который считает время доз после миграции (next_due_minute = -1)"""
+    timezones = ["Europe/Moscow", "Asia/Yekaterinburg", "Europe/Berlin", "America/New_York"]
+    reminder_minutes = sorted(set(app.TIME_CHOICES.values()))
+
+    async def fill():
+        bot = app.MedicationReminderBot("0:bench")
+        rows = (
+            (user_id, 10_000_000 + user_id, int(user_id % 10 != 0),
+             reminder_minutes[user_id % len(reminder_minutes)], timezones[user_id % len(timezones)])
+            for user_id in range(1, args.users + 1)
+        )
+        await bot.db.executemany(
+            "INSERT INTO user_settings (user_id, chat_id, is_active, reminder_minute, timezone) VALUES (?, ?, ?, ?, ?)",
+            rows
+        )
+        await bot.db.execute('''
+            INSERT INTO schedules (user_id, chat_id, local_minute, timezone, next_due_minute)
+            SELECT user_id, chat_id, reminder_minute, timezone, CASE WHEN is_active THEN -1 END FROM user_settings
+        ''')
+        await bot.db.aclose()
+
+    async def start():
+        started = time.perf_counter()
+        bot = app.MedicationReminderBot("0:bench")
+        bot.log = lambda message, *args, **kwargs: None
+
+        async def fake_request(method, data=None, retries=3):
+            return {"ok": True, "result": {"username": "bench", "first_name": "bench"}}
+
+        bot.make_request = fake_request
+        bot.cat_pool.start = lambda: None
+        result = {}
+
+        async def measure_stalls(stalls):
+            # Насколько цикл событий не успевает проснуться во время фоновой загрузки
+            while True:
+                before = time.perf_counter()
+                await asyncio.sleep(0.005)
+                stalls.append(time.perf_counter() - before - 0.005)
+
+        async def fake_polling():
+            result["ready_seconds"] = round(time.perf_counter() - started, 3)
+            stalls = []
+            monitor = asyncio.create_task(measure_stalls(stalls))
+            await bot.warmup_task
+            result["restored_seconds"] = round(time.perf_counter() - started, 3)
+            while not bot.scheduler.ticks:
+                await asyncio.sleep(0.01)
+            monitor.cancel()
+            result["first_tick_seconds"] = round(bot.scheduler.last_tick_seconds, 3)
+            result["max_loop_stall_ms"] = round(max(stalls, default=0) * 1000, 1)
+            result["scheduled"] = (await bot.db.fetchone(
+                "SELECT COUNT(*) FROM schedules WHERE next_due_minute IS NOT NULL"
+            ))[0]
+
+        bot.run_polling = fake_polling
+        await bot.run_bot()
+        await bot.stop()
+        return result
+
+    import_seconds = subprocess.run(
+        [sys.executable, "-c", "import time; t = time.perf_counter(); import app; print(time.perf_counter() - t)"],
+        capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))
+    ).stdout.split()[-1]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            asyncio.run(fill())
+            # Первый запуск после миграции считает время всех доз, следующие только читают индекс
+            migration = asyncio.run(start())
+            result = asyncio.run(start())
+            result["migration_tick_seconds"] = migration["first_tick_seconds"]
+        finally:
+            os.chdir(cwd)
+    return {
+        "benchmark": "startup",
+        "users": args.users,
+        "import_seconds": round(float(import_seconds), 3),
+        **result
+    }
+
+
+def bench_schedules(args):
+    """Тик планировщика доз на таблице из N строк: слот из --due наступивших доз и пустой тик"""
+    timezones = ["Europe/Moscow", "Asia/Yekaterinburg", "Europe/Berlin", "America/New_York"]
+
+    async def run():
+        bot = app.MedicationReminderBot("0:bench")
+        bot.log = lambda message, *args, **kwargs: None
+        now_minute = int(time.time() // 60)
+        # Остальные дозы разбросаны по следующим суткам, как у реальных пользователей
+        await bot.db.executemany(
+            "INSERT INTO schedules (user_id, chat_id, local_minute, timezone, next_due_minute) VALUES (?, ?, ?, ?, ?)",
+            (
+                (user_id, user_id, user_id % 1440, timezones[user_id % len(timezones)],
+                 now_minute if user_id <= args.due else now_minute + 1 + user_id % 1440)
+                for user_id in range(1, args.rows + 1)
+            )
+        )
+
+        started = time.perf_counter()
+        cpu_started = time.process_time()
+        queued, _ = await bot.scheduler.tick(now_minute)
+        slot_seconds = time.perf_counter() - started
+        slot_cpu = time.process_time() - cpu_started
+
+        started = time.perf_counter()
+        empty_ticks = 100
+        for _ in range(empty_ticks):
+            await bot.scheduler.tick(now_minute)
+        empty_seconds = (time.perf_counter() - started) / empty_ticks
+
+        await bot.db.aclose()
+        return {
+            "benchmark": "schedules",
+            "rows": args.rows,
+            "due": args.due,
+            "queued": queued,
+            "slot_tick_seconds": round(slot_seconds, 3),
+            "slot_cpu_seconds": round(slot_cpu, 3),
+            "doses_per_second": round(queued / slot_seconds),
+            "empty_tick_ms": round(empty_seconds * 1000, 3)
+        }
+
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            return asyncio.run(run())
+        finally:
+            os.chdir(cwd)
+
+
+def bench_render(args):
+    """CPU потока event loop на одно входящее сообщение: разбор команды, ответ и сериализация тела запроса"""
+    texts = ["/start", "📊 Статус", "⚙️ Настроить время", "21:00", "Назад", "ℹ️ Помощь", "что-то непонятное"]
+
+    async def run():
+        bot = app.MedicationReminderBot("0:bench")
+        bot.log = lambda message, *args, **kwargs: None
+        sent_bytes = 0
+
+        async def fake_request(method, data=None, retries=3, files=None, body=None, chat_id=None):
+            # Тело кодируется так же, как его закодировал бы aiohttp для json=data
+            nonlocal sent_bytes
+            sent_bytes += len(body if body is not None else json.dumps(data).encode())
+            return {"ok": True, "result": {}}
+
+        bot.make_request = fake_request
+        # Пользователи уже в кэше настроек, чтобы мерить обработку, а не первое чтение из SQLite
+        users = 1000
+        for user_id in range(users):
+            await bot.save_user_settings(user_id, user_id, False)
+
+        messages = [
+            {"chat": {"id": n % users}, "from": {"id": n % users}, "text": texts[n % len(texts)]}
+            for n in range(args.messages)
+        ]
+        started = time.thread_time()
+        for message in messages:
+            await bot.process_message(message)
+        cpu = time.thread_time() - started
+
+        await bot.http.close()
+        await bot.db.aclose()
+        return cpu, sent_bytes
+
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            cpu, sent_bytes = asyncio.run(run())
+        finally:
+            os.chdir(cwd)
+    return {
+        "benchmark": "render",
+        "messages": args.messages,
+        "cpu_us_per_message": round(cpu / args.messages * 1e6, 1),
+        "body_bytes_per_message": round(sent_bytes / args.messages, 1)
+    }
+
+
+def bench_adherence(args):
+    """Журнал приёма: N пользователей по 2 дозы в день за D дней — /stats одного пользователя и выгрузка CSV"""
+    async def run():
+        bot = app.MedicationReminderBot("0:bench")
+        bot.log = lambda message, *args, **kwargs: None
+        today = int(time.time() // 86400)
+        # Утренняя и вечерняя доза, вечерняя отмечена через день
+        morning, evening = 1 << 0, 1 << 1
+        await bot.db.executemany(
+            "INSERT INTO dose_log (user_id, day, due_mask, taken_mask) VALUES (?, ?, ?, ?)",
+            (
+                (user_id, day, morning | evening, morning | (evening if day % 2 else 0))
+                for user_id in range(1, args.users + 1)
+                for day in range(today - args.days + 1, today + 1)
+            )
+        )
+
+        reports = 1000
+        started = time.perf_counter()
+        for user_id in range(1, reports + 1):
+            await bot.adherence.report(user_id, today)
+        report_ms = (time.perf_counter() - started) / reports * 1000
+
+        async def export(days):
+            size = lines = 0
+            async for chunk in bot.adherence.export(days):
+                size += len(chunk)
+                lines += chunk.count(b"\n")
+            return size, lines
+
+        results = {}
+        for days in app.ADHERENCE_PERIODS[1:]:
+            started = time.perf_counter()
+            size, lines = await export(days)
+            elapsed = time.perf_counter() - started
+            # Память — отдельным проходом: tracemalloc сильно замедляет выгрузку
+            tracemalloc.start()
+            await export(days)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results[f"export_{days}d"] = {
+                "users": lines,
+                "seconds": round(elapsed, 3),
+                "bytes": size,
+                "peak_memory_bytes": peak
+            }
+
+        await bot.db.aclose()
+        return {
+            "benchmark": "adherence",
+            "users": args.users,
+            "days": args.days,
+            "report_ms": round(report_ms, 3),
+            **results
+        }
+
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            return asyncio.run(run())
+        finally:
+            os.chdir(cwd)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки бота-напоминалки")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    memory = subparsers.add_parser("memory", help="память кэша настроек пользователей")
+    memory.add_argument("--users", type=int, default=100_000)
+    memory.set_defaults(func=bench_memory)
+
+    outbox = subparsers.add_parser("outbox", help="разбор журнала напоминаний")
+    outbox.add_argument("--jobs", type=int, default=10_000)
+    outbox.add_argument("--batch", type=int, default=1000)
+    outbox.set_defaults(func=bench_outbox)
+
+    logs = subparsers.add_parser("logging", help="цена вызова логирования")
+    logs.add_argument("--calls", type=int, default=100_000)
+    logs.set_defaults(func=bench_logging)
+
+    startup = subparsers.add_parser("startup", help="запуск на синтетической базе")
+    startup.add_argument("--users", type=int, default=100_000)
+    startup.set_defaults(func=bench_startup)
+
+    schedules = subparsers.add_parser("schedules", help="тик планировщика доз на большой таблице")
+    schedules.add_argument("--rows", type=int, default=1_000_000)
+    schedules.add_argument("--due", type=int, default=50_000)
+    schedules.set_defaults(func=bench_schedules)
+
+    render = subparsers.add_parser("render", help="CPU на обработку одного сообщения")
+    render.add_argument("--messages", type=int, default=20_000)
+    render.set_defaults(func=bench_render)
+
+    adherence = subparsers.add_parser("adherence", help="статистика и выгрузка журнала приёма")
+    adherence.add_argument("--users", type=int, default=100_000)
+    adherence.add_argument("--days", type=int, default=90)
+    adherence.set_defaults(func=bench_adherence)
+
+    args = parser.parse_args()
+    print(json.dumps(args.func(args), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
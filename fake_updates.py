@@ -0,0 +1,70 @@
+"""Локальная замена Telegram для проверки webhook: отправляет фейковые апдейты в бота
+
+Пример:
+    WEBHOOK_SECRET=test python fake_updates.py --url http://127.0.0.1:10000/webhook --count 100
+"""
+import argparse
+import asyncio
+import os
+import time
+
+import aiohttp
+
+
+def make_update(update_id, chat_id, text):
+    """Собирает апдейт в формате Telegram Bot API"""
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"Test {chat_id}"},
+            "text": text
+        }
+    }
+
+
+async def send_updates(url, secret, count, chats, text, concurrency, start_id):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret}
+    statuses = {}
+    latencies = []
+    next_id = iter(range(start_id, start_id + count))
+
+    async with aiohttp.ClientSession(headers=headers) as session:
+        async def worker():
+            for update_id in next_id:
+                update = make_update(update_id, 100000 + update_id % chats, text)
+                started = time.perf_counter()
+                async with session.post(url, json=update) as response:
+                    await response.read()
+                    statuses[response.status] = statuses.get(response.status, 0) + 1
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"📨 Отправлено {count} апдейтов за {elapsed:.2f} сек ({count / elapsed:.0f}/сек)")
+    print(f"📊 Статусы ответов: {statuses}")
+    if latencies:
+        print(f"⏱ p50 {latencies[len(latencies) // 2] * 1000:.1f} мс, p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f} мс")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Отправка фейковых апдейтов в webhook бота")
+    parser.add_argument("--url", default=f"http://127.0.0.1:{os.environ.get('PORT', 10000)}{os.environ.get('WEBHOOK_PATH', '/webhook')}")
+    parser.add_argument("--secret", default=os.environ.get("WEBHOOK_SECRET", ""))
+    parser.add_argument("--count", type=int, default=10)
+    parser.add_argument("--chats", type=int, default=5)
+    parser.add_argument("--text", default="📊 Статус")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--start-id", type=int, default=int(time.time()))
+    args = parser.parse_args()
+
+    asyncio.run(send_updates(args.url, args.secret, args.count, args.chats, args.text, args.concurrency, args.start_id))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,432 @@
+"""Нагрузочный стенд: бот в отдельном процессе против локальной заглушки Telegram и cat API
+
+Примеры:
+    python loadtest.py slot --users 50000
+    python loadtest.py updates --rate 500 --duration 30
+    python loadtest.py slot --users 10000 --latency-ms 80 --error-rate 0.01 --rate-429 0.02
+
+Заглушка отвечает на /bot<token>/<method> как api.telegram.org, на /cat/search как TheCatAPI
+и на /cat/cataas как Cataas; задержка, доля ошибок 500 и ответов 429 настраиваются.
+Бот получает адреса через TELEGRAM_API_URL и CAT_API_URLS.
+Результат — одна JSON-строка: пропускная способность, p50/p99 задержки, пиковый RSS процесса бота
+и задержка /health бота под нагрузкой (её меряет отдельный процесс `loadtest.py probe`, чтобы
+заглушка в этом процессе не искажала замер).
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import select
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from aiohttp import web
+
+from fake_updates import make_update
+
+TOKEN = "0:loadtest"
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+TIMEZONES = ["Europe/Moscow", "Asia/Yekaterinburg", "Europe/Berlin", "America/New_York"]
+
+# Кнопки, на каждую из которых бот отвечает ровно одним sendMessage
+BUTTONS = ["📊 Статус", "⚙️ Настроить время", "22:00", "Назад", "ℹ️ Помощь", "✅ Включить напоминания"]
+
+
+class FakeApi:
+    """Заглушка api.telegram.org, TheCatAPI и Cataas с настраиваемой задержкой, ошибками и 429"""
+
+    def __init__(self, latency_ms=0.0, error_rate=0.0, rate_429=0.0, retry_after=1):
+        self.latency = latency_ms / 1000
+        self.error_rate = error_rate
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.ids = itertools.count(1)
+        self.counts = {}
+        self.errors = 0
+        self.throttled = 0
+        self.pending_updates = deque()
+        self.updates_ready = asyncio.Event()
+        self.polled = asyncio.Event()
+        self.on_reply = None
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.telegram)
+        app.router.add_get("/cat/search", self.thecatapi)
+        app.router.add_get("/cat/cataas", self.cataas)
+        return app
+
+    async def delay(self):
+        if self.latency:
+            # Экспоненциальное распределение: среднее latency_ms, длинный хвост как у реальной сети
+            await asyncio.sleep(random.expovariate(1 / self.latency))
+
+    def failure(self):
+        """Ответ-ошибка по заданным долям или None"""
+        roll = random.random()
+        if roll < self.rate_429:
+            self.throttled += 1
+            return web.json_response({
+                "ok": False, "error_code": 429, "description": "Too Many Requests: retry later",
+                "parameters": {"retry_after": self.retry_after}
+            }, status=429)
+        if roll < self.rate_429 + self.error_rate:
+            self.errors += 1
+            return web.json_response({"ok": False, "error_code": 500, "description": "Internal Server Error"}, status=500)
+        return None
+
+    async def telegram(self, request):
+        method = request.match_info["method"]
+        self.counts[method] = self.counts.get(method, 0) + 1
+
+        if method == "getUpdates":
+            return await self.get_updates(request)
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": {"id": 1, "is_bot": True, "username": "loadtest_bot", "first_name": "Loadtest"}})
+        if method not in ("sendMessage", "sendPhoto"):
+            return web.json_response({"ok": True, "result": True})
+
+        if request.content_type == "application/json":
+            data = await request.json()
+        else:
+            data = dict(await request.post())
+        await self.delay()
+        error = self.failure()
+        if error is not None:
+            return error
+
+        chat_id = int(data["chat_id"])
+        message_id = next(self.ids)
+        if self.on_reply:
+            self.on_reply(chat_id, method, time.time())
+        result = {"message_id": message_id, "chat": {"id": chat_id}, "date": int(time.time())}
+        if method == "sendPhoto":
+            result["photo"] = [{"file_id": f"photo-{message_id}-s", "width": 90}, {"file_id": f"photo-{message_id}", "width": 800}]
+        return web.json_response({"ok": True, "result": result})
+
+    async def get_updates(self, request):
+        self.polled.set()
+        offset = int(request.query.get("offset", 0))
+        timeout = min(float(request.query.get("timeout", 0)), 5)
+        # Все апдейты до offset бот подтвердил
+        while self.pending_updates and self.pending_updates[0]["update_id"] < offset:
+            self.pending_updates.popleft()
+        if not self.pending_updates and timeout:
+            self.updates_ready.clear()
+            try:
+                await asyncio.wait_for(self.updates_ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return web.json_response({"ok": True, "result": list(itertools.islice(self.pending_updates, 100))})
+
+    def push_update(self, update):
+        self.pending_updates.append(update)
+        self.updates_ready.set()
+
+    async def thecatapi(self, request):
+        await self.delay()
+        error = self.failure()
+        if error is not None:
+            return error
+        image_id = next(self.ids)
+        return web.json_response([{"id": str(image_id), "url": f"https://cdn.example.com/cat/{image_id}.jpg"}])
+
+    async def cataas(self, request):
+        await self.delay()
+        error = self.failure()
+        if error is not None:
+            return error
+        return web.json_response({"url": f"/cat/{next(self.ids)}"})
+
+    def stats(self):
+        return {"requests": self.counts, "injected_errors": self.errors, "injected_429": self.throttled}
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 4)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def peak_rss_bytes(pid):
+    """Пиковый RSS (VmHWM) процесса и его дочерних процессов доставки; None вне Linux"""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            peak = next(int(line.split()[1]) * 1024 for line in status if line.startswith("VmHWM:"))
+        with open(f"/proc/{pid}/task/{pid}/children") as children:
+            child_pids = children.read().split()
+    except (OSError, StopIteration):
+        return None
+    return peak + sum(peak_rss_bytes(int(child)) or 0 for child in child_pids)
+
+
+async def create_users(workdir, users, minute_for_timezone):
+    """Синтетическая база: users активных пользователей, часовые поясы по кругу"""
+    import app  # схема и миграции — те же, что у бота
+
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        db = app.MedicationReminderBot(TOKEN).db
+    finally:
+        os.chdir(cwd)
+    await db.executemany(
+        "INSERT INTO user_settings (user_id, chat_id, is_active, reminder_minute, timezone) VALUES (?, ?, 1, ?, ?)",
+        (
+            (user_id, user_id, minute_for_timezone[TIMEZONES[user_id % len(TIMEZONES)]], TIMEZONES[user_id % len(TIMEZONES)])
+            for user_id in range(1, users + 1)
+        )
+    )
+    # По одной дозе на пользователя; время срабатывания бот посчитает на первом тике, как после миграции
+    await db.execute('''
+        INSERT INTO schedules (user_id, chat_id, local_minute, timezone, next_due_minute)
+        SELECT user_id, chat_id, reminder_minute, timezone, -1 FROM user_settings
+    ''')
+    await db.aclose()
+
+
+async def start_stack(args, workdir):
+    """Поднимает заглушку, запускает бота и зонд /health; возвращает (заглушка, runner, процесс бота, зонд)"""
+    fake = FakeApi(args.latency_ms, args.error_rate, args.rate_429)
+    runner = web.AppRunner(fake.create_app(), access_log=None)
+    await runner.setup()
+    port = free_port()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    api_url = f"http://127.0.0.1:{port}"
+
+    http_port = free_port()
+    env = dict(
+        os.environ,
+        BOT_TOKEN=TOKEN,
+        TELEGRAM_API_URL=api_url,
+        CAT_API_URLS=f"{api_url}/cat/search,{api_url}/cat/cataas?json=true",
+        PORT=str(http_port),
+        LOG_LEVEL=args.log_level,
+        TG_GLOBAL_RATE=str(args.global_rate),
+        TG_CHAT_RATE=str(args.chat_rate),
+        DELIVERY_WORKERS=str(args.workers),
+        REMINDER_RETRY_DELAY=str(args.retry_delay)
+    )
+    log_file = open(os.path.join(workdir, "bot.log"), "w")
+    process = subprocess.Popen([sys.executable, APP_PATH], cwd=workdir, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+    await asyncio.wait_for(fake.polled.wait(), 60)
+    probe = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.abspath(__file__), "probe", "--url", f"http://127.0.0.1:{http_port}/health",
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE
+    )
+    return fake, runner, process, probe
+
+
+def cpu_seconds(pid):
+    """Процессорное время процесса (user + system); None вне Linux"""
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            fields = stat.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return round((int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK"), 2)
+
+
+async def stop_stack(runner, process, probe, since):
+    """Останавливает бота и заглушку; возвращает пиковый RSS, процессорное время бота и задержку /health с момента since"""
+    usage = {"peak_rss_bytes": peak_rss_bytes(process.pid), "bot_cpu_seconds": cpu_seconds(process.pid)}
+
+    # Зонд печатает замеры, когда у него закрывают stdin
+    probe.stdin.close()
+    samples = json.loads((await probe.stdout.read()) or "[]")
+    await probe.wait()
+    window = [latency for at, latency in samples if at >= since]
+    answered = [latency for latency in window if latency is not None]
+    usage.update({
+        "health_checks": len(window),
+        "health_failed": len(window) - len(answered),
+        "health_p50": percentile(answered, 0.5),
+        "health_p99": percentile(answered, 0.99),
+        "health_max": round(max(answered), 4) if answered else None
+    })
+
+    process.terminate()
+    try:
+        await asyncio.to_thread(process.wait, 10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+    await runner.cleanup()
+    return usage
+
+
+async def run_slot(args, workdir):
+    """Сценарий «N пользователей в одну минуту»: задержка каждого напоминания от времени слота"""
+    # Ближайшая граница минуты не раньше чем через --lead секунд: бот успеет стартовать и загрузить напоминания
+    fire_dt = (datetime.now().astimezone() + timedelta(seconds=args.lead + 60)).replace(second=0, microsecond=0)
+    minute_for_timezone = {}
+    for timezone in TIMEZONES:
+        local = fire_dt.astimezone(ZoneInfo(timezone))
+        minute_for_timezone[timezone] = local.hour * 60 + local.minute
+    await create_users(workdir, args.users, minute_for_timezone)
+
+    fire_at = fire_dt.timestamp()
+    delivered = {}
+    done = asyncio.Event()
+
+    def on_reply(chat_id, method, at):
+        if method == "sendMessage" and chat_id not in delivered and at >= fire_at:
+            delivered[chat_id] = at
+            if len(delivered) >= args.users:
+                done.set()
+
+    fake, runner, process, probe = await start_stack(args, workdir)
+    fake.on_reply = on_reply
+    try:
+        await asyncio.wait_for(done.wait(), max(fire_at - time.time(), 0) + args.timeout)
+    except asyncio.TimeoutError:
+        pass
+    usage = await stop_stack(runner, process, probe, fire_at)
+
+    lateness = [at - fire_at for at in delivered.values()]
+    delivery_seconds = max(lateness, default=0)
+    return {
+        "scenario": "slot",
+        "users": args.users,
+        "delivered": len(delivered),
+        "delivery_seconds": round(delivery_seconds, 3),
+        "throughput_per_second": round(len(delivered) / delivery_seconds, 1) if delivery_seconds else None,
+        "lateness_p50": percentile(lateness, 0.5),
+        "lateness_p99": percentile(lateness, 0.99),
+        **usage,
+        **fake.stats()
+    }
+
+
+async def run_updates(args, workdir):
+    """Сценарий «поток нажатий кнопок»: задержка от появления апдейта до ответа бота"""
+    # Напоминания пользователей далеко от текущего времени, чтобы не мешали замеру
+    far = datetime.now().astimezone() + timedelta(hours=12)
+    minute_for_timezone = {
+        timezone: far.astimezone(ZoneInfo(timezone)).hour * 60 for timezone in TIMEZONES
+    }
+    await create_users(workdir, args.users, minute_for_timezone)
+
+    waiting = {}
+    latencies = []
+
+    def on_reply(chat_id, method, at):
+        sent = waiting.get(chat_id)
+        if method == "sendMessage" and sent:
+            latencies.append(at - sent.popleft())
+
+    fake, runner, process, probe = await start_stack(args, workdir)
+    fake.on_reply = on_reply
+
+    update_ids = itertools.count(1)
+    total = int(args.rate * args.duration)
+    started = time.time()
+    pushed = 0
+    while pushed < total:
+        # Равномерный поток: досылаем столько апдейтов, сколько положено к текущему моменту
+        due = min(total, int((time.time() - started) * args.rate))
+        for _ in range(due - pushed):
+            chat_id = random.randint(1, args.users)
+            waiting.setdefault(chat_id, deque()).append(time.time())
+            fake.push_update(make_update(next(update_ids), chat_id, random.choice(BUTTONS)))
+        pushed = due
+        await asyncio.sleep(0.01)
+    send_seconds = time.time() - started
+
+    # Дожидаемся ответов на уже отправленные апдейты
+    deadline = time.time() + args.timeout
+    while len(latencies) < total and time.time() < deadline:
+        await asyncio.sleep(0.1)
+    elapsed = time.time() - started
+    usage = await stop_stack(runner, process, probe, started)
+
+    return {
+        "scenario": "updates",
+        "users": args.users,
+        "updates": total,
+        "target_rate": args.rate,
+        "send_seconds": round(send_seconds, 3),
+        "answered": len(latencies),
+        "throughput_per_second": round(len(latencies) / elapsed, 1),
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p99": percentile(latencies, 0.99),
+        **usage,
+        **fake.stats()
+    }
+
+
+def probe_health(args):
+    """GET --url каждые --interval сек, пока открыт stdin; возвращает [[время, задержка или None], ...]"""
+    import urllib.request
+
+    samples = []
+    while True:
+        started = time.time()
+        try:
+            with urllib.request.urlopen(args.url, timeout=10) as response:
+                response.read()
+            samples.append((started, round(time.time() - started, 5)))
+        except OSError:
+            samples.append((started, None))
+        readable, _, _ = select.select([sys.stdin], [], [], args.interval)
+        if readable:
+            return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный стенд бота-напоминалки")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--latency-ms", type=float, default=0, help="средняя задержка ответа заглушки")
+    common.add_argument("--error-rate", type=float, default=0, help="доля ответов 500")
+    common.add_argument("--rate-429", type=float, default=0, help="доля ответов 429")
+    common.add_argument("--global-rate", type=float, default=100_000,
+                        help="TG_GLOBAL_RATE бота; по умолчанию лимит не мешает измерять сам бот")
+    common.add_argument("--chat-rate", type=float, default=1, help="TG_CHAT_RATE бота (сообщений в секунду на чат)")
+    common.add_argument("--workers", type=int, default=1, help="DELIVERY_WORKERS бота")
+    common.add_argument("--retry-delay", type=int, default=2, help="REMINDER_RETRY_DELAY бота")
+    common.add_argument("--timeout", type=float, default=300, help="сколько ждать доставки, сек")
+    common.add_argument("--log-level", default="WARNING", help="LOG_LEVEL бота (лог — bot.log во временной папке)")
+
+    slot = subparsers.add_parser("slot", parents=[common], help="N пользователей с напоминанием в одну минуту")
+    slot.add_argument("--users", type=int, default=50_000)
+    slot.add_argument("--lead", type=float, default=15, help="минимум секунд от запуска до слота")
+    slot.set_defaults(func=run_slot)
+
+    updates = subparsers.add_parser("updates", parents=[common], help="поток нажатий кнопок")
+    updates.add_argument("--users", type=int, default=10_000)
+    updates.add_argument("--rate", type=float, default=500, help="апдейтов в секунду")
+    updates.add_argument("--duration", type=float, default=20, help="длительность потока, сек")
+    updates.set_defaults(func=run_updates)
+
+    probe = subparsers.add_parser("probe", help="(служебный) замер задержки HTTP-эндпоинта до закрытия stdin")
+    probe.add_argument("--url", required=True)
+    probe.add_argument("--interval", type=float, default=0.05)
+    probe.set_defaults(func=probe_health)
+
+    args = parser.parse_args()
+    if args.command == "probe":
+        print(json.dumps(args.func(args)))
+        return
+    with tempfile.TemporaryDirectory() as workdir:
+        result = asyncio.run(args.func(args, workdir))
+    print(json.dumps(result, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Журнал приёма: у каждой дозы своя отметка, даже если дозы в одном получасе
+
+Запуск: python -m pytest -q test_adherence.py
+"""
+import asyncio
+import time
+
+import app
+
+
+def test_two_doses_in_one_half_hour(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    async def run():
+        bot = app.MedicationReminderBot("0:test")
+        bot.log = lambda message, *args, **kwargs: None
+        bot.is_running = True
+        bot.nudge_after = 0
+        sent = []
+        requests = []
+
+        async def fake_reminder(user_id, chat_id, cat_url=None, medication=None, ack=None):
+            sent.append(("reminder", medication, ack))
+            return True
+
+        async def fake_nudge(user_id, chat_id, medication=None, ack=None):
+            sent.append(("nudge", medication, ack))
+            return True
+
+        async def fake_request(method, data=None, **kwargs):
+            requests.append((method, data))
+            return {"ok": True, "result": {}}
+
+        bot.send_reminder = fake_reminder
+        bot.send_nudge = fake_nudge
+        bot.make_request = fake_request
+
+        async def deliver_due():
+            for due_at, jobs in (await bot.outbox.claim_due()).items():
+                for job in jobs:
+                    await bot.deliver_job(*job, due_at=due_at)
+            # Отметки sent пишутся в фоне; чтение после них ждет, пока они попадут в БД
+            await bot.db.fetchone("SELECT 1")
+
+        async def tap(ack):
+            requests.clear()
+            await bot.process_callback({
+                "id": "q", "from": {"id": 1}, "data": "ack:%d:%d" % ack,
+                "message": {"message_id": 1, "chat": {"id": 1}}
+            })
+            return [data.get("text") for method, data in requests if method == "answerCallbackQuery"]
+
+        await bot.save_user_settings(1, 1, True, 8 * 60, "Europe/Moscow")
+        await bot.schedules.add(1, 1, 8 * 60, app.ALL_WEEKDAYS, "Aspirin", "Europe/Moscow", True)
+        await bot.schedules.add(1, 1, 8 * 60 + 15, app.ALL_WEEKDAYS, "Insulin", "Europe/Moscow", True)
+
+        # Обе дозы наступили в прошлом получасе: в 00 и в 15 минут
+        now_minute = int(time.time() // 60)
+        half_hour = now_minute // 30 * 30 - 30
+        rows = await bot.schedules.list(1)
+        await bot.db.executemany(
+            "UPDATE schedules SET next_due_minute = ? WHERE id = ?",
+            [(half_hour + offset, row[0]) for row, offset in zip(rows, (0, 15))]
+        )
+        await bot.scheduler.tick(now_minute)
+        assert bot.scheduler.scheduled_users == 1
+        await deliver_due()
+
+        reminders = [entry for entry in sent if entry[0] == "reminder"]
+        assert sorted(medication for _, medication, _ in reminders) == ["Aspirin", "Insulin"]
+        acks = {medication: ack for _, medication, ack in reminders}
+        assert acks["Aspirin"][1] != acks["Insulin"][1]
+
+        # Первая кнопка отмечает только свою дозу
+        assert await tap(acks["Aspirin"]) == ["✅ Отмечено! Так держать 💪"]
+        assert await tap(acks["Aspirin"]) == ["Этот приём уже отмечен"]
+
+        # Повтор идет через общий цикл раздачи: без котика и без записи в статистику слотов
+        sent.clear()
+        bot.get_random_cat_image = None
+        slots_before = len(bot.dispatcher.slot_stats)
+        for due_at, jobs in (await bot.outbox.claim_due()).items():
+            await bot.dispatch_jobs(due_at, jobs)
+        await bot.db.fetchone("SELECT 1")
+        assert sent == [("nudge", "Insulin", acks["Insulin"])]
+        assert len(bot.dispatcher.slot_stats) == slots_before
+
+        today = app.dose_day(half_hour, "Europe/Moscow")
+        assert (await bot.adherence.report(1, today))["periods"][7] == (1, 2)
+        assert await tap(acks["Insulin"]) == ["✅ Отмечено! Так держать 💪"]
+        assert (await bot.adherence.report(1, today))["periods"][7] == (2, 2)
+
+        await bot.http.close()
+        await bot.db.aclose()
+
+    asyncio.run(run())